@@ -0,0 +1,376 @@
+"""局域网读缓存代理：同一对象只回源一次，多个下载端共享"""
+from botocore.exceptions import ClientError
+import os
+import threading
+import time
+import hashlib
+import html
+import json
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from era5.core import create_s3_client, FileIncompleteException
+
+
+# ================= 局域网缓存代理 =================
+CACHE_PORT = 8765
+
+
+class _CacheFill:
+    """一次回源下载，同一对象的并发请求共享它，边写入边读取"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.meta = None
+        self.written = 0
+        self.done = False
+        self.error = None
+
+    def wait_meta(self):
+        with self.cond:
+            while self.meta is None and self.error is None:
+                self.cond.wait()
+            if self.meta is None:
+                raise self.error
+            return self.meta
+
+    def wait_for(self, offset):
+        """等待 offset 之前的数据落盘，返回已写入的字节数"""
+        with self.cond:
+            while self.written < offset and not self.done and self.error is None:
+                self.cond.wait()
+            if self.written < offset and self.error is not None:
+                raise self.error
+            return self.written
+
+
+class S3CacheStore:
+    """磁盘上的对象缓存，按总大小 LRU 淘汰，未命中时整文件回源一次
+
+    每个对象存为 objects/<sha1>，旁边的 <sha1>.json 记录键、大小和 ETag，
+    写完后才生成，因此没有 .json 的数据文件视为残缺，启动时清理。
+    endpoint_url 是回源的 S3 端点(如上一级缓存或镜像)，为空时直连 AWS。
+    """
+
+    def __init__(self, cache_dir, max_bytes, s3_client, endpoint_url=None):
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.s3 = s3_client
+        self.endpoint_url = endpoint_url.rstrip('/') if endpoint_url else None
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # {名称: 元数据}，按最近访问排序
+        self.total = 0
+        self.readers = {}  # {名称: 正在读取的请求数}，读取中的对象不淘汰
+        self.fills = {}    # {名称: _CacheFill}
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'bytes_served': 0}
+        self._load()
+
+    def data_path(self, name):
+        return os.path.join(self.objects_dir, name)
+
+    def _load(self):
+        found = []
+        for fname in os.listdir(self.objects_dir):
+            if fname.endswith('.json'):
+                continue
+            path = self.data_path(fname)
+            try:
+                with open(path + '.json', 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                if os.path.getsize(path) != meta['size']:
+                    raise ValueError("大小不符")
+                found.append((os.path.getmtime(path), fname, meta))
+            except (OSError, ValueError, KeyError):
+                for p in (path, path + '.json'):
+                    if os.path.exists(p):
+                        os.remove(p)
+        for _, name, meta in sorted(found):
+            self.entries[name] = meta
+            self.total += meta['size']
+        print(f"[缓存] 已有 {len(self.entries)} 个对象, {self.total / 1073741824:.1f} GB")
+
+    @staticmethod
+    def _name(bucket, key):
+        return hashlib.sha1(f"{bucket}/{key}".encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _meta(bucket, key, resp):
+        return {'bucket': bucket, 'key': key, 'size': resp['ContentLength'], 'etag': resp.get('ETag', ''),
+                'last_modified': resp['LastModified'].strftime('%a, %d %b %Y %H:%M:%S GMT')}
+
+    def upstream_url(self, bucket, path):
+        """把 /桶/路径 换成回源端点上的地址；自定义端点按路径风格访问，与 create_s3_client 一致"""
+        if self.endpoint_url:
+            return f"{self.endpoint_url}/{bucket}/{path}"
+        return f"https://{bucket}.s3.amazonaws.com/{path}"
+
+    def head(self, bucket, key):
+        """HEAD 请求用的元数据：已缓存时直接返回，否则只向 S3 查询，不触发回源"""
+        with self.lock:
+            meta = self.entries.get(self._name(bucket, key))
+        if meta is not None:
+            return meta
+        return self._meta(bucket, key, self.s3.head_object(Bucket=bucket, Key=key))
+
+    def acquire(self, bucket, key):
+        """返回 (名称, 元数据或 None, 回源任务或 None)，调用方用完后必须 release"""
+        name = self._name(bucket, key)
+        with self.lock:
+            self.readers[name] = self.readers.get(name, 0) + 1
+            if name in self.entries:
+                self.entries.move_to_end(name)
+                self.stats['hits'] += 1
+                return name, self.entries[name], None
+            fill = self.fills.get(name)
+            if fill is not None:
+                self.stats['coalesced'] += 1
+                return name, None, fill
+            fill = self.fills[name] = _CacheFill()
+            self.stats['misses'] += 1
+        threading.Thread(target=self._fill, args=(name, bucket, key, fill), daemon=True).start()
+        return name, None, fill
+
+    def release(self, name):
+        with self.lock:
+            self.readers[name] -= 1
+            if not self.readers[name]:
+                del self.readers[name]
+
+    def touch(self, name):
+        """更新访问时间，重启后按它恢复 LRU 顺序"""
+        try:
+            os.utime(self.data_path(name))
+        except OSError:
+            pass
+
+    def _fill(self, name, bucket, key, fill):
+        path = self.data_path(name)
+        try:
+            with open(path, 'wb') as f:
+                resp = self.s3.get_object(Bucket=bucket, Key=key)
+                meta = self._meta(bucket, key, resp)
+                with fill.cond:
+                    fill.meta = meta
+                    fill.cond.notify_all()
+                body = resp['Body']
+                try:
+                    for chunk in body.iter_chunks(chunk_size=1024 * 1024):
+                        f.write(chunk)
+                        f.flush()
+                        with fill.cond:
+                            fill.written += len(chunk)
+                            fill.cond.notify_all()
+                finally:
+                    body.close()
+            if fill.written != meta['size']:
+                raise FileIncompleteException(f"回源不完整: {fill.written} != {meta['size']}")
+            with open(path + '.json', 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+            with self.lock:
+                self.entries[name] = meta
+                self.total += meta['size']
+                del self.fills[name]
+                self._evict()
+            with fill.cond:
+                fill.done = True
+                fill.cond.notify_all()
+        except Exception as e:
+            with self.lock:
+                del self.fills[name]
+            with fill.cond:
+                fill.error = e
+                fill.cond.notify_all()
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            if not isinstance(e, ClientError):
+                print(f"[缓存] 回源失败 {key}: {e}")
+
+    def _evict(self):
+        """淘汰最久未访问的对象直到不超过容量，跳过正在读取的对象(需持有锁)"""
+        for name in list(self.entries):
+            if self.total <= self.max_bytes:
+                break
+            if name in self.readers:
+                continue
+            meta = self.entries.pop(name)
+            self.total -= meta['size']
+            for p in (self.data_path(name), self.data_path(name) + '.json'):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+
+
+def _parse_range(header, size):
+    """解析单段 Range 头，返回 [start, stop)；无 Range 时返回 None"""
+    if not header or not header.startswith('bytes='):
+        return None
+    first, _, last = header[len('bytes='):].split(',')[0].strip().partition('-')
+    if not first:
+        return max(size - int(last), 0), size
+    start = int(first)
+    stop = min(int(last) + 1, size) if last else size
+    return start, stop
+
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+    """按 S3 路径风格 (/桶/键) 提供对象读取，其余请求(如列举)直接转发到 S3"""
+    protocol_version = "HTTP/1.1"
+    store = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle(send_body=True)
+
+    def do_HEAD(self):
+        self._handle(send_body=False)
+
+    def _handle(self, send_body):
+        url = urllib.parse.urlsplit(self.path)
+        bucket, _, key = url.path.lstrip('/').partition('/')
+        if not key or url.query:
+            self._passthrough(url, send_body)
+            return
+        key = urllib.parse.unquote(key)
+
+        if not send_body:
+            # HEAD 只要元数据，未缓存的对象不回源
+            try:
+                self._send_headers(self.store.head(bucket, key))
+            except Exception as e:
+                self._send_upstream_error(e)
+            return
+
+        name, meta, fill = self.store.acquire(bucket, key)
+        try:
+            try:
+                if meta is None:
+                    meta = fill.wait_meta()
+            except Exception as e:
+                self._send_upstream_error(e)
+                return
+
+            byte_range = self._send_headers(meta)
+            if byte_range is not None:
+                self._send_body(name, *byte_range, fill)
+            if fill is None:
+                self.store.touch(name)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        except Exception as e:
+            # 头部已发出，只能断开连接，客户端按不完整处理并续传
+            print(f"[缓存] 发送 {key} 中断: {e}")
+            self.close_connection = True
+        finally:
+            self.store.release(name)
+
+    def _send_headers(self, meta):
+        """按 Range 发送响应头，返回要发送的 (start, stop)；范围无效时回复 416 并返回 None"""
+        size = meta['size']
+        byte_range = _parse_range(self.headers.get('Range'), size)
+        if byte_range and byte_range[0] >= size:
+            self.send_response(416)
+            self.send_header('Content-Range', f"bytes */{size}")
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        start, stop = byte_range or (0, size)
+        self.send_response(206 if byte_range else 200)
+        if byte_range:
+            self.send_header('Content-Range', f"bytes {start}-{stop - 1}/{size}")
+        self.send_header('Content-Length', str(stop - start))
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', meta['etag'])
+        self.send_header('Last-Modified', meta['last_modified'])
+        self.end_headers()
+        return start, stop
+
+    def _send_body(self, name, start, stop, fill):
+        with open(self.store.data_path(name), 'rb') as f:
+            pos = start
+            while pos < stop:
+                # 回源中的对象只发送已经落盘的部分
+                available = stop if fill is None else min(stop, fill.wait_for(pos + 1))
+                if available <= pos:
+                    raise FileIncompleteException("回源提前结束")
+                self.connection.sendfile(f, pos, available - pos)
+                with self.store.lock:
+                    self.store.stats['bytes_served'] += available - pos
+                pos = available
+
+    def _send_upstream_error(self, e):
+        """把回源或查询元数据时的错误转成 S3 风格的错误响应"""
+        if isinstance(e, ClientError):
+            err = e.response.get('Error', {})
+            self._send_error(e.response['ResponseMetadata']['HTTPStatusCode'],
+                             err.get('Code', 'Error'), err.get('Message', ''))
+        else:
+            self._send_error(503, 'ServiceUnavailable', str(e))
+
+    def _send_error(self, status, code, message):
+        body = (f'<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>{code}</Code>'
+                f'<Message>{html.escape(message)}</Message></Error>').encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _passthrough(self, url, send_body):
+        bucket, _, rest = url.path.lstrip('/').partition('/')
+        upstream = self.store.upstream_url(bucket, rest) + (f"?{url.query}" if url.query else "")
+        try:
+            resp = urllib.request.urlopen(urllib.request.Request(upstream, method=self.command), timeout=30)
+        except urllib.error.HTTPError as e:
+            resp = e
+        except Exception as e:
+            self._send_error(503, 'ServiceUnavailable', str(e))
+            return
+        with resp:
+            body = resp.read()
+            self.send_response(resp.status)
+            for header in ('Content-Type', 'x-amz-bucket-region'):
+                if resp.headers.get(header):
+                    self.send_header(header, resp.headers[header])
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+
+
+def run_cache_server(cache_dir, max_bytes, host='0.0.0.0', port=CACHE_PORT, endpoint_url=None):
+    """启动局域网读缓存代理，直到 Ctrl+C；endpoint_url 给出时从该端点(镜像或上一级缓存)回源"""
+    store = S3CacheStore(cache_dir, max_bytes, create_s3_client(32, endpoint_url), endpoint_url)
+    handler = type('Handler', (CacheRequestHandler,), {'store': store})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+
+    def report():
+        while True:
+            time.sleep(60)
+            with store.lock:
+                s = dict(store.stats)
+                used = store.total
+            print(f"[缓存] 命中 {s['hits']}, 回源 {s['misses']}, 合并 {s['coalesced']}, "
+                  f"已发送 {s['bytes_served'] / 1073741824:.1f} GB, "
+                  f"占用 {used / 1073741824:.1f}/{max_bytes / 1073741824:.1f} GB")
+
+    threading.Thread(target=report, daemon=True).start()
+    print(f"[缓存] 监听 {host}:{port}，缓存目录 {cache_dir}，回源 {endpoint_url or 'AWS S3'}")
+    print(f"[缓存] 下载端在配置中设置 \"cache_endpoint\": \"http://<本机地址>:{port}\"")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n[缓存] 已退出")
+    finally:
+        server.server_close()
@@ -0,0 +1,260 @@
+"""命令行入口：download / plan 子命令以及缓存代理、存储、校验、常驻同步等无界面模式"""
+import os
+import sys
+import argparse
+import contextlib
+import threading
+import json
+import multiprocessing
+
+if __package__ in (None, ''):
+    # 直接运行 python era5/cli.py 时把项目根目录加入搜索路径，才能导入 era5 包
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from era5.progress import format_duration
+from era5.core import DEFAULT_DATASET, parse_size, read_config_file
+from era5.scheduling import parse_deadline, parse_months, submit_job
+from era5.validate import audit_directory
+from era5.content_store import ContentStore, print_store_status
+from era5.cache_proxy import CACHE_PORT, run_cache_server
+from era5.workqueue import WorkQueue
+from era5.plan import METRICS_DB
+from era5.headless import AutoDownloader, print_queue_status
+
+
+# ================= 命令行任务 =================
+def build_arg_parser(command='download'):
+    """download 与 plan 共用任务参数；plan 另有刷新列举和指定性能数据库的选项"""
+    description = {'download': "无界面下载 ERA5 数据，全部任务参数由命令行给出，不依赖 GUI 配置文件",
+                   'plan': "估算下载任务：按月份/变量汇总文件数和字节数，并按历史吞吐估算耗时，不下载"}
+    parser = argparse.ArgumentParser(prog=f"era5 {command}", description=description[command])
+    parser.add_argument('-d', '--dates', nargs='+', required=True, metavar='MONTHS',
+                        help="月份：202401、区间 202401-202403、整年 2024 或 2015-2024，可给多个或用逗号分隔")
+    parser.add_argument('-v', '--vars', nargs='+', default=[], metavar='VAR',
+                        help="变量代码，如 t u v 或 t,u,v；不给时下载全部变量")
+    parser.add_argument('--dataset', default=DEFAULT_DATASET,
+                        help=f"存储桶中的数据集前缀 (默认 {DEFAULT_DATASET})")
+    parser.add_argument('-o', '--output', required=True, help="保存根目录，每月一个子目录")
+    parser.add_argument('-t', '--threads', type=int, default=4, help="并发下载线程数 (默认 4)")
+    parser.add_argument('--max-rate', metavar='RATE',
+                        help="总带宽上限 (字节/秒)，如 50M、1.5G")
+    parser.add_argument('--config', metavar='PATH',
+                        help="可选的 JSON 配置文件，提供子集、后处理、Zarr 等高级配置；命令行参数优先")
+    if command == 'download':
+        parser.add_argument('--dry-run', action='store_true', help="只列出要下载的文件和大小，不下载")
+        parser.add_argument('--priority', type=int, default=0,
+                            help="任务优先级，大于 0 为紧急任务，优先于后台补档 (默认 0)")
+        parser.add_argument('--deadline', metavar='TIME',
+                            help="截止时间，如 2025-03-01 或 '2025-03-01 18:00'，临近时提到最前")
+        parser.add_argument('--submit', action='store_true',
+                            help="不自己下载，把任务提交给同一保存目录下正在运行的任务，由其抢占调度")
+        parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                            help="在本机该端口提供 /metrics (Prometheus) 和 /progress (JSON) 进度端点")
+        parser.add_argument('--profile', action='store_true',
+                            help="开启性能剖析，结束时在保存根目录写出折叠栈 (火焰图) 和分段汇总")
+    else:
+        parser.add_argument('--refresh', action='store_true', help="忽略列举缓存，重新列举")
+        parser.add_argument('--metrics-db', default=METRICS_DB, metavar='PATH',
+                            help=f"性能监控数据库，用于估算吞吐 (默认 {METRICS_DB})")
+    parser.add_argument('--json', action='store_true',
+                        help="在标准输出逐行输出 JSON 事件和最终汇总，日志改写到标准错误")
+    return parser
+
+
+def parse_job_args(command, argv):
+    """解析 download/plan 的命令行参数，返回 (args, config)"""
+    parser = build_arg_parser(command)
+    args = parser.parse_args(argv)
+    try:
+        months = parse_months(args.dates)
+        if args.max_rate:
+            parse_size(args.max_rate)
+        if getattr(args, 'deadline', None):
+            parse_deadline(args.deadline)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.threads < 1:
+        parser.error("--threads 至少为 1")
+
+    config = read_config_file(args.config) if args.config else {}
+    config.update({
+        'date': months[0],
+        'months': months,
+        'selected_vars': [v for item in args.vars for v in item.split(',') if v],
+        'dataset': args.dataset,
+        'local_root': args.output,
+        'thread_count': args.threads,
+    })
+    if args.max_rate:
+        config['max_rate'] = args.max_rate
+    if getattr(args, 'metrics_port', None):
+        config['metrics_port'] = args.metrics_port
+    if getattr(args, 'profile', False):
+        config['profile'] = True
+    if getattr(args, 'priority', 0) or getattr(args, 'deadline', None):
+        config['priorities'] = list(config.get('priorities') or ()) + [
+            {'months': months, 'vars': config['selected_vars'], 'priority': args.priority,
+             'deadline': args.deadline}]
+    return args, config
+
+
+def print_plan(plan):
+    """以表格输出下载计划"""
+    gb = 1073741824
+    print(f"{'月份':<8}{'变量':<8}{'文件':>6}{'已有':>6}{'待传':>6}{'总量(GB)':>11}{'待传(GB)':>11}")
+    for m in plan['months']:
+        for var, v in sorted(m['vars'].items()):
+            print(f"{m['month']:<10}{var:<10}{v['files']:>8}{v['done'] + v['linked']:>8}"
+                  f"{v['transfer_files']:>8}{v['bytes'] / gb:>13.2f}{v['transfer_bytes'] / gb:>13.2f}")
+        if not m['vars']:
+            print(f"{m['month']:<10}(未找到文件)")
+    print(f"合计: {plan['files']} 个文件 {plan['bytes'] / gb:.1f} GB，"
+          f"需传输 {plan['transfer_files']} 个 {plan['transfer_bytes'] / gb:.1f} GB")
+    if plan['throughput'] is None:
+        print("预计耗时: 没有历史吞吐数据，无法估算 (可用 --max-rate 按带宽上限估算)")
+    else:
+        basis = (f"历史吞吐中位数，{plan['throughput_samples']} 个样本" if plan['throughput_source'] == 'metrics'
+                 else "带宽上限")
+        print(f"预计耗时: {format_duration(plan['eta_seconds'])} "
+              f"(按 {plan['throughput'] / 1048576:.1f} MB/s，{basis})")
+
+
+def run_cli(argv):
+    """命令行下载入口，返回退出码：0 全部完成，1 有文件失败，2 参数或运行错误"""
+    args, config = parse_job_args('download', argv)
+    config['dry_run'] = args.dry_run
+    if args.submit:
+        path = submit_job(config['local_root'], config['months'], config['selected_vars'],
+                          args.priority, args.deadline)
+        if args.json:
+            print(json.dumps({'event': 'submitted', 'path': path}, ensure_ascii=False))
+        else:
+            print(f"[调度] 任务已提交: {path}")
+        return 0
+
+    out = sys.stdout
+    out_lock = threading.Lock()
+
+    def emit(event):
+        with out_lock:
+            out.write(json.dumps(event, ensure_ascii=False) + "\n")
+            out.flush()
+
+    downloader = AutoDownloader()
+    if args.json:
+        downloader.on_event = emit
+    # JSON 模式下标准输出只留给事件，其余输出改写到标准错误
+    with contextlib.redirect_stdout(sys.stderr) if args.json else contextlib.nullcontext():
+        ok = downloader.run(config)
+
+    results = downloader.results
+    failed = sum(r['failed'] for r in results)
+    if args.json:
+        emit({'event': 'summary', 'ok': ok, 'dry_run': args.dry_run, 'months': len(results),
+              'files': sum(r['files'] for r in results), 'bytes': sum(r['bytes'] for r in results),
+              'pending': sum(r['pending'] for r in results),
+              'pending_bytes': sum(r['pending_bytes'] for r in results),
+              'completed': sum(r['completed'] for r in results), 'failed': failed,
+              'seconds': round(sum(r['seconds'] for r in results), 1)})
+    if not ok:
+        return 2
+    return 1 if failed else 0
+
+
+def run_plan_cli(argv):
+    """命令行估算入口，返回退出码：0 成功，2 参数或运行错误"""
+    args, config = parse_job_args('plan', argv)
+    config['metrics_db'] = args.metrics_db
+    try:
+        with contextlib.redirect_stdout(sys.stderr) if args.json else contextlib.nullcontext():
+            plan = AutoDownloader().plan(config, refresh=args.refresh)
+    except Exception as e:
+        print(f"[错误] 估算失败: {e}", file=sys.stderr)
+        return 2
+    if args.json:
+        print(json.dumps(dict(event='plan', **plan), ensure_ascii=False))
+    else:
+        print_plan(plan)
+    return 0
+
+
+def _get_arg(name, default=None):
+    """读取形如 --name value 的命令行参数"""
+    if name in sys.argv:
+        idx = sys.argv.index(name)
+        if idx + 1 < len(sys.argv):
+            return sys.argv[idx + 1]
+    return default
+
+
+# ================= 主程序入口 =================
+def main():
+    """处理无界面的运行模式并返回退出码；没有指定这些模式时返回 None，由调用方启动图形界面"""
+    # 检查命令行参数
+    auto_mode = '--auto' in sys.argv or '-a' in sys.argv
+    queue_path = _get_arg('--queue')
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'download':
+        # 命令行任务：全部参数由命令行给出
+        return run_cli(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'plan':
+        # 估算任务的文件数、字节数和耗时
+        return run_plan_cli(sys.argv[2:])
+    elif '--cache-server' in sys.argv:
+        # 局域网读缓存代理
+        run_cache_server(_get_arg('--cache-server'), parse_size(_get_arg('--cache-size', '500G')),
+                         host=_get_arg('--bind', '0.0.0.0'), port=int(_get_arg('--port', CACHE_PORT)),
+                         endpoint_url=_get_arg('--upstream'))
+        return 0
+    elif '--store-status' in sys.argv:
+        # 查看内容寻址存储的占用和去重情况
+        print_store_status(ContentStore(_get_arg('--store-status')))
+        return 0
+    elif '--store-gc' in sys.argv:
+        # 删除已无目录引用的存储对象
+        ContentStore(_get_arg('--store-gc')).gc()
+        return 0
+    elif '--audit' in sys.argv:
+        # 批量校验已下载文件的结构
+        workers = _get_arg('--workers')
+        ok, bad = audit_directory(_get_arg('--audit'), max_workers=int(workers) if workers else None)
+        return 0 if bad == 0 else 1
+    elif '--queue-status' in sys.argv:
+        # 查看共享队列的合并进度
+        print_queue_status(WorkQueue(_get_arg('--queue-status')))
+        return 0
+    elif '--daemon' in sys.argv:
+        # 常驻同步模式：周期检查并下载新发布的数据
+        downloader = AutoDownloader()
+        success = downloader.run_daemon(interval=int(_get_arg('--interval', 3600)))
+        return 0 if success else 1
+    elif auto_mode and queue_path:
+        # 多节点模式：从共享队列领取文件
+        downloader = AutoDownloader()
+        success = downloader.run_queue(queue_path, node_id=_get_arg('--node-id'))
+        return 0 if success else 1
+    elif auto_mode:
+        # 自动模式：配置文件存在则直接下载
+        print("=" * 60)
+        print("ERA5 自动下载模式")
+        print("=" * 60)
+        downloader = AutoDownloader()
+        success = downloader.run()
+        if success:
+            print("[完成] 下载任务完成")
+            return 0
+        print("[失败] 配置文件不存在，请先运行GUI模式创建配置")
+        return 1
+    return None
+
+
+if __name__ == "__main__":
+    # 打包后的程序使用进程池需要
+    multiprocessing.freeze_support()
+    code = main()
+    if code is None:
+        # 没有指定无界面模式时启动图形界面
+        from era5.gui import ERA5ResumeDownloadApp
+        ERA5ResumeDownloadApp().mainloop()
+        code = 0
+    sys.exit(code)
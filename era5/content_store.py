@@ -0,0 +1,199 @@
+"""按 ETag 去重的内容寻址存储"""
+import os
+import time
+import shutil
+import sqlite3
+
+
+# ================= 内容寻址存储 =================
+STORE_MANIFEST = "manifest.db"
+_FICLONE = 0x40049409  # Linux ioctl，btrfs/xfs 等文件系统的写时复制克隆
+
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+
+
+def link_file(src, dst, allow_copy=True):
+    """依次尝试硬链接、reflink、复制，把 src 放到 dst，返回所用方式；都不可行时返回 None"""
+    try:
+        os.link(src, dst)
+        return 'hardlink'
+    except FileExistsError:
+        raise
+    except OSError:
+        pass
+    try:
+        _reflink(src, dst)
+        return 'reflink'
+    except (ImportError, OSError):
+        if os.path.exists(dst):
+            os.remove(dst)
+    if not allow_copy:
+        return None
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+
+def create_content_store(config):
+    """按配置中的 content_store 创建内容寻址存储，未配置时返回 None"""
+    root = config.get('content_store') if config else None
+    return ContentStore(root) if root else None
+
+
+class ContentStore:
+    """按 ETag 存放文件的共享目录，各 local_root 下的文件是指向它的硬链接
+
+    objects/<ETag 前两位>/<ETag> 保存唯一一份数据，manifest.db 记录每个对象被哪些路径引用。
+    下载前先查存储，命中时只需建立链接；新下载的文件随后放入存储。
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        self.db_path = os.path.join(root, STORE_MANIFEST)
+        self._warned = False
+        conn = self._connect()
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS objects (
+                    etag TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    key TEXT NOT NULL,
+                    created REAL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS refs (
+                    path TEXT PRIMARY KEY,
+                    etag TEXT NOT NULL,
+                    method TEXT NOT NULL,
+                    updated REAL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_refs_etag ON refs(etag)')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=60)
+
+    def object_path(self, etag):
+        return os.path.join(self.root, 'objects', etag[:2], etag)
+
+    def _add_ref(self, f_info, local_path, method):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('INSERT OR IGNORE INTO objects (etag, size, key, created) VALUES (?, ?, ?, ?)',
+                         (f_info['ETag'], f_info['Size'], f_info['Key'], now))
+            conn.execute('INSERT OR REPLACE INTO refs (path, etag, method, updated) VALUES (?, ?, ?, ?)',
+                         (os.path.abspath(local_path), f_info['ETag'], method, now))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def has(self, f_info):
+        """存储中是否已有该文件(ETag 和大小一致)"""
+        if not f_info.get('ETag'):
+            return False
+        try:
+            return os.path.getsize(self.object_path(f_info['ETag'])) == f_info['Size']
+        except OSError:
+            return False
+
+    def same_device(self, path):
+        """path 与存储是否在同一设备上；不在时链接会退回复制，命中存储也要占用完整空间"""
+        try:
+            return os.stat(path).st_dev == os.stat(self.root).st_dev
+        except OSError:
+            return False
+
+    def link_into(self, f_info, local_path):
+        """存储中已有该对象时链接到 local_path (替换已有文件)，返回所用方式；没有则返回 None"""
+        if not self.has(f_info):
+            return None
+        obj = self.object_path(f_info['ETag'])
+        tmp = local_path + ".link"
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        method = link_file(obj, tmp)
+        os.replace(tmp, local_path)
+        self._add_ref(f_info, local_path, method)
+        return method
+
+    def adopt(self, local_path, f_info):
+        """把新下载的文件放入存储；其他进程已放入同一对象时改为链接到它，去掉重复副本"""
+        if not f_info.get('ETag'):
+            return None
+        obj = self.object_path(f_info['ETag'])
+        if os.path.exists(obj):
+            return self.link_into(f_info, local_path)
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        try:
+            method = link_file(local_path, obj, allow_copy=False)
+        except FileExistsError:
+            return self.link_into(f_info, local_path)
+        if method is None:
+            if not self._warned:
+                self._warned = True
+                print(f"[存储] {self.root} 与下载目录不在同一文件系统，无法建立链接，新文件不放入存储")
+            return None
+        self._add_ref(f_info, local_path, method)
+        return method
+
+    def _is_live(self, path, etag, method):
+        try:
+            if method == 'hardlink':
+                return os.path.samefile(path, self.object_path(etag))
+            return os.path.exists(path)
+        except OSError:
+            return False
+
+    def gc(self):
+        """清理已失效的引用，删除无人引用的对象，返回 (删除对象数, 释放字节)"""
+        conn = self._connect()
+        try:
+            refs = conn.execute('SELECT path, etag, method FROM refs').fetchall()
+            dead = [(path,) for path, etag, method in refs if not self._is_live(path, etag, method)]
+            conn.executemany('DELETE FROM refs WHERE path = ?', dead)
+            orphans = conn.execute('''
+                SELECT etag, size FROM objects WHERE etag NOT IN (SELECT etag FROM refs)
+            ''').fetchall()
+            freed = 0
+            for etag, size in orphans:
+                try:
+                    os.remove(self.object_path(etag))
+                    freed += size
+                except FileNotFoundError:
+                    pass
+            conn.executemany('DELETE FROM objects WHERE etag = ?', [(etag,) for etag, _ in orphans])
+            conn.commit()
+        finally:
+            conn.close()
+        print(f"[存储] 清理失效引用 {len(dead)} 个，删除对象 {len(orphans)} 个，释放 {freed / 1073741824:.2f} GB")
+        return len(orphans), freed
+
+    def status(self):
+        """返回 (对象数, 实际占用字节, 引用数, 各目录合计字节)"""
+        conn = self._connect()
+        try:
+            objects, physical = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects').fetchone()
+            refs, logical = conn.execute('''
+                SELECT COUNT(*), COALESCE(SUM(o.size), 0) FROM refs r JOIN objects o ON o.etag = r.etag
+                WHERE r.method = 'hardlink'
+            ''').fetchone()
+        finally:
+            conn.close()
+        return objects, physical, refs, logical
+
+
+def print_store_status(store):
+    objects, physical, refs, logical = store.status()
+    print(f"[存储] {store.root}")
+    print(f"  对象: {objects} 个, {physical / 1073741824:.2f} GB")
+    print(f"  硬链接引用: {refs} 个, 合计 {logical / 1073741824:.2f} GB")
+    print(f"  去重节省: {max(logical - physical, 0) / 1073741824:.2f} GB")
@@ -0,0 +1,1114 @@
+"""下载核心：S3 访问、分块写盘、重试、限速、多端点分流和磁盘空间规划"""
+import boto3
+from botocore import UNSIGNED
+from botocore.client import Config
+from botocore.exceptions import ClientError
+import os
+import sys
+import threading
+import time
+import errno
+import queue
+import random
+import re
+import json
+import shutil
+import socket
+from bisect import bisect_left
+from collections import deque
+
+from era5.progress import PROFILER
+
+
+# ================= 变量定义 =================
+ERA5_VARS = {
+    "动力与热力学": {
+        "t": "空气温度 (K)", "u": "U风分量 (m/s)", "v": "V风分量 (m/s)",
+        "w": "垂直速度 (Pa/s)", "z": "位势高度", "d": "散度", "vo": "相对涡度", "pv": "位涡"
+    },
+    "湿度与云物理": {
+        "q": "比湿", "r": "相对湿度", "cc": "云量", "ciwc": "云冰水含量",
+        "clwc": "云液水含量", "crwc": "雨水含量", "cswc": "雪水含量"
+    },
+    "化学成分": {
+        "o3": "臭氧"
+    }
+}
+
+# 配置文件路径
+CONFIG_FILE = ".era5_gui_config.json"
+# 默认数据集(存储桶中的前缀)：气压层分析场
+DEFAULT_DATASET = "e5.oper.an.pl"
+# 常驻同步模式的状态文件(保存在保存根目录下)
+SYNC_STATE_FILE = ".era5_sync_state.json"
+
+
+# ================= 自定义异常类 =================
+class DownloadStoppedException(Exception):
+    """下载被用户停止"""
+    pass
+
+
+class FileIncompleteException(Exception):
+    """文件下载不完整"""
+    pass
+
+
+class DiskFullException(Exception):
+    """磁盘空间或配额不足，重试没有意义"""
+    pass
+
+
+class FileCorruptException(FileIncompleteException):
+    """文件大小正确但结构损坏，需要删除后重新下载"""
+    pass
+
+
+# ================= 暂停与恢复 =================
+# 暂停后保持响应流的秒数：短暂停顿(如避开带宽高峰的几秒)恢复时不必重新请求
+DEFAULT_PAUSE_HOLD = 20
+
+
+class PauseGate:
+    """协作式暂停开关，所有下载线程共享
+
+    下载线程在开始新文件前和每写完一块后检查：暂停时把已写入的数据刷到磁盘，
+    然后等待恢复。不关闭客户端，连接池里的空闲连接在恢复后继续使用。
+    """
+
+    def __init__(self, hold=DEFAULT_PAUSE_HOLD):
+        self.hold = hold
+        self._running = threading.Event()
+        self._running.set()
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def wait(self, should_stop=None, timeout=None):
+        """暂停时阻塞到恢复，返回 True；超过 timeout 仍未恢复返回 False；期间请求停止则抛出"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._running.wait(0.5):
+            if should_stop is not None and should_stop():
+                raise DownloadStoppedException("用户停止下载")
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+        return True
+
+
+# ================= 传输阶段计时 =================
+# 直方图桶上界(毫秒)，最后一个桶收纳所有更大的值
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+# connect: TCP/TLS 建连; ttfb: 请求发出到响应头; body: 读取响应体; disk: 写入本地文件
+TRANSFER_PHASES = ("connect", "ttfb", "body", "disk")
+TRANSFER_STATS_FILE = ".era5_transfer_stats.json"
+
+# 当前线程正在进行的请求的建连耗时(秒)，由 _install_connect_timer 累加
+_phase_local = threading.local()
+
+
+def _install_connect_timer():
+    """给 botocore 的连接类包一层计时，建连耗时记入当前线程"""
+    from botocore.awsrequest import AWSHTTPConnection, AWSHTTPSConnection
+
+    for conn_cls in (AWSHTTPConnection, AWSHTTPSConnection):
+        if getattr(conn_cls.connect, '_era5_timed', False):
+            continue
+
+        def connect(self, _orig=conn_cls.connect):
+            t0 = time.perf_counter()
+            try:
+                return _orig(self)
+            finally:
+                _phase_local.connect = getattr(_phase_local, 'connect', 0.0) + time.perf_counter() - t0
+
+        connect._era5_timed = True
+        conn_cls.connect = connect
+
+
+class LatencyHistogram:
+    """固定分桶的耗时直方图(毫秒)"""
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def merge(self, other):
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.count += other.count
+        self.total_ms += other.total_ms
+        self.max_ms = max(self.max_ms, other.max_ms)
+
+    def percentile(self, q):
+        """按桶估算分位数，返回所在桶的上界(不超过观测到的最大值)"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank and c > 0:
+                return min(float(LATENCY_BUCKETS_MS[i]), self.max_ms) if i < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def to_dict(self):
+        return {
+            'buckets_ms': list(LATENCY_BUCKETS_MS) + ['inf'],
+            'counts': list(self.counts),
+            'count': self.count,
+            'total_ms': round(self.total_ms, 3),
+            'max_ms': round(self.max_ms, 3),
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+        }
+
+
+class TransferStats:
+    """按 变量 / 尝试次数 / 阶段 聚合的请求耗时统计(线程安全)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hists = {}  # {(var, attempt, phase): LatencyHistogram}
+
+    def record(self, var, attempt, timings):
+        """记录一次请求的各阶段耗时(秒)，每个请求只加一次锁"""
+        with self._lock:
+            for phase, seconds in timings.items():
+                key = (var, attempt, phase)
+                hist = self._hists.get(key)
+                if hist is None:
+                    hist = self._hists[key] = LatencyHistogram()
+                hist.observe(seconds * 1000.0)
+
+    def by_phase(self, var=None):
+        """按阶段合并直方图，可限定变量"""
+        merged = {phase: LatencyHistogram() for phase in TRANSFER_PHASES}
+        with self._lock:
+            for (v, _attempt, phase), hist in self._hists.items():
+                if var is None or v == var:
+                    merged[phase].merge(hist)
+        return merged
+
+    def snapshot(self):
+        """导出为 {变量: {尝试次数: {阶段: 直方图}}}"""
+        result = {}
+        with self._lock:
+            for (var, attempt, phase), hist in sorted(self._hists.items()):
+                result.setdefault(var, {}).setdefault(str(attempt), {})[phase] = hist.to_dict()
+        return result
+
+    def summary_lines(self):
+        """生成按阶段汇总的文本表格"""
+        merged = self.by_phase()
+        if not merged['ttfb'].count:
+            return []
+        lines = [f"{'阶段':<8}{'请求数':>8}{'P50(ms)':>10}{'P95(ms)':>10}{'最大(ms)':>10}{'累计(s)':>10}"]
+        for phase in TRANSFER_PHASES:
+            h = merged[phase]
+            lines.append(f"{phase:<8}{h.count:>8}{h.percentile(0.5):>10.0f}{h.percentile(0.95):>10.0f}"
+                         f"{h.max_ms:>10.0f}{h.total_ms / 1000:>10.1f}")
+        return lines
+
+    def save(self, target_dir):
+        """保存统计到下载目录"""
+        try:
+            path = os.path.join(target_dir, TRANSFER_STATS_FILE)
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump({'generated': time.strftime('%Y-%m-%d %H:%M:%S'),
+                           'phases': list(TRANSFER_PHASES),
+                           'stats': self.snapshot()}, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            print(f"保存传输统计失败: {e}")
+
+
+_read_buffers = threading.local()
+
+
+def _read_buffer(size):
+    """返回当前线程复用的读缓冲区(memoryview)，大小不够时重新分配"""
+    view = getattr(_read_buffers, 'view', None)
+    if view is None or len(view) < size:
+        view = _read_buffers.view = memoryview(bytearray(size))
+    return view[:size]
+
+
+def _direct_reader(body):
+    """满足条件时返回 (urllib3 响应, http.client 响应, 内容长度)，否则返回 None
+
+    只有未压缩、非分块且带 Content-Length 的响应才能绕过 urllib3/botocore 直接 readinto；
+    其余情况(包括测试里的假对象)回退到 iter_chunks。
+    """
+    raw = getattr(body, '_raw_stream', None)
+    fp = getattr(raw, '_fp', None)
+    length = getattr(body, '_content_length', None)
+    if fp is None or length is None or not hasattr(fp, 'readinto') or getattr(fp, 'chunked', False):
+        return None
+    encoding = (getattr(raw, 'headers', None) or {}).get('content-encoding', 'identity')
+    if encoding.lower() != 'identity':
+        return None
+    return raw, fp, int(length)
+
+
+def iter_body(body, chunk_size):
+    """逐块产出响应体
+
+    能直接读取时把数据从连接 readinto 到线程复用的缓冲区，产出的 memoryview 只在下一次迭代前有效，
+    不再为每块新建 bytes；读完后自行核对 Content-Length，并把连接还给连接池。
+    """
+    reader = _direct_reader(body)
+    if reader is None:
+        yield from body.iter_chunks(chunk_size=chunk_size)
+        return
+    raw, fp, expected = reader
+    view = _read_buffer(chunk_size)
+    received = 0
+    while True:
+        n = fp.readinto(view)
+        if not n:
+            break
+        received += n
+        yield view[:n]
+    if received != expected:
+        raise FileIncompleteException(f"响应提前结束: 收到 {received} / {expected} 字节")
+    # 直接读底层响应时 urllib3 不知道已经读完，需要手动归还连接，否则 close 会断开它
+    raw.release_conn()
+
+
+def stream_object_to_file(s3_client, bucket, f_info, temp_path, start_byte, chunk_size,
+                          on_chunk=None, should_stop=None, stats=None, attempt=0, limiter=None, gate=None):
+    """从 start_byte 开始把 S3 对象写入临时文件，返回写入后的文件总字节数
+
+    各阶段耗时按请求汇总后记入 stats；on_chunk(n, downloaded) 在每块写入后调用；
+    给出 limiter (RateLimiter) 时按其速率限速。
+    给出 gate (PauseGate) 时在块边界响应暂停：先把已写入的数据刷到磁盘，在保持时间内恢复则
+    沿用同一个连接继续读；暂停更久就释放这次请求，恢复后从检查点按 Range 续传。
+    响应体经 iter_body 读取，条件允许时直接读入复用缓冲区。
+    """
+    timings = dict.fromkeys(TRANSFER_PHASES, 0.0)
+
+    def request(offset):
+        get_params = {'Bucket': bucket, 'Key': f_info['Key']}
+        if offset > 0:
+            get_params['Range'] = f"bytes={offset}-"
+        _phase_local.connect = 0.0
+        t0 = time.perf_counter()
+        response = s3_client.get_object(**get_params)
+        timings['connect'] += _phase_local.connect
+        timings['ttfb'] += max(0.0, time.perf_counter() - t0 - _phase_local.connect)
+        return response['Body']
+
+    body = request(start_byte)
+    downloaded = start_byte
+    try:
+        # 写入文件(续传时追加)
+        with open(temp_path, 'ab' if start_byte > 0 else 'wb') as f:
+            while body is not None:
+                released = False
+                try:
+                    chunks = iter_body(body, chunk_size)
+                    while True:
+                        t_read = time.perf_counter()
+                        chunk = next(chunks, None)
+                        t_write = time.perf_counter()
+                        timings['body'] += t_write - t_read
+                        if chunk is None:
+                            break
+                        if should_stop is not None and should_stop():
+                            raise DownloadStoppedException("用户停止下载")
+
+                        f.write(chunk)
+                        t_callback = time.perf_counter()
+                        timings['disk'] += t_callback - t_write
+                        downloaded += len(chunk)
+                        if on_chunk is not None:
+                            on_chunk(len(chunk), downloaded)
+                        profiling = PROFILER.enabled
+                        t_throttle = time.perf_counter() if profiling else 0.0
+                        if limiter is not None:
+                            limiter.consume(len(chunk), should_stop)
+                        if profiling:
+                            PROFILER.record_chunk(t_write - t_read, t_callback - t_write, t_throttle - t_callback,
+                                                  time.perf_counter() - t_throttle)
+                        # 最后一块之后不再响应暂停：对象已经读完，再按 Range 续传只会得到 416
+                        if gate is not None and gate.paused and downloaded < f_info['Size']:
+                            f.flush()
+                            os.fsync(f.fileno())
+                            if not gate.wait(should_stop, timeout=gate.hold):
+                                released = True
+                                break
+                finally:
+                    body.close()
+                    body = None
+                if released:
+                    gate.wait(should_stop)
+                    body = request(downloaded)
+    except OSError as e:
+        if is_disk_full(e):
+            raise DiskFullException(f"磁盘空间或配额不足: {temp_path}") from e
+        raise
+    finally:
+        if stats is not None:
+            stats.record(f_info['Var'], attempt, timings)
+    return downloaded
+
+
+# ================= 连接预热与 DNS 缓存 =================
+DEFAULT_DNS_TTL = 300
+
+
+class DnsCache:
+    """带 TTL 的 DNS 缓存
+
+    同一主机的多个地址轮流排在首位，让连接池里的连接分散到不同的服务端 IP；
+    过期后重新解析失败时继续使用旧结果，避免 DNS 抖动直接变成下载失败。
+    getaddrinfo 不返回记录本身的 TTL，因此使用固定的缓存时长。
+    """
+
+    def __init__(self, ttl=DEFAULT_DNS_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # {(主机, 端口): [过期时间, 地址列表, 轮转计数]}
+
+    def resolve(self, host, port, pin=None):
+        """返回该主机的 (地址, 端口) 列表，每次调用换一个地址排在首位；指定 pin 时固定第 pin 个地址在首位"""
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[0] <= now:
+            try:
+                infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+                addrs = list(dict.fromkeys(info[4][:2] for info in infos))
+                with self._lock:
+                    entry = self._entries[key] = [now + self.ttl, addrs, entry[2] if entry else 0]
+            except socket.gaierror:
+                if entry is None:
+                    raise
+                print(f"[DNS] 解析 {host} 失败，继续使用缓存的 {len(entry[1])} 个地址")
+                with self._lock:
+                    entry[0] = now + min(self.ttl, 30)
+        with self._lock:
+            addrs = entry[1]
+            if pin is None:
+                start = entry[2] % len(addrs)
+                entry[2] += 1
+            else:
+                start = pin % len(addrs)
+        return addrs[start:] + addrs[:start]
+
+
+_dns_cache = DnsCache()
+
+
+def _install_dns_cache(ttl=DEFAULT_DNS_TTL):
+    """让 urllib3 建连时经过 DNS 缓存，并依次尝试主机的各个地址"""
+    from urllib3.util import connection
+
+    _dns_cache.ttl = ttl
+    if getattr(connection.create_connection, '_era5_cached', False):
+        return
+    _orig = connection.create_connection
+
+    def create_connection(address, *args, **kwargs):
+        host, port = address
+        try:
+            candidates = _dns_cache.resolve(host, port, getattr(_dns_pin, 'index', None))
+        except socket.gaierror:
+            return _orig(address, *args, **kwargs)
+        last_error = None
+        for addr in candidates:
+            try:
+                return _orig(addr, *args, **kwargs)
+            except OSError as e:
+                last_error = e
+        raise last_error
+
+    create_connection._era5_cached = True
+    connection.create_connection = create_connection
+
+
+def warm_up_connections(s3_client, bucket, count, prefix="e5.oper.an.pl/"):
+    """并发发出 count 个轻量请求，让连接池提前建好连接，返回 (成功数, 耗时秒)"""
+    barrier = threading.Barrier(count)
+    ok = 0
+    lock = threading.Lock()
+
+    def ping():
+        nonlocal ok
+        try:
+            barrier.wait(timeout=10)
+        except threading.BrokenBarrierError:
+            pass
+        try:
+            s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix, MaxKeys=1)
+            with lock:
+                ok += 1
+        except Exception:
+            pass
+
+    t0 = time.time()
+    threads = [threading.Thread(target=ping, daemon=True) for _ in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return ok, time.time() - t0
+
+
+# ================= 重试策略 =================
+RETRY_THROTTLE = "throttle"    # 服务端限流 (503 SlowDown / 429)，退避更久
+RETRY_TRANSIENT = "transient"  # 网络中断、超时、5xx，可以重试
+RETRY_FATAL = "fatal"          # 404/403、本地磁盘错误等，重试无意义
+
+THROTTLE_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                  'TooManyRequests', 'ServiceUnavailable'}
+# 写本地文件时出现这些错误说明是本地问题，不是网络问题
+LOCAL_FATAL_ERRNOS = {errno.EACCES, errno.EPERM, errno.EROFS, errno.ENOTDIR, errno.EISDIR, errno.ENAMETOOLONG}
+
+DEFAULT_FILE_ATTEMPTS = 4        # 每个文件最多完整尝试几轮(首轮 + 队尾补下)
+DEFAULT_MIN_RETRY_BUDGET = 20    # 一次运行的全局重试预算下限
+DEFAULT_REQUEUE_DELAY = 30       # 开始补下失败文件前等待的秒数
+
+
+def classify_error(e):
+    """把下载异常分为 限流 / 临时 / 致命 三类"""
+    if isinstance(e, (DownloadStoppedException, DiskFullException)):
+        return RETRY_FATAL
+    if isinstance(e, ClientError):
+        code = e.response.get('Error', {}).get('Code', '')
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        if code in THROTTLE_CODES or status in (429, 503):
+            return RETRY_THROTTLE
+        if status >= 500 or code in ('RequestTimeout', 'InternalError'):
+            return RETRY_TRANSIENT
+        return RETRY_FATAL
+    if isinstance(e, OSError):
+        return RETRY_FATAL if is_disk_full(e) or e.errno in LOCAL_FATAL_ERRNOS else RETRY_TRANSIENT
+    # botocore 的连接/读取超时、流中断以及文件不完整都按临时错误处理
+    return RETRY_TRANSIENT
+
+
+class CircuitBreaker:
+    """全局熔断：最近一段时间内请求错误率过高时，所有线程暂停发起新请求
+
+    冷却结束后放行请求重新统计；刚恢复又很快熔断时冷却时间加倍。
+    """
+
+    def __init__(self, window=30.0, min_requests=10, threshold=0.5, cooldown=15.0, max_cooldown=240.0):
+        self.window = window
+        self.min_requests = min_requests
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._events = deque()  # (时间, 是否成功)
+        self._errors = 0
+        self.open_until = 0.0
+        self.trips = 0
+
+    def record(self, ok):
+        now = time.monotonic()
+        with self._lock:
+            self._events.append((now, ok))
+            if not ok:
+                self._errors += 1
+            while self._events and self._events[0][0] < now - self.window:
+                if not self._events.popleft()[1]:
+                    self._errors -= 1
+            if ok and self.open_until and now > self.open_until + self.window:
+                # 恢复后稳定了一个窗口，冷却时间复位
+                self.cooldown = self.base_cooldown
+                self.open_until = 0.0
+            if (now >= self.open_until and len(self._events) >= self.min_requests
+                    and self._errors / len(self._events) >= self.threshold):
+                if self.open_until and now < self.open_until + self.window:
+                    self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                rate = self._errors / len(self._events)
+                self.open_until = now + self.cooldown
+                self.trips += 1
+                self._events.clear()
+                self._errors = 0
+                print(f"[熔断] 最近 {self.window:.0f} 秒错误率 {rate:.0%}，暂停新请求 {self.cooldown:.0f} 秒")
+
+    def wait(self, should_stop=None):
+        """熔断期间阻塞，直到冷却结束或收到停止请求"""
+        while True:
+            with self._lock:
+                remaining = self.open_until - time.monotonic()
+            if remaining <= 0:
+                return
+            if should_stop is not None and should_stop():
+                raise DownloadStoppedException("用户停止下载")
+            time.sleep(min(remaining, 0.5))
+
+
+class RetryPolicy:
+    """所有下载线程共享的重试策略
+
+    致命错误直接抛出；其余错误按 decorrelated jitter 退避 (sleep = rand(base, 上次 × 3)，不超过 cap)，
+    限流错误的基数更大。每次请求的成败都记入熔断器。
+    """
+
+    def __init__(self, max_attempts=6, base=2.0, cap=60.0, throttle_base=5.0, breaker=None):
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+        self.throttle_base = throttle_base
+        self.breaker = breaker or CircuitBreaker()
+        self.budget = None  # 每次运行开始时设置为该次运行的 RetryBudget
+
+    def next_delay(self, previous, kind):
+        base = self.throttle_base if kind == RETRY_THROTTLE else self.base
+        return min(self.cap, random.uniform(base, max(base, previous * 3)))
+
+    def run(self, attempt_fn, should_stop=None, on_retry=None):
+        """执行 attempt_fn(第几次尝试)，失败时按策略等待后重试
+
+        on_retry(attempt, kind, delay, error) 在每次等待前调用，用于显示状态。
+        """
+        delay = 0.0
+        attempt = 0
+        while True:
+            self.breaker.wait(should_stop)
+            try:
+                result = attempt_fn(attempt)
+                self.breaker.record(True)
+                return result
+            except DownloadStoppedException:
+                raise
+            except Exception as e:
+                kind = classify_error(e)
+                if kind != RETRY_FATAL:
+                    self.breaker.record(False)
+                if kind == RETRY_FATAL or attempt + 1 >= self.max_attempts:
+                    raise
+                if self.budget is not None and not self.budget.try_spend():
+                    raise
+                delay = self.next_delay(delay, kind)
+                if on_retry is not None:
+                    on_retry(attempt, kind, delay, e)
+                deadline = time.monotonic() + delay
+                while time.monotonic() < deadline:
+                    if should_stop is not None and should_stop():
+                        raise DownloadStoppedException("用户停止下载")
+                    time.sleep(min(0.5, deadline - time.monotonic()))
+                attempt += 1
+
+
+class RetryBudget:
+    """一次运行内所有重试共用的预算：请求级重试和整文件重新排队都从这里扣
+
+    大面积故障时预算很快用完，剩余失败直接上报，不会无休止地重试放大负载。
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def try_spend(self, n=1):
+        with self.lock:
+            if self.used + n > self.total:
+                return False
+            self.used += n
+            return True
+
+    @property
+    def remaining(self):
+        with self.lock:
+            return self.total - self.used
+
+    def grow_to(self, total):
+        """边列举边下载时文件数逐渐增加，预算随之放大"""
+        with self.lock:
+            self.total = max(self.total, total)
+
+
+def default_retry_budget(config, file_count):
+    """配置 retry_budget 优先，否则平均每个文件一次重试，至少 20 次"""
+    return RetryBudget(int(config.get('retry_budget', max(DEFAULT_MIN_RETRY_BUDGET, file_count))))
+
+
+class RequeueTracker:
+    """记录每个文件的尝试次数和最后一次错误，决定失败的文件是否排到队尾再试
+
+    非致命错误、尝试次数未到上限且全局预算还有余量时重新排队；
+    最终仍失败的文件生成报告写入进度文件。
+    """
+
+    def __init__(self, max_attempts=DEFAULT_FILE_ATTEMPTS, budget=None):
+        self.max_attempts = max_attempts
+        self.budget = budget
+        self.attempts = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def started(self, name):
+        with self.lock:
+            self.attempts[name] = self.attempts.get(name, 0) + 1
+
+    def failed(self, name, error):
+        """记录一次失败，返回是否应重新排队"""
+        kind = classify_error(error)
+        with self.lock:
+            attempts = self.attempts.get(name, 1)
+            self.errors[name] = {'attempts': attempts, 'kind': kind,
+                                 'error': f"{type(error).__name__}: {error}",
+                                 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+        if kind == RETRY_FATAL or attempts >= self.max_attempts:
+            return False
+        return self.budget is None or self.budget.try_spend()
+
+    def skipped(self, name, reason):
+        """未尝试就放弃的文件(如磁盘空间不足、停止时仍在排队)也写入报告，已有错误记录时保留原记录"""
+        with self.lock:
+            self.errors.setdefault(name, {'attempts': self.attempts.get(name, 0), 'kind': RETRY_FATAL,
+                                          'error': reason, 'time': time.strftime('%Y-%m-%d %H:%M:%S')})
+
+    def succeeded(self, name):
+        with self.lock:
+            self.errors.pop(name, None)
+
+    def report(self):
+        """最终失败文件的报告 {文件名: {attempts, kind, error, time}}"""
+        with self.lock:
+            return dict(self.errors)
+
+
+def wait_requeue_delay(seconds, should_stop):
+    """两轮补下之间等待一会儿，让短时故障恢复；可被停止请求打断"""
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        if should_stop():
+            return False
+        time.sleep(min(0.5, max(0.0, deadline - time.monotonic())))
+    return not should_stop()
+
+
+def store_failure_report(progress_data, report):
+    """把失败报告写进进度数据的 failed 字段，没有失败时删除该字段"""
+    if report:
+        progress_data['failed'] = report
+    else:
+        progress_data.pop('failed', None)
+    return progress_data
+
+
+# ================= 带宽限制 =================
+class RateLimiter:
+    """令牌桶限速，所有下载线程共享一个桶；rate 为字节/秒，允许约 1 秒的突发
+
+    令牌可以透支：取走一块数据后桶内为负时，调用方睡到补回为止，
+    多个线程的透支依次累积，总速率不会超过 rate。
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n, should_stop=None):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline:
+            if should_stop is not None and should_stop():
+                raise DownloadStoppedException("用户停止下载")
+            time.sleep(min(0.5, max(0.0, deadline - time.monotonic())))
+
+
+def create_rate_limiter(config):
+    """按配置中的 max_rate (如 "50M"，字节/秒) 创建限速器，未配置时返回 None"""
+    rate = config.get('max_rate') if config else None
+    if not rate:
+        return None
+    return RateLimiter(parse_size(rate))
+
+
+# ================= 多端点分流 =================
+# 当前线程发起的请求应优先连接的地址序号，由 EndpointStriper 设置
+_dns_pin = threading.local()
+
+
+class EndpointLane:
+    """一条分流通道：独立的客户端(连接池)，固定连接主机的某个 IP 或某个镜像端点"""
+
+    def __init__(self, name, client, ip_index=None):
+        self.name = name
+        self.client = client
+        self.ip_index = ip_index
+        self.goodput = None  # 有效吞吐的 EWMA (字节/秒)
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.consecutive_errors = 0
+        self.cooldown_until = 0.0
+
+
+class EndpointStriper:
+    """把下载分散到桶主机的多个 A 记录(及可选镜像端点)，按各通道的健康状况和有效吞吐加权
+
+    每条通道一个客户端，通道内新建的连接固定到同一个 IP；连续失败的通道暂停一段时间，
+    尚无测量的通道按当前最好的通道估计，保证会被试用。
+    """
+    EWMA_ALPHA = 0.3
+    FAIL_THRESHOLD = 3
+    COOLDOWN_SECONDS = 60
+    MIN_SAMPLE_BYTES = 1024 * 1024
+
+    def __init__(self, max_workers, ips=4, mirrors=(), dns_ttl=DEFAULT_DNS_TTL):
+        self._lock = threading.Lock()
+        self.lanes = [EndpointLane(f"IP#{i}", create_s3_client(max_workers, None, dns_ttl, lane=i), ip_index=i)
+                      for i in range(ips)]
+        self.lanes += [EndpointLane(url, create_s3_client(max_workers, url, dns_ttl)) for url in mirrors]
+
+    def pick(self):
+        now = time.monotonic()
+        with self._lock:
+            healthy = [lane for lane in self.lanes if lane.cooldown_until <= now] or self.lanes
+            known = [lane.goodput for lane in healthy if lane.goodput]
+            prior = max(known) if known else 1.0
+            return random.choices(healthy, weights=[lane.goodput or prior for lane in healthy])[0]
+
+    def record(self, lane, nbytes, seconds, failed=False):
+        with self._lock:
+            lane.requests += 1
+            if failed:
+                lane.errors += 1
+                lane.consecutive_errors += 1
+                if lane.consecutive_errors >= self.FAIL_THRESHOLD:
+                    lane.cooldown_until = time.monotonic() + self.COOLDOWN_SECONDS
+                    lane.consecutive_errors = 0
+                    print(f"[分流] {lane.name} 连续失败，暂停 {self.COOLDOWN_SECONDS} 秒")
+                return
+            lane.consecutive_errors = 0
+            lane.bytes += nbytes
+            if nbytes >= self.MIN_SAMPLE_BYTES and seconds > 0:
+                rate = nbytes / seconds
+                lane.goodput = rate if lane.goodput is None else \
+                    self.EWMA_ALPHA * rate + (1 - self.EWMA_ALPHA) * lane.goodput
+
+    def run(self, fetch):
+        """在选中的通道上执行 fetch(client)，fetch 返回本次传输的字节数"""
+        lane = self.pick()
+        _dns_pin.index = lane.ip_index
+        t0 = time.monotonic()
+        try:
+            nbytes = fetch(lane.client)
+        except (DownloadStoppedException, DiskFullException):
+            raise
+        except ClientError as e:
+            # 4xx 与通道无关，只有服务端错误计入通道健康
+            if e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500:
+                self.record(lane, 0, 0, failed=True)
+            raise
+        except Exception:
+            self.record(lane, 0, 0, failed=True)
+            raise
+        finally:
+            _dns_pin.index = None
+        self.record(lane, nbytes, time.monotonic() - t0)
+        return nbytes
+
+    def summary_lines(self):
+        with self._lock:
+            return [f"{lane.name:<28}请求 {lane.requests:>5}  失败 {lane.errors:>4}  "
+                    f"{lane.bytes / 1073741824:>7.2f} GB  "
+                    f"{(lane.goodput or 0) / 1048576:>6.1f} MB/s" for lane in self.lanes if lane.requests]
+
+
+def create_striper(config, max_workers):
+    """按配置中的 stripe 创建多端点分流器，未配置时返回 None"""
+    stripe = config.get('stripe') if config else None
+    if not stripe:
+        return None
+    if stripe is True:
+        stripe = {}
+    return EndpointStriper(max_workers, ips=stripe.get('ips', 4), mirrors=stripe.get('mirrors', []),
+                           dns_ttl=config.get('dns_ttl', DEFAULT_DNS_TTL))
+
+
+# ================= 配置文件 =================
+def read_config_file(path=CONFIG_FILE):
+    """读取配置文件，不存在或损坏时返回空字典"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+# ================= 磁盘空间规划 =================
+DISK_FULL_ERRNOS = {errno.ENOSPC} | ({errno.EDQUOT} if hasattr(errno, 'EDQUOT') else set())
+DISK_FULL_WINERRORS = {39, 112}  # ERROR_HANDLE_DISK_FULL, ERROR_DISK_FULL
+DEFAULT_DISK_RESERVE = "1G"
+
+
+def is_disk_full(e):
+    """判断 OSError 是否为磁盘满或超出配额"""
+    return isinstance(e, OSError) and (e.errno in DISK_FULL_ERRNOS
+                                       or getattr(e, 'winerror', None) in DISK_FULL_WINERRORS)
+
+
+class DiskPlanner:
+    """按目标磁盘的剩余空间逐个决定文件能否在本轮下载
+
+    每个文件还需的空间 = 大小 - 已有 .tmp 的字节数；已下载完整的文件不占新空间，
+    共享存储中已有的文件只有与目标目录在同一设备(可硬链接)时才不占新空间，否则会退回复制。
+    按到达顺序贪心接纳，边列举边下载时也能逐个判断。
+    用户配额不体现在剩余空间中，超出配额由写入时的 EDQUOT 处理。
+    """
+
+    def __init__(self, target_dir, reserve=0, store=None):
+        self.target_dir = target_dir
+        self.store = store if store is not None and store.same_device(target_dir) else None
+        self.free = shutil.disk_usage(target_dir).free - reserve
+        self.total_need = 0
+        self.used = 0
+
+    def admit(self, f):
+        """文件放得下时计入已用空间并返回 True"""
+        local_path = os.path.join(self.target_dir, f['Name'])
+        temp_path = local_path + ".tmp"
+        need = f['Size']
+        if os.path.exists(local_path) and os.path.getsize(local_path) == f['Size']:
+            need = 0
+        elif os.path.exists(temp_path):
+            need -= min(os.path.getsize(temp_path), need)
+        elif self.store is not None and self.store.has(f):
+            need = 0
+        self.total_need += need
+        if self.used + need <= self.free:
+            self.used += need
+            return True
+        return False
+
+
+def plan_disk_space(files, target_dir, reserve=0, store=None):
+    """按目标磁盘的剩余空间挑选本轮放得下的文件，返回 (本轮下载, 推迟, 共需字节, 可用字节)"""
+    planner = DiskPlanner(target_dir, reserve, store)
+    selected, deferred = [], []
+    for f in files:
+        (selected if planner.admit(f) else deferred).append(f)
+    return selected, deferred, planner.total_need, planner.free
+
+
+def parse_size(text):
+    """解析 500G / 2T / 1048576 这样的容量写法"""
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    text = str(text).strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+# ================= S3 访问 =================
+# 已创建的客户端，同一进程内再次下载时复用其连接池
+_s3_clients = {}
+_s3_clients_lock = threading.Lock()
+
+
+def create_s3_client(max_workers, endpoint_url=None, dns_ttl=DEFAULT_DNS_TTL, lane=None):
+    """创建(或复用)匿名访问的 S3 客户端，连接池按并发数放大
+
+    endpoint_url 指向局域网缓存代理时按路径风格 (/桶/键) 访问。
+    同样参数的客户端在进程内只创建一次，池中仍存活的连接不必重新握手；
+    lane 用于给多端点分流的每条通道单独创建客户端。
+    """
+    key = (max_workers, endpoint_url, lane)
+    with _s3_clients_lock:
+        if key in _s3_clients:
+            return _s3_clients[key]
+    s3_config = Config(
+        signature_version=UNSIGNED,
+        max_pool_connections=max_workers * 2,  # 增加连接池大小
+        tcp_keepalive=True,  # 启用TCP keepalive保持连接活跃
+        connect_timeout=10,  # 连接超时10秒
+        read_timeout=30,  # 读取超时30秒
+        retries={'max_attempts': 2},  # 限制内部重试次数
+        s3={'addressing_style': 'path'} if endpoint_url else None
+    )
+    client = boto3.client('s3', config=s3_config, endpoint_url=endpoint_url)
+    _install_connect_timer()
+    _install_dns_cache(dns_ttl)
+    with _s3_clients_lock:
+        return _s3_clients.setdefault(key, client)
+
+
+# 文件名第 5 段最后一个下划线之后是变量代码，如 e5.oper.an.pl.128_130_t.ll025sc...nc -> t
+VAR_CODE_RE = re.compile(r'^(?:[^.]*\.){4}(?:[^.]*_)?([^._]*)')
+
+
+def parse_var_code(fname):
+    """从文件名中解析变量代码，如 e5.oper.an.pl.128_130_t.ll025sc...nc -> t"""
+    m = VAR_CODE_RE.match(fname)
+    return sys.intern(m.group(1)) if m else "unknown"
+
+
+# 对象键的目录前缀(数据集/月份/)，同一前缀的所有文件共享一个字符串
+_key_prefixes = {}
+
+
+class FileEntry:
+    """列举得到的一个待下载文件
+
+    多年全变量任务有几十万个文件，用 __slots__ 代替字典：键拆成共享的目录前缀和文件名，
+    变量代码驻留，内存比字典少约四成，创建也快一倍。仍支持 f_info['Name'] / f_info.get('ETag') 的写法。
+    """
+    __slots__ = ('prefix', 'name', 'size', 'var', 'etag')
+    _FIELDS = {'Key': 'key', 'Name': 'name', 'Size': 'size', 'Var': 'var', 'ETag': 'etag'}
+
+    def __init__(self, key, size, etag='', var=None):
+        cut = key.rfind('/') + 1
+        prefix = key[:cut]
+        self.prefix = _key_prefixes.setdefault(prefix, prefix)
+        self.name = key[cut:]
+        self.size = size
+        self.var = parse_var_code(self.name) if var is None else sys.intern(var)
+        self.etag = etag
+
+    @property
+    def key(self):
+        return self.prefix + self.name
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, self._FIELDS[field])
+        except KeyError:
+            raise KeyError(field) from None
+
+    def get(self, field, default=None):
+        attr = self._FIELDS.get(field)
+        return getattr(self, attr) if attr else default
+
+    def __contains__(self, field):
+        return field in self._FIELDS
+
+    def keys(self):
+        return self._FIELDS.keys()
+
+    def to_dict(self):
+        return {'Key': self.key, 'Size': self.size, 'Var': self.var, 'Name': self.name, 'ETag': self.etag}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['Key'], d['Size'], d.get('ETag', ''), d.get('Var'))
+
+    def __repr__(self):
+        return f"FileEntry({self.key!r}, {self.size})"
+
+
+def iter_month_files(s3_client, bucket, date_str, wanted_vars, dataset=DEFAULT_DATASET):
+    """逐页列举某月需要下载的文件，每取回一页就产出该页中的 FileEntry (按键名升序)"""
+    prefix = f"{dataset}/{date_str}/"
+    wanted = set(wanted_vars or ())
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            f_info = FileEntry(obj['Key'], obj['Size'], obj.get('ETag', '').strip('"'))
+            if not wanted or f_info.var in wanted:
+                yield f_info
+
+
+def list_month_files(s3_client, bucket, date_str, wanted_vars, dataset=DEFAULT_DATASET):
+    """列出某月需要下载的文件，返回 FileEntry 列表"""
+    return list(iter_month_files(s3_client, bucket, date_str, wanted_vars, dataset))
+
+
+def stream_tasks(items, fn, workers, should_stop, backlog=None, scheduler=None):
+    """有界生产者/消费者流水线：生产线程从 items (可以是边列举边产生的生成器) 取任务放入有界队列，
+    workers 个工作线程取出执行 fn(item)
+
+    按完成顺序逐个产出 (item, 异常或 None)，慢的早期任务不会挡住后面结果的处理；
+    队列最多积压 backlog 个任务，内存不随任务总数增长。items 本身出错(如列举失败)时，
+    等已领取的任务结束后抛出该异常。
+    给出 scheduler (PriorityScheduler) 时用它代替先进先出队列，任务按优先级出队。
+    """
+    backlog = backlog or workers * 2
+    tasks = queue.Queue(maxsize=backlog) if scheduler is None else scheduler
+    # 结束标记要排在所有任务之后
+    put_finished = tasks.put if scheduler is None else scheduler.put_last
+    results = queue.Queue()
+    finished = object()
+    source_error = []
+
+    def produce():
+        try:
+            for item in items:
+                while True:
+                    if should_stop():
+                        return
+                    try:
+                        tasks.put(item, timeout=0.5)
+                        break
+                    except queue.Full:
+                        pass
+        except Exception as e:
+            source_error.append(e)
+        finally:
+            for _ in range(workers):
+                put_finished(finished)
+
+    def work():
+        while True:
+            item = tasks.get()
+            if item is finished:
+                results.put(finished)
+                return
+            if should_stop():
+                results.put((item, DownloadStoppedException("用户停止下载")))
+                continue
+            try:
+                fn(item)
+                results.put((item, None))
+            except Exception as e:
+                results.put((item, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    for _ in range(workers):
+        threading.Thread(target=work, daemon=True).start()
+
+    running = workers
+    while running:
+        result = results.get()
+        if result is finished:
+            running -= 1
+        else:
+            yield result
+    if source_error:
+        raise source_error[0]
+
+
+def list_published_months(s3_client, bucket, dataset=DEFAULT_DATASET):
+    """列出存储桶中已发布的月份(YYYYMM)，按时间升序"""
+    paginator = s3_client.get_paginator('list_objects_v2')
+    months = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{dataset}/", Delimiter='/'):
+        for cp in page.get('CommonPrefixes', []):
+            month = cp['Prefix'].rstrip('/').rsplit('/', 1)[-1]
+            if len(month) == 6 and month.isdigit():
+                months.append(month)
+    return sorted(months)
@@ -1,8 +1,4 @@
 import customtkinter as ctk
-import boto3
-from botocore import UNSIGNED
-from botocore.client import Config
-from botocore.exceptions import ClientError, ConnectionError, EndpointConnectionError
 from boto3.s3.transfer import TransferConfig
 import os
 import sys
@@ -11,42 +7,31 @@ import time
 import queue
 import json
 import traceback
-from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
 from tkinter import filedialog, messagebox
 
+if __package__ in (None, ''):
+    # 直接运行 python era5/gui.py 时把项目根目录加入搜索路径，才能导入 era5 包
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from era5.progress import PROFILER, format_progress, ProgressTracker, start_metrics_server
+from era5.core import (
+    CONFIG_FILE, DEFAULT_DISK_RESERVE, DEFAULT_DNS_TTL, DEFAULT_FILE_ATTEMPTS, DEFAULT_REQUEUE_DELAY,
+    ERA5_VARS, RETRY_THROTTLE, create_rate_limiter, create_s3_client, create_striper, default_retry_budget,
+    DiskFullException, DiskPlanner, DownloadStoppedException, FileCorruptException, FileIncompleteException,
+    iter_month_files, parse_size, PauseGate, read_config_file, RequeueTracker, RetryPolicy,
+    store_failure_report, stream_object_to_file, stream_tasks, TransferStats, wait_requeue_delay,
+    warm_up_connections)
+from era5.scheduling import create_file_scheduler, PriorityRules
+from era5.validate import verify_download
+from era5.postprocess import create_post_processor
+from era5.content_store import create_content_store
+from era5.cli import main
+
 # 设置外观
 ctk.set_appearance_mode("Dark")
 ctk.set_default_color_theme("dark-blue")
 
-# ================= 变量定义 =================
-ERA5_VARS = {
-    "动力与热力学": {
-        "t": "空气温度 (K)", "u": "U风分量 (m/s)", "v": "V风分量 (m/s)",
-        "w": "垂直速度 (Pa/s)", "z": "位势高度", "d": "散度", "vo": "相对涡度", "pv": "位涡"
-    },
-    "湿度与云物理": {
-        "q": "比湿", "r": "相对湿度", "cc": "云量", "ciwc": "云冰水含量",
-        "clwc": "云液水含量", "crwc": "雨水含量", "cswc": "雪水含量"
-    },
-    "化学成分": {
-        "o3": "臭氧"
-    }
-}
-
-# 配置文件路径
-CONFIG_FILE = ".era5_gui_config.json"
-
-
-# ================= 自定义异常类 =================
-class DownloadStoppedException(Exception):
-    """下载被用户停止"""
-    pass
-
-
-class FileIncompleteException(Exception):
-    """文件下载不完整"""
-    pass
-
 
 class ERA5ResumeDownloadApp(ctk.CTk):
     def __init__(self):
@@ -56,6 +41,8 @@ class ERA5ResumeDownloadApp(ctk.CTk):
 
         # 拦截关闭事件
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
+        # F9 开关性能剖析
+        self.bind("<F9>", lambda event: self.toggle_profiling())
 
         # S3 配置
         self.bucket_name = 'nsf-ncar-era5'
@@ -64,22 +51,39 @@ class ERA5ResumeDownloadApp(ctk.CTk):
         self.stop_requested = False
         self.current_download_dir = None
 
-        # 速度监控锁
-        self.total_bytes = 0
-        self.last_bytes = 0
-        self.lock = threading.Lock()
-        self.speed_reset_threshold = 1024 * 1024 * 1024  # 1GB后重置计数器
+        # 速度与剩余时间估算，也是指标端点的数据来源
+        self.progress = ProgressTracker()
+        self.metrics_server = None
+
+        # 请求各阶段耗时统计
+        self.transfer_stats = TransferStats()
 
         # 断点续传配置
         self.max_retries = 6  # 最大重试次数
         self.retry_delay = 2  # 初始重试延迟(秒)
+        self.retry_policy = RetryPolicy(self.max_retries, self.retry_delay)  # 各线程共享，含全局熔断
         self.progress_file = ".era5_download_progress.json"  # 进度文件
         self.chunk_size = 8 * 1024 * 1024  # 8MB 分块大小
 
         # 失败文件追踪
         self.failed_files = []  # 记录下载失败的文件
+        self.requeue_tracker = None  # 每个文件的尝试次数和全局重试预算
+        self.requeued = []  # 本轮失败、等待在队尾补下的文件
         self.lock_failed = threading.Lock()  # 保护失败列表的锁
 
+        # 下载后处理流水线(配置了 post_process 时启用)
+        self.post_processor = None
+        # 内容寻址存储(配置了 content_store 时启用)
+        self.content_store = None
+        # 下载中遇到磁盘满/超配额时置位
+        self.disk_full = False
+        # 多端点分流(配置了 stripe 时启用)
+        self.striper = None
+        # 带宽限制(配置了 max_rate 时启用)
+        self.rate_limiter = None
+        # 暂停/继续开关，下载线程在块边界检查
+        self.pause_gate = PauseGate()
+
         # 布局
         self.grid_columnconfigure(1, weight=1)
         self.grid_rowconfigure(0, weight=1)
@@ -120,7 +124,11 @@ class ERA5ResumeDownloadApp(ctk.CTk):
                                        font=("微软雅黑", 15, "bold"), height=45, fg_color="#1f6aa5")
         self.start_btn.pack(fill="x", padx=20, pady=(40, 10))
 
-        self.stop_btn = ctk.CTkButton(self.sidebar, text="停止并关闭", command=self.stop_download,
+        self.pause_btn = ctk.CTkButton(self.sidebar, text="暂停", command=self.toggle_pause,
+                                       font=("微软雅黑", 15, "bold"), height=45, fg_color="#b7791f", state="disabled")
+        self.pause_btn.pack(fill="x", padx=20, pady=(0, 10))
+
+        self.stop_btn = ctk.CTkButton(self.sidebar, text="停止", command=self.stop_download,
                                       font=("微软雅黑", 15, "bold"), height=45, fg_color="#a51f1f", state="disabled")
         self.stop_btn.pack(fill="x", padx=20, pady=(0, 20))
 
@@ -191,12 +199,14 @@ class ERA5ResumeDownloadApp(ctk.CTk):
     def save_config(self):
         """保存当前配置到文件"""
         try:
-            config = {
+            # 保留界面上没有的配置项(如 subset、post_process)
+            config = read_config_file()
+            config.update({
                 'date': self.date_entry.get(),
                 'local_root': self.local_root,
                 'thread_count': int(self.thread_slider.get()),
                 'selected_vars': [k for k, v in self.checkboxes.items() if v.get() == 1]
-            }
+            })
             with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
                 json.dump(config, f, ensure_ascii=False, indent=2)
         except Exception as e:
@@ -247,13 +257,21 @@ class ERA5ResumeDownloadApp(ctk.CTk):
     def on_closing(self):
         """窗口关闭事件"""
         if self.is_downloading:
-            # 如果正在下载，调用停止下载
+            # 如果正在下载，先停止下载，等下载线程收尾(保存进度、关闭文件)后再关闭窗口
             self.stop_download()
+            self._close_when_idle(time.time() + 10)
         else:
             # 如果没有下载，直接保存配置并退出
             self.save_config()
             self.destroy()
 
+    def _close_when_idle(self, deadline):
+        """下载线程结束(或超过 deadline)后关闭窗口，不阻塞界面线程"""
+        if self.is_downloading and time.time() < deadline:
+            self.after(200, self._close_when_idle, deadline)
+            return
+        self.destroy()
+
     # ================= 逻辑功能 =================
 
     def select_folder(self):
@@ -287,33 +305,68 @@ class ERA5ResumeDownloadApp(ctk.CTk):
             print(f"加载进度失败: {e}")
         return None
 
+    def _halted(self):
+        """用户停止或磁盘已满：不再派发新文件，进行中的请求在块边界退出
+
+        磁盘满不置 stop_requested，本轮照常收尾并写入失败报告。
+        """
+        return self.stop_requested or self.disk_full
+
     def stop_download(self):
-        """停止下载,保留临时文件供断点续传"""
+        """停止下载,保留临时文件供断点续传
+
+        只置停止标志：下载线程在下一个块边界退出，临时文件和进度照常保存，
+        客户端与连接池保留，下次开始下载时直接复用。
+        """
         self.stop_requested = True
+        # 暂停中的线程需要醒来才能看到停止标志
+        self.pause_gate.resume()
 
         # UI反馈
         self.log_label.configure(text="正在停止,保留临时文件供续传...", text_color="orange")
         self.stop_btn.configure(text="停止中...", state="disabled")
+        self.pause_btn.configure(text="暂停", state="disabled")
 
         # 保存配置
         self.save_config()
 
-        # 等待线程结束(最多5秒)
-        for _ in range(50):
-            if not self.is_downloading:
-                break
-            time.sleep(0.1)
-
-        # 关闭网络
-        if self.s3_client:
-            try:
-                self.s3_client._endpoint.http_session.close()
-            except:
-                pass
+    def toggle_pause(self):
+        """暂停/继续下载，不中断进程也不丢弃已下载的数据"""
+        if not self.is_downloading:
+            return
+        if not self.pause_gate.paused:
+            self.pause_gate.pause()
+            self.pause_btn.configure(text="继续")
+            self.log_label.configure(text="已暂停：已下载数据已写入磁盘，点击继续恢复", text_color="orange")
+            return
 
-        # 关闭窗口
-        self.destroy()
-        os._exit(0)
+        self.pause_gate.resume()
+        self.pause_btn.configure(text="暂停")
+        self.log_label.configure(text="已恢复下载", text_color="#64b5f6")
+        # 暂停较久时服务端可能已关闭空闲连接，后台重新预热
+        if self.s3_client is not None:
+            threading.Thread(target=warm_up_connections,
+                             args=(self.s3_client, self.bucket_name, int(self.thread_slider.get())),
+                             daemon=True).start()
+
+    def toggle_profiling(self):
+        """开关性能剖析，关闭时把折叠栈和分段汇总写到下载目录"""
+        if not PROFILER.enabled:
+            PROFILER.start()
+            self.log_label.configure(text="性能剖析已开启，再按 F9 停止并保存结果", text_color="orange")
+            print("[剖析] 已开启")
+            return
+        PROFILER.stop()
+        out_dir = self.current_download_dir or self.local_root or "."
+        try:
+            collapsed, summary = PROFILER.dump(out_dir)
+        except OSError as e:
+            self.log_label.configure(text=f"保存剖析结果失败: {e}", text_color="red")
+            return
+        for line in PROFILER.summary_lines():
+            print(f"[剖析] {line}")
+        print(f"[剖析] 折叠栈: {collapsed}")
+        self.log_label.configure(text=f"剖析结果已保存: {os.path.basename(summary)}", text_color="#64b5f6")
 
     def start_download(self):
         if self.is_downloading: return
@@ -327,11 +380,14 @@ class ERA5ResumeDownloadApp(ctk.CTk):
 
         self.is_downloading = True
         self.stop_requested = False
-        self.total_bytes = 0
-        self.last_bytes = 0
+        self.progress.reset()
+        self.transfer_stats = TransferStats()
+
+        self.pause_gate.resume()
 
         self.start_btn.configure(state="disabled", text="运行中...")
-        self.stop_btn.configure(state="normal", text="停止并关闭")
+        self.pause_btn.configure(state="normal", text="暂停")
+        self.stop_btn.configure(state="normal", text="停止")
 
         num_threads = int(self.thread_slider.get())
         for i in range(10):
@@ -347,33 +403,19 @@ class ERA5ResumeDownloadApp(ctk.CTk):
         if not self.is_downloading:
             self.speed_label.configure(text="当前速度: 0.0 MB/s")
             return
-        with self.lock: curr = self.total_bytes
-        diff = curr - self.last_bytes
-        self.last_bytes = curr
-
-        # 定期重置total_bytes，避免数值过大影响性能
-        if curr > self.speed_reset_threshold:
-            with self.lock:
-                self.total_bytes = 0
-                self.last_bytes = 0
-
-        self.speed_label.configure(text=f"当前速度: {diff / 1048576:.2f} MB/s")
+        self.speed_label.configure(text=format_progress(self.progress.sample()))
         self.after(1000, self.monitor_speed)
 
     def run_logic(self, date_str, max_workers):
         try:
-            prefix = f"e5.oper.an.pl/{date_str}/"
-
             # 优化S3客户端配置，提升性能
-            s3_config = Config(
-                signature_version=UNSIGNED,
-                max_pool_connections=max_workers * 2,  # 增加连接池大小
-                tcp_keepalive=True,  # 启用TCP keepalive保持连接活跃
-                connect_timeout=10,  # 连接超时10秒
-                read_timeout=30,  # 读取超时30秒
-                retries={'max_attempts': 2}  # 限制内部重试次数
-            )
-            self.s3_client = boto3.client('s3', config=s3_config)
+            config = read_config_file()
+            self.s3_client = create_s3_client(max_workers, config.get('cache_endpoint'),
+                                              config.get('dns_ttl', DEFAULT_DNS_TTL))
+            self.striper = create_striper(config, max_workers)
+            self.rate_limiter = create_rate_limiter(config)
+            if self.metrics_server is None:
+                self.metrics_server = start_metrics_server(config, lambda: self.progress.latest)
 
             wanted_vars = self.get_selected_vars()
             self.log_label.configure(text=f"正在扫描... 目标变量: {wanted_vars if wanted_vars else '全部'}",
@@ -387,32 +429,9 @@ class ERA5ResumeDownloadApp(ctk.CTk):
             perf_start_time = time.time()
             perf_file_count = 0
 
-            paginator = self.s3_client.get_paginator('list_objects_v2')
-            files_to_download = []
-
-            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
-                if 'Contents' in page:
-                    for obj in page['Contents']:
-                        key = obj['Key']
-                        fname = os.path.basename(key)
-                        try:
-                            parts = fname.split('.')
-                            var_segment = parts[4]
-                            current_var = var_segment.split('_')[-1]
-                        except:
-                            current_var = "unknown"
-
-                        if not wanted_vars or current_var in wanted_vars:
-                            files_to_download.append(
-                                {'Key': key, 'Size': obj['Size'], 'Var': current_var, 'Name': fname})
-
-            if not files_to_download:
-                self.log_label.configure(text="未找到文件!", text_color="red")
-                self.reset_ui()
-                return
-
             target_dir = os.path.join(self.local_root, date_str)
-            if not os.path.exists(target_dir): os.makedirs(target_dir)
+            created = not os.path.exists(target_dir)
+            if created: os.makedirs(target_dir)
             self.current_download_dir = target_dir
 
             # 加载之前的进度
@@ -421,73 +440,198 @@ class ERA5ResumeDownloadApp(ctk.CTk):
             if progress_data and 'completed' in progress_data:
                 completed_files = set(progress_data['completed'])
 
-            # 过滤已完成的文件
-            remaining_files = [f for f in files_to_download if f['Name'] not in completed_files]
-
-            if not remaining_files:
-                self.log_label.configure(text="所有文件已下载完成!", text_color="#00e676")
-                messagebox.showinfo("提示", f"所有文件已下载完成: {target_dir}")
-                self.reset_ui()
-                return
-
-            self.log_label.configure(
-                text=f"共 {len(files_to_download)} 个文件,已完成 {len(completed_files)},剩余 {len(remaining_files)}",
-                text_color="white"
-            )
+            self.post_processor = create_post_processor(config)
+            self.content_store = create_content_store(config)
+            self.disk_full = False
+
+            # 失败的文件排到队尾，整轮结束后再补下，重试次数受全局预算限制
+            self.requeue_tracker = RequeueTracker(config.get('file_attempts', DEFAULT_FILE_ATTEMPTS),
+                                                  default_retry_budget(config, 0))
+            self.retry_policy.budget = self.requeue_tracker.budget
+            auto_budget = 'retry_budget' not in config
+            # 配置了 priorities 时按变量优先级调度，否则保持列举顺序
+            priority_rules = PriorityRules.from_config(config)
+
+            # 边列举边下载：每取回一页列举结果就过滤已完成的文件，并只安排磁盘放得下的文件
+            planner = DiskPlanner(target_dir, parse_size(config.get('disk_reserve', DEFAULT_DISK_RESERVE)),
+                                  self.content_store)
+            deferred = []
+            listed = {'files': 0, 'pending': 0, 'queued': 0}
+
+            def remaining():
+                # 在生产线程中运行
+                for f_info in iter_month_files(self.s3_client, self.bucket_name, date_str, wanted_vars):
+                    listed['files'] += 1
+                    if f_info['Name'] in completed_files:
+                        continue
+                    listed['pending'] += 1
+                    if not planner.admit(f_info):
+                        deferred.append(f_info)
+                        continue
+                    listed['queued'] += 1
+                    self.progress.expect(f_info['Size'])
+                    if auto_budget:
+                        self.requeue_tracker.budget.grow_to(listed['queued'])
+                    yield f_info
+                print(f"[磁盘] 需要 {planner.total_need / 1073741824:.1f} GB, 可用 {planner.free / 1073741824:.1f} GB")
+                if listed['pending']:
+                    self.log_label.configure(
+                        text=f"共 {listed['files']} 个文件,已完成 {listed['files'] - listed['pending']},"
+                             f"剩余 {listed['pending']}", text_color="white")
 
             slot_queue = queue.Queue()
             for i in range(max_workers):
                 slot_queue.put(i)
 
+            # 开始调度前并发建好连接，首批文件不必排队握手
+            if config.get('warm_up', True):
+                self.log_label.configure(text="正在预热连接...", text_color="#64b5f6")
+                warmed, seconds = warm_up_connections(self.s3_client, self.bucket_name, max_workers)
+                print(f"[连接] 预热 {warmed} 个连接，用时 {seconds:.2f} 秒")
+                self.log_label.configure(text=f"正在扫描并下载... 目标变量: {wanted_vars if wanted_vars else '全部'}",
+                                         text_color="#64b5f6")
+
             transfer_cfg = TransferConfig(use_threads=False)
 
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                futures = []
-                for f_info in remaining_files:
-                    if self.stop_requested: break
-                    futures.append(executor.submit(
-                        self.download_one_with_resume, f_info, target_dir, transfer_cfg, slot_queue
-                    ))
+            def run_one(f_info):
+                self.requeue_tracker.started(f_info['Name'])
+                try:
+                    self.download_one_with_resume(f_info, target_dir, transfer_cfg, slot_queue)
+                finally:
+                    # 排到队尾的文件仍在清单中，其余(完成、跳过、最终失败)移出
+                    with self.lock_failed:
+                        requeued = f_info in self.requeued
+                    if not requeued:
+                        self.progress.finish(f_info['Size'])
+
+            pending = remaining()
+            round_no = 0
+            listing_error = None
+            while not self._halted():
+                if round_no > 0:
+                    if not pending:
+                        break
+                    self.log_label.configure(
+                        text=f"第 {round_no} 轮补下 {len(pending)} 个失败文件...", text_color="orange")
+                    print(f"[重试] 第 {round_no} 轮补下 {len(pending)} 个失败文件 "
+                          f"(剩余重试预算 {self.requeue_tracker.budget.remaining})")
+                    if not wait_requeue_delay(config.get('requeue_delay', DEFAULT_REQUEUE_DELAY), self._halted):
+                        break
 
-                # 等待所有任务完成
-                for i, f in enumerate(futures):
-                    try:
-                        f.result()
-                        perf_file_count += 1
-
-                        # 每完成10个文件记录一次性能状态
-                        if perf_file_count % 10 == 0:
-                            elapsed = time.time() - perf_start_time
-                            speed = (perf_file_count * 60) / elapsed if elapsed > 0 else 0
-                            print(f"[性能监控] 已完成 {perf_file_count}/{len(remaining_files)} 个文件, "
-                                  f"耗时 {elapsed:.1f}秒, 平均速度 {speed:.2f} 文件/分钟")
-
-                    except DownloadStoppedException:
-                        # 用户停止下载，不记录为失败
-                        pass
-                    except Exception as e:
-                        # 其他异常已经记录在 failed_files 中
-                        print(f"任务异常: {e}")
+                with self.lock_failed:
+                    self.requeued = []
+                # 按完成顺序处理结果
+                try:
+                    for f_info, error in stream_tasks(pending, run_one, max_workers, self._halted,
+                                                      scheduler=create_file_scheduler(config, priority_rules)):
+                        if error is None:
+                            perf_file_count += 1
+
+                            # 每完成10个文件记录一次性能状态
+                            if perf_file_count % 10 == 0:
+                                elapsed = time.time() - perf_start_time
+                                speed = (perf_file_count * 60) / elapsed if elapsed > 0 else 0
+                                print(f"[性能监控] 已完成 {perf_file_count}/{listed['queued']} 个文件, "
+                                      f"耗时 {elapsed:.1f}秒, 平均速度 {speed:.2f} 文件/分钟, "
+                                      f"{format_progress(self.progress.latest)}")
+                        elif not isinstance(error, DownloadStoppedException):
+                            # 其他异常已经记录在 failed_files 中；用户停止下载不记录为失败
+                            print(f"任务异常: {error}")
+                except Exception as e:
+                    # 列举中途出错：已领取的文件都已处理完，先收尾再报告
+                    listing_error = e
+                    with self.lock_failed:
+                        pending = self.requeued
+                    break
+                with self.lock_failed:
+                    pending = self.requeued
+                    self.requeued = []
+                round_no += 1
+
+            with self.lock_failed:
+                # 停止、磁盘满或列举出错时仍在等待补下的文件记为失败
+                if isinstance(pending, list):
+                    if listing_error is not None:
+                        reason = "列举出错，未重试"
+                    elif self.disk_full:
+                        reason = "磁盘空间不足，未重试"
+                    else:
+                        reason = "已停止，未重试"
+                    for f_info in pending:
+                        self.failed_files.append({'name': f_info['Name'], 'error': reason})
+                # 放不下的文件记为失败，释放空间后重新开始即可
+                for f_info in deferred:
+                    self.failed_files.append({'name': f_info['Name'], 'error': "磁盘空间不足，本次未下载"})
+                    self.requeue_tracker.skipped(f_info['Name'], "磁盘空间不足，本次未下载")
+            if deferred:
+                print(f"[磁盘] 空间不足，推迟 {len(deferred)} 个文件")
+
+            # 列举完才知道的情况：没有文件、全部已完成、磁盘一个都放不下
+            if listing_error is None and (not listed['pending'] or (deferred and not listed['queued'])):
+                if self.post_processor:
+                    self.post_processor.close()
+                    self.post_processor = None
+                if not listed['files']:
+                    self.log_label.configure(text="未找到文件!", text_color="red")
+                    if created:
+                        try:
+                            os.rmdir(target_dir)
+                        except OSError:
+                            pass
+                elif not listed['pending']:
+                    self.log_label.configure(text="所有文件已下载完成!", text_color="#00e676")
+                    messagebox.showinfo("提示", f"所有文件已下载完成: {target_dir}")
+                else:
+                    need, free = planner.total_need, planner.free
+                    self.log_label.configure(text=f"磁盘空间不足: 需要 {need / 1073741824:.1f} GB，"
+                                                  f"可用 {free / 1073741824:.1f} GB", text_color="red")
+                    messagebox.showerror("磁盘空间不足", f"保存目录剩余空间不足以下载任何文件: {target_dir}")
+                return
+
+            if self.post_processor:
+                self.log_label.configure(text="下载结束，等待后处理完成...", text_color="#64b5f6")
+                pp_done, pp_failed = self.post_processor.close()
+                self.post_processor = None
+                print(f"[后处理] 完成 {pp_done} 个, 失败 {pp_failed} 个")
+            if listing_error is not None:
+                raise listing_error
+
+            # 输出并保存各阶段耗时统计
+            for line in self.transfer_stats.summary_lines():
+                print(f"[传输统计] {line}")
+            self.transfer_stats.save(target_dir)
+            if self.striper:
+                for line in self.striper.summary_lines():
+                    print(f"[分流] {line}")
 
             if not self.stop_requested:
-                # 清理进度文件
+                # 检查是否有失败的文件
+                with self.lock_failed:
+                    failed_count = len(self.failed_files)
+
                 progress_file = os.path.join(target_dir, self.progress_file)
-                if os.path.exists(progress_file):
+                if failed_count > 0:
+                    # 保留进度文件并写入失败报告，重新开始时只补下失败的文件
+                    progress_data = self.load_progress(target_dir) or {
+                        'completed': [], 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+                    self.save_progress(store_failure_report(progress_data, self.requeue_tracker.report()))
+                elif os.path.exists(progress_file):
+                    # 清理进度文件
                     try:
                         os.remove(progress_file)
                     except:
                         pass
 
-                # 检查是否有失败的文件
-                with self.lock_failed:
-                    failed_count = len(self.failed_files)
-
                 if failed_count > 0:
-                    # 有文件下载失败
-                    self.log_label.configure(
-                        text=f"下载完成，但 {failed_count} 个文件失败",
-                        text_color="orange"
-                    )
+                    # 有文件下载失败；磁盘满时剩余文件已暂停，失败列表照常显示
+                    if self.disk_full:
+                        self.log_label.configure(text="磁盘空间或配额不足，已暂停；释放空间后重新开始会断点续传",
+                                                 text_color="red")
+                    else:
+                        self.log_label.configure(
+                            text=f"下载完成，但 {failed_count} 个文件失败",
+                            text_color="orange"
+                        )
 
                     # 构建失败文件列表
                     failure_list = "以下文件下载失败:\n\n"
@@ -502,7 +646,7 @@ class ERA5ResumeDownloadApp(ctk.CTk):
                         if failed_count > 10:
                             failure_list += f"... 还有 {failed_count - 10} 个文件失败\n"
 
-                    messagebox.showwarning("部分文件下载失败", failure_list)
+                    messagebox.showwarning("磁盘空间不足" if self.disk_full else "部分文件下载失败", failure_list)
                 else:
                     # 所有文件都成功
                     self.log_label.configure(text="所有任务完成!", text_color="#00e676")
@@ -516,7 +660,9 @@ class ERA5ResumeDownloadApp(ctk.CTk):
 
     def download_one_with_resume(self, f_info, target_dir, cfg, slot_queue):
         """支持断点续传的下载方法"""
-        if self.stop_requested:
+        # 暂停期间不开始新文件
+        self.pause_gate.wait(self._halted)
+        if self._halted():
             raise DownloadStoppedException("用户停止下载")
 
         sid = slot_queue.get()
@@ -525,7 +671,7 @@ class ERA5ResumeDownloadApp(ctk.CTk):
         short_name = f_info['Name'][-25:]
 
         try:
-            if self.stop_requested:
+            if self._halted():
                 raise DownloadStoppedException("用户停止下载")
 
             # 检查本地文件是否完整
@@ -539,6 +685,16 @@ class ERA5ResumeDownloadApp(ctk.CTk):
                 else:
                     self.update_slot(sid, f_info['Var'], short_name, 0, "不完整-重下")
 
+            # 共享存储中已有同一文件时只建链接
+            if self.content_store:
+                method = self.content_store.link_into(f_info, local_path)
+                if method:
+                    self.update_slot(sid, f_info['Var'], short_name, 1.0, f"已链接({method})")
+                    self._update_progress(target_dir, f_info['Name'], completed=True)
+                    if self.post_processor:
+                        self.post_processor.submit(local_path, target_dir)
+                    return
+
             # 检查临时文件大小(断点续传)
             downloaded_bytes = 0
             if os.path.exists(temp_path):
@@ -563,10 +719,15 @@ class ERA5ResumeDownloadApp(ctk.CTk):
                 # 验证文件大小
                 final_size = os.path.getsize(temp_path)
                 if final_size == f_info['Size']:
+                    verify_download(temp_path)
                     os.rename(temp_path, local_path)
+                    if self.content_store:
+                        self.content_store.adopt(local_path, f_info)
                     self.update_slot(sid, f_info['Var'], short_name, 1.0, "完成")
                     # 更新进度
                     self._update_progress(target_dir, f_info['Name'], completed=True)
+                    if self.post_processor:
+                        self.post_processor.submit(local_path, target_dir)
                 else:
                     # 文件不完整，抛出异常
                     error_msg = f"文件大小不匹配: 期望{f_info['Size']}字节，实际{final_size}字节"
@@ -577,6 +738,16 @@ class ERA5ResumeDownloadApp(ctk.CTk):
             self.update_slot(sid, f_info['Var'], short_name, 0, "已停止")
             raise  # 重新抛出，让调用者知道这是用户停止
 
+        except DiskFullException as e:
+            # 磁盘满时其他文件也无法写入，停止调度，保留临时文件供续传；
+            # 不置 stop_requested，本轮结束时照常写入失败报告
+            self.disk_full = True
+            self.requeue_tracker.failed(f_info['Name'], e)
+            with self.lock_failed:
+                self.failed_files.append({'name': f_info['Name'], 'error': str(e)})
+            self._log_error(f_info, e, traceback.format_exc())
+            self.update_slot(sid, f_info['Var'], short_name, 0, "磁盘已满")
+
         except FileIncompleteException as e:
             # 文件下载不完整
             failure_info = {
@@ -585,13 +756,18 @@ class ERA5ResumeDownloadApp(ctk.CTk):
                 'size': os.path.getsize(temp_path) if os.path.exists(temp_path) else 0,
                 'expected': f_info['Size']
             }
-            with self.lock_failed:
-                self.failed_files.append(failure_info)
+            requeued = self._record_failure(f_info, e, failure_info)
 
             # 记录详细错误日志
             self._log_error(f_info, e, traceback.format_exc())
 
-            self.update_slot(sid, f_info['Var'], short_name, 0, "文件不完整")
+            if requeued:
+                self.update_slot(sid, f_info['Var'], short_name, 0, "稍后重试")
+            elif isinstance(e, FileCorruptException):
+                # 临时文件已删除，下次从头下载
+                self.update_slot(sid, f_info['Var'], short_name, 0, "文件损坏")
+            else:
+                self.update_slot(sid, f_info['Var'], short_name, 0, "文件不完整")
             # 不抛出异常，保留临时文件供续传
 
         except Exception as e:
@@ -602,101 +778,73 @@ class ERA5ResumeDownloadApp(ctk.CTk):
                 'size': os.path.getsize(temp_path) if os.path.exists(temp_path) else 0,
                 'expected': f_info['Size']
             }
-            with self.lock_failed:
-                self.failed_files.append(failure_info)
+            requeued = self._record_failure(f_info, e, failure_info)
 
             # 记录详细错误日志
             self._log_error(f_info, e, traceback.format_exc())
 
-            self.update_slot(sid, "Err", "失败", 0, f"{type(e).__name__}")
+            if requeued:
+                self.update_slot(sid, f_info['Var'], short_name, 0, "稍后重试")
+            else:
+                self.update_slot(sid, "Err", "失败", 0, f"{type(e).__name__}")
             # 不抛出异常，继续下载其他文件
 
         finally:
+            self.progress.end(sid)
             slot_queue.put(sid)
 
     def _download_with_retry(self, f_info, temp_path, start_byte, sid):
-        """带重试的下载方法"""
+        """带重试的下载方法，退避和熔断由共享的 retry_policy 决定"""
         short_name = f_info['Name'][-25:]
         remote_size = f_info['Size']
+        should_stop = self._halted
 
-        for retry in range(self.max_retries):
-            # 检查是否停止请求
-            if self.stop_requested:
-                raise DownloadStoppedException("用户停止下载")
-
-            try:
-                if start_byte >= remote_size:
-                    # 文件已经下载完成
-                    return
+        # 动态调整UI更新频率：大文件更新频率低，小文件更新频率高
+        update_interval = max(0.2, min(1.0, remote_size / 100_000_000))
 
-                # 使用 Range 请求（仅当需要断点续传时）
-                get_params = {
-                    'Bucket': self.bucket_name,
-                    'Key': f_info['Key']
-                }
-                if start_byte > 0:
-                    get_params['Range'] = f"bytes={start_byte}-"
-
-                # 获取对象
-                response = self.s3_client.get_object(**get_params)
-
-                # 写入文件(追加模式)
-                mode = 'ab' if start_byte > 0 else 'wb'
-                with open(temp_path, mode) as f:
-                    downloaded = start_byte
-                    chunk_size = self.chunk_size
-
-                    for chunk in response['Body'].iter_chunks(chunk_size=chunk_size):
-                        # 检查是否停止请求
-                        if self.stop_requested:
-                            raise DownloadStoppedException("用户停止下载")
-
-                        f.write(chunk)
-                        downloaded += len(chunk)
-
-                        # 更新进度
-                        with self.lock:
-                            self.total_bytes += len(chunk)
-
-                        pct = downloaded / remote_size
-                        t = time.time()
-                        # 动态调整UI更新频率：大文件更新频率低，小文件更新频率高
-                        update_interval = max(0.2, min(1.0, remote_size / 100_000_000))
-                        if t - cb.last_t > update_interval or pct >= 1.0:
-                            # 显示百分比和已下载大小
-                            status_text = f"{int(pct * 100)}%"
-                            if retry > 0:
-                                status_text += f" (重试{retry})"
-                            self.update_slot(sid, f_info['Var'], short_name, pct, status_text)
-                            cb.last_t = t
-
-                # 下载成功,退出重试循环
+        def attempt(retry):
+            # 每次尝试从临时文件当前大小续传
+            start = os.path.getsize(temp_path) if retry > 0 and os.path.exists(temp_path) else start_byte
+            if start >= remote_size:
+                # 文件已经下载完成
                 return
+            self.progress.begin(sid, start)
+
+            def on_chunk(n, downloaded):
+                # 更新进度
+                self.progress.add(sid, n)
+
+                pct = downloaded / remote_size
+                t = time.time()
+                if t - cb.last_t > update_interval or pct >= 1.0:
+                    # 显示百分比和已下载大小
+                    status_text = f"{int(pct * 100)}%"
+                    if retry > 0:
+                        status_text += f" (重试{retry})"
+                    self.update_slot(sid, f_info['Var'], short_name, pct, status_text)
+                    cb.last_t = t
+
+            # 使用 Range 请求（仅当需要断点续传时）
+            def fetch(client):
+                return stream_object_to_file(client, self.bucket_name, f_info, temp_path, start,
+                                             self.chunk_size, on_chunk=on_chunk, should_stop=should_stop,
+                                             stats=self.transfer_stats, attempt=retry,
+                                             limiter=self.rate_limiter, gate=self.pause_gate) - start
+
+            if self.striper:
+                self.striper.run(fetch)
+            else:
+                fetch(self.s3_client)
 
-            except DownloadStoppedException:
-                # 用户停止，重新抛出
-                raise
-
-            except (ConnectionError, ClientError, EndpointConnectionError, OSError, IOError) as e:
-                if retry < self.max_retries - 1:
-                    # 指数退避
-                    delay = self.retry_delay * (2 ** retry)
-                    # 计算当前进度
-                    current_pct = 0
-                    if os.path.exists(temp_path):
-                        current_size = os.path.getsize(temp_path)
-                        current_pct = current_size / remote_size
-
-                    self.update_slot(sid, f_info['Var'], short_name, current_pct,
-                                   f"网络错误,{delay}秒后重试({retry+1}/{self.max_retries})")
-                    time.sleep(delay)
-
-                    # 更新断点位置
-                    if os.path.exists(temp_path):
-                        start_byte = os.path.getsize(temp_path)
-                else:
-                    # 达到最大重试次数，重新抛出异常
-                    raise
+        def on_retry(retry, kind, delay, error):
+            current_pct = os.path.getsize(temp_path) / remote_size if os.path.exists(temp_path) else 0
+            reason = "服务端限流" if kind == RETRY_THROTTLE else "网络错误"
+            self.update_slot(sid, f_info['Var'], short_name, current_pct,
+                             f"{reason},{delay:.0f}秒后重试({retry + 1}/{self.max_retries})")
+
+        if should_stop():
+            raise DownloadStoppedException("用户停止下载")
+        self.retry_policy.run(attempt, should_stop, on_retry)
 
     def _update_progress(self, target_dir, filename, completed=False):
         """更新下载进度"""
@@ -704,10 +852,23 @@ class ERA5ResumeDownloadApp(ctk.CTk):
         if progress_data is None:
             progress_data = {'completed': [], 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
 
+        if completed:
+            self.requeue_tracker.succeeded(filename)
         if completed and filename not in progress_data['completed']:
             progress_data['completed'].append(filename)
+            progress_data.get('failed', {}).pop(filename, None)
             self.save_progress(progress_data)
 
+    def _record_failure(self, f_info, e, failure_info):
+        """记录一次失败；可重试的文件放回队尾等本轮结束后补下，返回是否已重新排队"""
+        requeue = self.requeue_tracker.failed(f_info['Name'], e) and not self._halted()
+        with self.lock_failed:
+            if requeue:
+                self.requeued.append(f_info)
+            else:
+                self.failed_files.append(failure_info)
+        return requeue
+
     def _log_error(self, f_info, exception, traceback_str):
         """记录错误日志到文件"""
         try:
@@ -735,6 +896,7 @@ class ERA5ResumeDownloadApp(ctk.CTk):
 
     def update_slot(self, sid, var, name, pct, status=None):
         def _ui():
+            t0 = time.perf_counter() if PROFILER.enabled else None
             # 如果提供了状态文本，使用状态文本；否则显示百分比
             if status:
                 txt = status
@@ -744,15 +906,19 @@ class ERA5ResumeDownloadApp(ctk.CTk):
             self.slots[sid]['label'].configure(text=f"[{var}] ...{name}")
             self.slots[sid]['bar'].set(pct)
             self.slots[sid]['pct'].configure(text=txt)
+            if t0 is not None:
+                PROFILER.record('tk_ui', time.perf_counter() - t0)
 
         self.after(0, _ui)
 
     def reset_ui(self):
         self.is_downloading = False
+        self.pause_gate.resume()
 
         def _r():
             self.start_btn.configure(state="normal", text="开始下载")
-            self.stop_btn.configure(state="disabled", text="停止并关闭")
+            self.pause_btn.configure(state="disabled", text="暂停")
+            self.stop_btn.configure(state="disabled", text="停止")
             self.speed_label.configure(text="当前速度: 0.0 MB/s")
             for s in self.slots:
                 s['label'].configure(text="闲置")
@@ -762,359 +928,6 @@ class ERA5ResumeDownloadApp(ctk.CTk):
         self.after(0, _r)
 
 
-# ================= 无GUI自动下载类 =================
-class AutoDownloader:
-    """无GUI的自动下载器"""
-    def __init__(self):
-        self.bucket_name = 'nsf-ncar-era5'
-        self.s3_client = None
-        self.stop_requested = False
-        self.current_download_dir = None
-        self.max_retries = 6
-        self.retry_delay = 2
-        self.progress_file = ".era5_download_progress.json"
-        self.chunk_size = 8 * 1024 * 1024
-        self.failed_files = []
-        self.config = None
-
-        # 实时进度监控
-        self.thread_progress = {}  # {slot_id: {'file': name, 'var': var, 'pct': 0.0-1.0, 'status': text}}
-        self.progress_lock = threading.Lock()
-        self.last_progress_print = 0
-
-    def load_config(self):
-        """加载配置文件"""
-        try:
-            if os.path.exists(CONFIG_FILE):
-                with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                    self.config = json.load(f)
-                print(f"[配置] 成功加载配置文件")
-                print(f"  日期: {self.config['date']}")
-                print(f"  路径: {self.config['local_root']}")
-                print(f"  线程: {self.config['thread_count']}")
-                print(f"  变量: {self.config['selected_vars'] if self.config['selected_vars'] else '全部'}")
-                return True
-            else:
-                print("[配置] 配置文件不存在，需要手动创建")
-                return False
-        except Exception as e:
-            print(f"[配置] 加载失败: {e}")
-            return False
-
-    def get_selected_vars(self):
-        if not self.config:
-            return []
-        return self.config.get('selected_vars', [])
-
-    def save_progress(self, target_dir, progress_data):
-        """保存下载进度"""
-        try:
-            progress_file = os.path.join(target_dir, self.progress_file)
-            with open(progress_file, 'w', encoding='utf-8') as f:
-                json.dump(progress_data, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"[进度] 保存失败: {e}")
-
-    def load_progress(self, target_dir):
-        """加载下载进度"""
-        try:
-            progress_file = os.path.join(target_dir, self.progress_file)
-            if os.path.exists(progress_file):
-                with open(progress_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-        except Exception as e:
-            print(f"[进度] 加载失败: {e}")
-        return None
-
-    def update_progress(self, target_dir, filename, completed=False):
-        """更新下载进度"""
-        progress_data = self.load_progress(target_dir)
-        if progress_data is None:
-            progress_data = {'completed': [], 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
-
-        if completed and filename not in progress_data['completed']:
-            progress_data['completed'].append(filename)
-            self.save_progress(target_dir, progress_data)
-
-    def format_size(self, bytes_size):
-        """格式化文件大小"""
-        if bytes_size < 1024 * 1024:
-            return f"{bytes_size / 1024:.1f}KB"
-        else:
-            return f"{bytes_size / 1048576:.1f}MB"
-
-    def run(self):
-        """执行自动下载"""
-        if not self.load_config():
-            return False
-
-        date_str = self.config['date']
-        local_root = self.config['local_root']
-        max_workers = self.config['thread_count']
-
-        print(f"\n{'='*60}")
-        print(f"ERA5 自动下载启动")
-        print(f"{'='*60}")
-        print(f"开始时间: {time.strftime('%Y-%m-%d %H:%M:%S')}")
-        print(f"目标日期: {date_str}")
-        print(f"保存目录: {local_root}")
-        print(f"并发线程: {max_workers}")
-        print(f"{'='*60}\n")
-
-        try:
-            prefix = f"e5.oper.an.pl/{date_str}/"
-
-            # S3配置
-            s3_config = Config(
-                signature_version=UNSIGNED,
-                max_pool_connections=max_workers * 2,
-                tcp_keepalive=True,
-                connect_timeout=10,
-                read_timeout=30,
-                retries={'max_attempts': 2}
-            )
-            self.s3_client = boto3.client('s3', config=s3_config)
-
-            wanted_vars = self.get_selected_vars()
-            print(f"[扫描] 正在扫描 S3 存储桶...")
-            print(f"[扫描] 目标变量: {wanted_vars if wanted_vars else '全部'}\n")
-
-            paginator = self.s3_client.get_paginator('list_objects_v2')
-            files_to_download = []
-
-            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
-                if 'Contents' in page:
-                    for obj in page['Contents']:
-                        key = obj['Key']
-                        fname = os.path.basename(key)
-                        try:
-                            parts = fname.split('.')
-                            var_segment = parts[4]
-                            current_var = var_segment.split('_')[-1]
-                        except:
-                            current_var = "unknown"
-
-                        if not wanted_vars or current_var in wanted_vars:
-                            files_to_download.append(
-                                {'Key': key, 'Size': obj['Size'], 'Var': current_var, 'Name': fname})
-
-            if not files_to_download:
-                print(f"[结果] 未找到匹配的文件!")
-                return True
-
-            print(f"[扫描] 找到 {len(files_to_download)} 个文件")
-
-            target_dir = os.path.join(local_root, date_str)
-            if not os.path.exists(target_dir): os.makedirs(target_dir)
-            self.current_download_dir = target_dir
-
-            # 加载进度
-            progress_data = self.load_progress(target_dir)
-            completed_files = set()
-            if progress_data and 'completed' in progress_data:
-                completed_files = set(progress_data['completed'])
-
-            remaining_files = [f for f in files_to_download if f['Name'] not in completed_files]
-
-            if not remaining_files:
-                print(f"[进度] 所有文件已下载完成!")
-                print(f"[结果] 保存位置: {target_dir}")
-                return True
-
-            print(f"[进度] 已完成 {len(completed_files)}, 剩余 {len(remaining_files)}\n")
-
-            # 开始下载
-            slot_queue = queue.Queue()
-            for i in range(max_workers):
-                slot_queue.put(i)
-
-            transfer_cfg = TransferConfig(use_threads=False)
-
-            completed_count = 0
-            failed_count = 0
-            start_time = time.time()
-
-            # 启动进度监控线程
-            import concurrent.futures
-            progress_monitor = threading.Thread(target=self.monitor_progress, args=(len(remaining_files),), daemon=True)
-            progress_monitor.start()
-
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                futures = {}
-                for f_info in remaining_files:
-                    if self.stop_requested: break
-                    futures[executor.submit(
-                        self.download_one, f_info, target_dir, transfer_cfg, slot_queue
-                    )] = f_info
-
-                for future in futures:
-                    try:
-                        future.result()
-                        completed_count += 1
-
-                        # 进度输出
-                        if completed_count % 10 == 0 or completed_count == len(remaining_files):
-                            elapsed = time.time() - start_time
-                            speed = (completed_count * 60) / elapsed if elapsed > 0 else 0
-                            print(f"[进度] {completed_count}/{len(remaining_files)} | "
-                                  f"耗时: {elapsed:.1f}秒 | 速度: {speed:.1f} 文件/分钟")
-
-                    except Exception as e:
-                        failed_count += 1
-                        print(f"[错误] {futures[future]['Name']}: {e}")
-
-            # 结果统计
-            elapsed = time.time() - start_time
-            print(f"\n{'='*60}")
-            print(f"下载完成!")
-            print(f"{'='*60}")
-            print(f"成功: {completed_count} 个文件")
-            print(f"失败: {failed_count} 个文件")
-            print(f"耗时: {elapsed/60:.1f} 分钟")
-            print(f"平均速度: {(completed_count*60)/elapsed:.1f} 文件/分钟")
-            print(f"保存位置: {target_dir}")
-            print(f"完成时间: {time.strftime('%Y-%m-%d %H:%M:%S')}")
-            print(f"{'='*60}\n")
-
-            return True
-
-        except Exception as e:
-            print(f"[错误] 下载失败: {e}")
-            traceback.print_exc()
-            return False
-
-    def download_one(self, f_info, target_dir, cfg, slot_queue):
-        """下载单个文件（支持实时进度更新）"""
-        sid = slot_queue.get()
-        local_path = os.path.join(target_dir, f_info['Name'])
-        temp_path = local_path + ".tmp"
-        short_name = f_info['Name'][-25:]  # 文件名后25个字符
-
-        try:
-            # 更新状态：开始
-            self._update_thread_progress(sid, f_info['Var'], short_name, 0.0, "开始下载...")
-
-            # 检查本地文件
-            if os.path.exists(local_path):
-                local_size = os.path.getsize(local_path)
-                if local_size == f_info['Size']:
-                    self._update_thread_progress(sid, f_info['Var'], short_name, 1.0, "已存在")
-                    return  # 已存在
-
-            # 断点续传
-            downloaded_bytes = 0
-            if os.path.exists(temp_path):
-                downloaded_bytes = os.path.getsize(temp_path)
-                if downloaded_bytes >= f_info['Size']:
-                    os.remove(temp_path)
-                    downloaded_bytes = 0
-                elif downloaded_bytes > 0:
-                    pct = downloaded_bytes / f_info['Size']
-                    self._update_thread_progress(sid, f_info['Var'], short_name, pct,
-                                             f"断点续传 {self.format_size(downloaded_bytes)}")
-
-            # Range请求（仅当需要断点续传时）
-            get_params = {
-                'Bucket': self.bucket_name,
-                'Key': f_info['Key']
-            }
-            if downloaded_bytes > 0:
-                get_params['Range'] = f"bytes={downloaded_bytes}-"
-
-            response = self.s3_client.get_object(**get_params)
-
-            mode = 'ab' if downloaded_bytes > 0 else 'wb'
-            last_update = time.time()
-
-            with open(temp_path, mode) as f:
-                for chunk in response['Body'].iter_chunks(chunk_size=self.chunk_size):
-                    f.write(chunk)
-                    downloaded_bytes += len(chunk)
-
-                    # 更新进度（每0.2秒更新一次，避免过于频繁）
-                    current_time = time.time()
-                    if current_time - last_update >= 5:
-                        pct = downloaded_bytes / f_info['Size']
-                        self._update_thread_progress(sid, f_info['Var'], short_name, pct, f"{int(pct*100)}%")
-                        last_update = current_time
-
-            # 验证并重命名
-            final_size = os.path.getsize(temp_path)
-            if final_size == f_info['Size']:
-                os.rename(temp_path, local_path)
-                self.update_progress(target_dir, f_info['Name'], completed=True)
-                self._update_thread_progress(sid, f_info['Var'], short_name, 1.0, "完成")
-            else:
-                raise FileIncompleteException(f"大小不匹配: {final_size} != {f_info['Size']}")
-
-        except Exception as e:
-            self._update_thread_progress(sid, "ERR", "失败", 0.0, f"{type(e).__name__}")
-            raise
-        finally:
-            # 清理进度（下载完成后）
-            with self.progress_lock:
-                if sid in self.thread_progress:
-                    del self.thread_progress[sid]
-            slot_queue.put(sid)
-
-    def _update_thread_progress(self, sid, var, name, pct, status):
-        """更新线程进度（线程安全）"""
-        with self.progress_lock:
-            self.thread_progress[sid] = {
-                'var': var,
-                'name': name,
-                'pct': pct,
-                'status': status
-            }
-
-    def monitor_progress(self, total_files):
-        """监控并打印实时进度（在独立线程中运行）"""
-        import sys
-        last_line_count = 0
-
-        while not self.stop_requested:
-            time.sleep(0.5)  # 每0.5秒更新一次
-
-            with self.progress_lock:
-                if not self.thread_progress:
-                    continue
-
-                # 构建进度显示
-                lines = []
-                lines.append(f"\n{'='*80}")
-                lines.append(f"实时下载进度 (活跃线程: {len(self.thread_progress)})")
-                lines.append(f"{'='*80}")
-
-                # 按线程ID排序显示
-                for sid in sorted(self.thread_progress.keys()):
-                    info = self.thread_progress[sid]
-                    var = info['var']
-                    name = info['name']
-                    pct = info['pct']
-                    status = info['status']
-
-                    # 构建进度条
-                    bar_width = 40
-                    filled = int(bar_width * pct)
-                    bar = '[' + '=' * filled + ' ' * (bar_width - filled) + ']'
-
-                    line = f"线程-{sid+1:2d} | [{var}] ...{name}\n"
-                    line += f"        {bar} {pct*100:5.1f}% | {status}"
-                    lines.append(line)
-
-                lines.append(f"{'='*80}\n")
-
-                # 清除之前的输出（仅保留最后一屏）
-                output = '\n'.join(lines)
-                print(output, end='', flush=True)
-
-            # 如果没有活跃线程，退出监控
-            with self.progress_lock:
-                if not self.thread_progress:
-                    break
-
-
-# 全局回调对象(用于进度更新)
 class CallbackWrapper:
     def __init__(self):
         self.done = 0
@@ -1125,23 +938,12 @@ cb = CallbackWrapper()
 
 # ================= 主程序入口 =================
 if __name__ == "__main__":
-    # 检查命令行参数
-    auto_mode = '--auto' in sys.argv or '-a' in sys.argv
-
-    if auto_mode:
-        # 自动模式：配置文件存在则直接下载
-        print("=" * 60)
-        print("ERA5 自动下载模式")
-        print("=" * 60)
-        downloader = AutoDownloader()
-        success = downloader.run()
-        if success:
-            print("[完成] 下载任务完成")
-            sys.exit(0)
-        else:
-            print("[失败] 配置文件不存在，请先运行GUI模式创建配置")
-            sys.exit(1)
-    else:
-        # GUI模式：正常显示界面
-        app = ERA5ResumeDownloadApp()
-        app.mainloop()
+    # 打包后的程序使用进程池需要
+    multiprocessing.freeze_support()
+
+    # 无界面模式(命令行任务、自动下载、缓存代理等)由 cli 处理，其余情况显示界面
+    code = main()
+    if code is not None:
+        sys.exit(code)
+    app = ERA5ResumeDownloadApp()
+    app.mainloop()
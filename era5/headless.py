@@ -0,0 +1,1111 @@
+"""无界面下载：自动模式、常驻同步、共享队列和命令行任务的执行者"""
+from boto3.s3.transfer import TransferConfig
+import os
+import threading
+import time
+import queue
+import json
+import signal
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from era5.progress import (
+    PROFILER, PROGRESS_EVENT_INTERVAL, format_progress, ProgressTracker, start_metrics_server)
+from era5.core import (
+    CONFIG_FILE, DEFAULT_DATASET, DEFAULT_DISK_RESERVE, DEFAULT_DNS_TTL, DEFAULT_FILE_ATTEMPTS,
+    DEFAULT_REQUEUE_DELAY, RETRY_THROTTLE, SYNC_STATE_FILE, create_rate_limiter, create_s3_client,
+    create_striper, default_retry_budget, DiskFullException, DiskPlanner, DownloadStoppedException,
+    FileIncompleteException, iter_month_files, list_month_files, list_published_months, parse_size,
+    PauseGate, RequeueTracker, RetryPolicy, store_failure_report, stream_object_to_file, stream_tasks,
+    TransferStats, wait_requeue_delay, warm_up_connections)
+from era5.scheduling import JOBS_POLL_INTERVAL, JOBS_SPOOL_DIR, create_file_scheduler, JobQueue, PriorityRules
+from era5.validate import verify_download
+from era5.subset import SUBSET_SUFFIX, subset_netcdf
+from era5.postprocess import create_post_processor
+from era5.zarr_output import create_zarr_ingestor, zarr_ingested_names
+from era5.content_store import create_content_store
+from era5.workqueue import WorkQueue
+from era5.plan import (
+    DEFAULT_LISTING_TTL, LISTING_CACHE_FILE, METRICS_DB, cached_list_month_files, historical_throughput,
+    reconcile_files)
+
+
+# ================= 无GUI自动下载类 =================
+class AutoDownloader:
+    """无GUI的自动下载器"""
+    def __init__(self):
+        self.bucket_name = 'nsf-ncar-era5'
+        self.s3_client = None
+        self.stop_requested = False
+        self.current_download_dir = None
+        self.max_retries = 6
+        self.retry_delay = 2
+        self.retry_policy = RetryPolicy(self.max_retries, self.retry_delay)
+        self.progress_file = ".era5_download_progress.json"
+        self.chunk_size = 8 * 1024 * 1024
+        self.failed_files = []
+        self.config = None
+        self.transfer_stats = TransferStats()
+        self.post_processor = None
+        self.content_store = None
+        self.striper = None
+        self.rate_limiter = None
+        self.pause_gate = PauseGate()  # SIGUSR1 暂停、SIGUSR2 继续
+        self.priority_rules = PriorityRules()  # 配置的 priorities 及运行中提交的紧急任务
+        self.preempt = threading.Event()  # 有更紧急的任务条目等待时置位，当前条目停止派发新文件
+        self.zarr_ingestor = None
+        self.on_event = None  # 机器可读事件的回调，命令行 --json 时输出为 JSON 行
+        self.progress = ProgressTracker()  # 速度与剩余时间估算，供终端面板、progress 事件和指标端点使用
+        self.metrics_server = None
+        self.results = []  # run() 中每个月的结果
+
+        # 实时进度监控
+        self.thread_progress = {}  # {slot_id: {'file': name, 'var': var, 'pct': 0.0-1.0, 'status': text}}
+        self.progress_lock = threading.Lock()
+        self.last_progress_print = 0
+
+    def load_config(self):
+        """加载配置文件"""
+        try:
+            if os.path.exists(CONFIG_FILE):
+                with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                    self.config = json.load(f)
+                print(f"[配置] 成功加载配置文件")
+                print(f"  日期: {self.config['date']}")
+                print(f"  路径: {self.config['local_root']}")
+                print(f"  线程: {self.config['thread_count']}")
+                print(f"  变量: {self.config['selected_vars'] if self.config['selected_vars'] else '全部'}")
+                return True
+            else:
+                print("[配置] 配置文件不存在，需要手动创建")
+                return False
+        except Exception as e:
+            print(f"[配置] 加载失败: {e}")
+            return False
+
+    def get_selected_vars(self):
+        if not self.config:
+            return []
+        return self.config.get('selected_vars', [])
+
+    def save_progress(self, target_dir, progress_data):
+        """保存下载进度"""
+        try:
+            progress_file = os.path.join(target_dir, self.progress_file)
+            with open(progress_file, 'w', encoding='utf-8') as f:
+                json.dump(progress_data, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            print(f"[进度] 保存失败: {e}")
+
+    def load_progress(self, target_dir):
+        """加载下载进度"""
+        try:
+            progress_file = os.path.join(target_dir, self.progress_file)
+            if os.path.exists(progress_file):
+                with open(progress_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+        except Exception as e:
+            print(f"[进度] 加载失败: {e}")
+        return None
+
+    def update_progress(self, target_dir, filename, completed=False):
+        """更新下载进度"""
+        progress_data = self.load_progress(target_dir)
+        if progress_data is None:
+            progress_data = {'completed': [], 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+        if completed and filename not in progress_data['completed']:
+            progress_data['completed'].append(filename)
+            progress_data.get('failed', {}).pop(filename, None)
+            self.save_progress(target_dir, progress_data)
+
+    def record_failures(self, target_dir, report):
+        """把最终失败文件的报告写入进度文件"""
+        progress_data = self.load_progress(target_dir)
+        if progress_data is None:
+            if not report:
+                return
+            progress_data = {'completed': [], 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+        self.save_progress(target_dir, store_failure_report(progress_data, report))
+        for name, info in sorted(report.items()):
+            print(f"[失败报告] {name}: 尝试 {info['attempts']} 次, {info['error']}")
+
+    def format_size(self, bytes_size):
+        """格式化文件大小"""
+        if bytes_size < 1024 * 1024:
+            return f"{bytes_size / 1024:.1f}KB"
+        else:
+            return f"{bytes_size / 1048576:.1f}MB"
+
+    def pending_filter(self, target_dir):
+        """返回判断文件是否尚需处理的函数：启用 Zarr 输出时以存储中的写入记录为准，否则以下载进度为准"""
+        store_root = self.config.get('zarr_store')
+        if store_root:
+            done = {}
+
+            def is_pending(f):
+                if f['Var'] not in done:
+                    done[f['Var']] = zarr_ingested_names(store_root, f['Var'])
+                return f['Name'] not in done[f['Var']]
+            return is_pending
+        progress_data = self.load_progress(target_dir) or {}
+        completed = set(progress_data.get('completed', []))
+        return lambda f: f['Name'] not in completed
+
+    def pending_files(self, files, target_dir):
+        """返回尚需处理的文件"""
+        is_pending = self.pending_filter(target_dir)
+        return [f for f in files if is_pending(f)]
+
+    def _hand_off(self, local_path, target_dir, f_info):
+        """把落盘完成的文件交给后处理和 Zarr 写入"""
+        if self.post_processor:
+            self.post_processor.submit(local_path, target_dir)
+        if self.zarr_ingestor:
+            self.zarr_ingestor.submit(local_path, f_info)
+
+    def download_files(self, files, target_dir, max_workers):
+        """并发下载一组文件，返回 (成功数, 失败数, 耗时秒)，失败数含因空间不足推迟的文件
+
+        files 可以是边列举边产生的生成器：每到一个文件就经过磁盘空间规划进入有界队列，
+        不必等列举结束；下载结果按完成顺序处理。
+        """
+        slot_queue = queue.Queue()
+        for i in range(max_workers):
+            slot_queue.put(i)
+
+        transfer_cfg = TransferConfig(use_threads=False)
+        # 配置了 subset 时只按块取回所需数据
+        subset = bool(self.config and self.config.get('subset'))
+        worker = self.subset_one if subset else self.download_one
+        self.content_store = create_content_store(self.config)
+
+        self.post_processor = create_post_processor(self.config)
+        self.zarr_ingestor = create_zarr_ingestor(self.config)
+
+        # 子集文件大小无法预估，不做空间规划
+        reserve = parse_size(self.config.get('disk_reserve', DEFAULT_DISK_RESERVE))
+        planner = None if subset else DiskPlanner(target_dir, reserve, self.content_store)
+        deferred = []
+        queued = [0]
+
+        def admitted(items):
+            # 在生产线程中运行：按剩余空间接纳文件，并登记 Zarr 的写入顺序
+            for f_info in items:
+                if planner is not None and not planner.admit(f_info):
+                    deferred.append(f_info)
+                    continue
+                if self.zarr_ingestor:
+                    self.zarr_ingestor.expect([f_info])
+                if not subset:
+                    self.progress.expect(f_info['Size'])
+                queued[0] += 1
+                if auto_budget:
+                    tracker.budget.grow_to(queued[0])
+                yield f_info
+            if planner is not None:
+                print(f"[磁盘] 需要 {planner.total_need / 1073741824:.1f} GB, "
+                      f"可用 {planner.free / 1073741824:.1f} GB (保留 {reserve / 1073741824:.1f} GB)")
+
+        # 开始调度前并发建好连接，首批文件不必排队握手
+        if self.config.get('warm_up', True):
+            warmed, seconds = warm_up_connections(self.s3_client, self.bucket_name, max_workers)
+            print(f"[连接] 预热 {warmed} 个连接，用时 {seconds:.2f} 秒")
+
+        completed_count = 0
+        failed_count = 0
+        stopped_count = 0
+        start_time = time.time()
+        disk_full = threading.Event()
+        should_stop = lambda: self.stop_requested or disk_full.is_set()
+        # 被抢占时只停止派发，正在下载的文件照常完成
+        stop_dispatch = lambda: should_stop() or self.preempt.is_set()
+
+        # 失败的文件排到队尾，整轮结束后再补下，重试次数受全局预算限制
+        tracker = RequeueTracker(self.config.get('file_attempts', DEFAULT_FILE_ATTEMPTS),
+                                 default_retry_budget(self.config, 0))
+        self.retry_policy.budget = tracker.budget
+        auto_budget = 'retry_budget' not in self.config
+
+        def run_one(f_info):
+            tracker.started(f_info['Name'])
+            worker(f_info, target_dir, transfer_cfg, slot_queue, should_stop)
+
+        def settle(f_info):
+            # 文件结束(完成、最终失败或让出)，移出剩余时间估算的清单
+            if not subset:
+                self.progress.finish(f_info['Size'])
+
+        # 启动速度采样和进度监控线程
+        sampling = self._start_sampler()
+        progress_monitor = threading.Thread(target=self.monitor_progress, daemon=True)
+        progress_monitor.start()
+
+        pending = admitted(files)
+        round_no = 0
+        listing_error = None
+        while not stop_dispatch():
+            if round_no > 0:
+                if not pending:
+                    break
+                print(f"[重试] 第 {round_no} 轮补下 {len(pending)} 个失败文件 "
+                      f"(剩余重试预算 {tracker.budget.remaining})")
+                if not wait_requeue_delay(self.config.get('requeue_delay', DEFAULT_REQUEUE_DELAY), stop_dispatch):
+                    break
+
+            requeue = []
+            try:
+                for f_info, error in stream_tasks(pending, run_one, max_workers, stop_dispatch,
+                                                  scheduler=create_file_scheduler(self.config, self.priority_rules)):
+                    if isinstance(error, DownloadStoppedException):
+                        # 停止时没下完的文件保留临时文件，下次运行续传，不记为失败；
+                        # 被抢占时还在排队的文件在条目重新运行时再下载
+                        settle(f_info)
+                        if not self.preempt.is_set() or should_stop():
+                            stopped_count += 1
+                            self._emit('file', name=f_info['Name'], status='stopped')
+                        continue
+                    if error is None:
+                        completed_count += 1
+                        settle(f_info)
+                        tracker.succeeded(f_info['Name'])
+                        self._emit('file', name=f_info['Name'], status='done', size=f_info['Size'],
+                                   completed=completed_count, total=queued[0])
+
+                        # 进度输出
+                        if completed_count % 10 == 0:
+                            elapsed = time.time() - start_time
+                            speed = (completed_count * 60) / elapsed if elapsed > 0 else 0
+                            print(f"[进度] {completed_count}/{queued[0]} | "
+                                  f"耗时: {elapsed:.1f}秒 | {speed:.1f} 文件/分钟 | "
+                                  f"{format_progress(self.progress.latest)}")
+
+                    elif isinstance(error, DiskFullException):
+                        failed_count += 1
+                        settle(f_info)
+                        tracker.failed(f_info['Name'], error)
+                        self._emit('file', name=f_info['Name'], status='failed', error=str(error))
+                        if not disk_full.is_set():
+                            disk_full.set()
+                            print(f"[磁盘] {error}")
+                            print("[磁盘] 已暂停剩余下载，释放空间后重新运行会从断点继续")
+                    elif tracker.failed(f_info['Name'], error) and not should_stop():
+                        requeue.append(f_info)
+                        print(f"[重试] {f_info['Name']}: {error}，排到队尾稍后重试")
+                        self._emit('file', name=f_info['Name'], status='requeued', error=str(error))
+                    else:
+                        failed_count += 1
+                        settle(f_info)
+                        print(f"[错误] {f_info['Name']}: {error}")
+                        self._emit('file', name=f_info['Name'], status='failed', error=str(error))
+            except Exception as e:
+                # 列举中途出错：已领取的文件都已处理完，先收尾再抛出
+                listing_error = e
+                pending = requeue
+                break
+            pending = requeue
+            round_no += 1
+
+        # 停止时还在等待补下的文件(被抢占时留到条目重新运行)
+        sampling.set()
+        preempted = self.preempt.is_set() and not should_stop()
+        if isinstance(pending, list):
+            for f_info in pending:
+                settle(f_info)
+        if isinstance(pending, list) and not preempted:
+            reason = "列举出错，未重试" if listing_error is not None else "已停止，未重试"
+            for f_info in pending:
+                tracker.skipped(f_info['Name'], reason)
+            failed_count += len(pending)
+        if stopped_count:
+            print(f"[停止] {stopped_count} 个文件未下载完，重新运行时从断点继续")
+        # 放不下的文件记为失败，释放空间后重新运行继续
+        if deferred:
+            print(f"[磁盘] 空间不足，推迟 {len(deferred)} 个文件 "
+                  f"(还差 {(planner.total_need - planner.free) / 1073741824:.1f} GB)，释放空间后重新运行继续")
+            for f_info in deferred:
+                tracker.skipped(f_info['Name'], "磁盘空间不足，本次未下载")
+            failed_count += len(deferred)
+        self.record_failures(target_dir, tracker.report())
+
+        if self.post_processor:
+            print("[后处理] 下载结束，等待后处理完成...")
+            pp_done, pp_failed = self.post_processor.close()
+            self.post_processor = None
+            print(f"[后处理] 完成 {pp_done} 个, 失败 {pp_failed} 个")
+
+        if self.zarr_ingestor:
+            print("[Zarr] 下载结束，等待写入完成...")
+            z_done, z_failed, z_waiting = self.zarr_ingestor.close()
+            self.zarr_ingestor = None
+            print(f"[Zarr] 写入 {z_done} 个, 失败 {z_failed} 个, 等待前序文件 {z_waiting} 个")
+
+        if self.striper:
+            for line in self.striper.summary_lines():
+                print(f"[分流] {line}")
+
+        if listing_error is not None:
+            raise listing_error
+        return completed_count, failed_count, time.time() - start_time
+
+    def run(self, config=None):
+        """执行自动下载；config 为空时读取 GUI 保存的配置文件
+
+        config 中的 months 给出多个月份时逐月下载，dry_run 为真时只列出计划不下载。
+        """
+        if config is not None:
+            self.config = config
+        elif not self.load_config():
+            return False
+
+        months = self.config.get('months') or [self.config['date']]
+        local_root = self.config['local_root']
+        max_workers = self.config['thread_count']
+        dry_run = self.config.get('dry_run', False)
+
+        print(f"\n{'='*60}")
+        print(f"ERA5 自动下载启动" + (" (仅列出计划)" if dry_run else ""))
+        print(f"{'='*60}")
+        print(f"开始时间: {time.strftime('%Y-%m-%d %H:%M:%S')}")
+        print(f"目标日期: {', '.join(months)}")
+        print(f"数据集: {self.config.get('dataset', DEFAULT_DATASET)}")
+        print(f"保存目录: {local_root}")
+        print(f"并发线程: {max_workers}")
+        if self.config.get('max_rate'):
+            print(f"带宽上限: {self.config['max_rate']}/s")
+        print(f"{'='*60}\n")
+
+        self.results = []
+        self.install_pause_signals()
+        done = threading.Event()
+        if self.config.get('profile'):
+            PROFILER.start(self.config.get('profile_interval'))
+            print("[剖析] 已开启，结束时写出折叠栈和分段汇总")
+        try:
+            # 每个月份是一个任务条目，按优先级/截止时间排序；运行中可向提交目录追加紧急任务
+            wanted_vars = self.get_selected_vars()
+            jobs = JobQueue.from_config(self.config)
+            self.priority_rules = jobs.rules
+            for date_str in months:
+                jobs.add(date_str, wanted_vars)
+            spool_dir = os.path.join(local_root, JOBS_SPOOL_DIR)
+            current = {'entry': None, 'start': 0.0}
+            current_lock = threading.Lock()
+
+            # S3配置
+            self.s3_client = create_s3_client(max_workers, self.config.get('cache_endpoint'),
+                                              self.config.get('dns_ttl', DEFAULT_DNS_TTL))
+            self.striper = create_striper(self.config, max_workers)
+            self.rate_limiter = create_rate_limiter(self.config)
+            if self.metrics_server is None:
+                self.metrics_server = start_metrics_server(self.config, lambda: self.progress.latest)
+            if not dry_run:
+                threading.Thread(target=self._watch_jobs,
+                                 args=(jobs, spool_dir, wanted_vars, current, current_lock, done),
+                                 daemon=True).start()
+
+            while not self.stop_requested:
+                if not dry_run:
+                    self._announce_jobs(jobs.poll(spool_dir, wanted_vars))
+                entry = jobs.pop()
+                if entry is None:
+                    break
+                with current_lock:
+                    self.preempt.clear()
+                    current.update(entry=entry, start=time.time())
+                if entry['runs']:
+                    print(f"[调度] 继续被抢占的任务: {entry['month']}")
+                entry['runs'] += 1
+                result = self.run_month(entry['month'], max_workers, dry_run, entry['vars'])
+                with current_lock:
+                    current['entry'] = None
+                jobs.record(entry, time.time() - current['start'])
+
+                # 被抢占过的条目：合计各段的完成数和耗时，待下载数以第一次列举为准
+                first = entry.get('result')
+                if first is not None:
+                    result.update(pending=first['pending'], pending_bytes=first['pending_bytes'],
+                                  completed=first['completed'] + result['completed'],
+                                  seconds=round(first['seconds'] + result['seconds'], 1))
+                if result.pop('preempted', False):
+                    entry['result'] = result
+                    jobs.requeue(entry)
+                    self._emit('preempted', month=entry['month'], completed=result['completed'])
+                    continue
+
+                result['priority'] = entry['priority']
+                if entry['deadline'] is not None:
+                    result['deadline'] = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['deadline']))
+                    if not dry_run and time.time() > entry['deadline']:
+                        print(f"[调度] {entry['month']} 晚于截止时间 {result['deadline']} 完成")
+                        result['deadline_missed'] = True
+                self.results.append(result)
+                self._emit('month', **result)
+            return True
+
+        except Exception as e:
+            print(f"[错误] 下载失败: {e}")
+            traceback.print_exc()
+            self._emit('error', error=f"{type(e).__name__}: {e}")
+            return False
+        finally:
+            done.set()
+            if PROFILER.enabled:
+                self.dump_profile(local_root)
+
+    def dump_profile(self, out_dir):
+        """停止剖析，打印分段汇总并写出结果文件"""
+        PROFILER.stop()
+        for line in PROFILER.summary_lines():
+            print(f"[剖析] {line}")
+        try:
+            collapsed, summary = PROFILER.dump(out_dir)
+            print(f"[剖析] 折叠栈: {collapsed}")
+            print(f"[剖析] 汇总: {summary}")
+        except OSError as e:
+            print(f"[剖析] 保存结果失败: {e}")
+
+    def _announce_jobs(self, entries):
+        for entry in entries:
+            deadline = entry['deadline']
+            print(f"[调度] 收到任务: {entry['month']} 变量 {entry['vars'] or '全部'} 优先级 {entry['priority']}"
+                  + (f" 截止 {time.strftime('%Y-%m-%d %H:%M', time.localtime(deadline))}" if deadline else ""))
+            self._emit('job', month=entry['month'], vars=entry['vars'], priority=entry['priority'],
+                       deadline=deadline)
+
+    def _watch_jobs(self, jobs, spool_dir, default_vars, current, current_lock, done):
+        """后台读取新提交的任务；有比当前条目更紧急的条目等待时置位抢占标志"""
+        while not done.wait(JOBS_POLL_INTERVAL):
+            self._announce_jobs(jobs.poll(spool_dir, default_vars))
+            with current_lock:
+                running = current['entry']
+                if running is None or self.preempt.is_set():
+                    continue
+                urgent = jobs.preemptor(running, time.time() - current['start'])
+                if urgent is not None:
+                    print(f"[调度] {urgent['month']} (优先级 {urgent['priority']}) 抢占 {running['month']}，"
+                          f"正在下载的文件完成后切换")
+                    self.preempt.set()
+
+    def run_month(self, date_str, max_workers, dry_run=False, wanted_vars=None):
+        """下载(或只规划)一个月的文件，返回结果字典；被更紧急的任务抢占时结果中 preempted 为真
+
+        下载时边列举边下载：第一页列举结果取回后即开始下载，不必等整月列举完成。
+        wanted_vars 为 None 时使用配置中选择的变量。
+        """
+        if wanted_vars is None:
+            wanted_vars = self.get_selected_vars()
+        print(f"[扫描] 正在扫描 S3 存储桶: {date_str}")
+        print(f"[扫描] 目标变量: {wanted_vars if wanted_vars else '全部'}\n")
+
+        listing = iter_month_files(self.s3_client, self.bucket_name, date_str, wanted_vars,
+                                   self.config.get('dataset', DEFAULT_DATASET))
+        target_dir = os.path.join(self.config['local_root'], date_str)
+        result = {'month': date_str, 'target_dir': target_dir, 'files': 0, 'bytes': 0,
+                  'pending': 0, 'pending_bytes': 0, 'completed': 0, 'failed': 0, 'seconds': 0.0}
+
+        if dry_run:
+            files_to_download = list(listing)
+            remaining_files = self.pending_files(files_to_download, target_dir)
+            result.update(files=len(files_to_download), bytes=sum(f['Size'] for f in files_to_download),
+                          pending=len(remaining_files), pending_bytes=sum(f['Size'] for f in remaining_files))
+            print(f"[计划] {date_str}: 共 {len(files_to_download)} 个文件 "
+                  f"({result['bytes'] / 1073741824:.1f} GB)，待下载 {len(remaining_files)} 个 "
+                  f"({result['pending_bytes'] / 1073741824:.1f} GB)")
+            for f_info in remaining_files:
+                print(f"  {f_info['Name']}  {self.format_size(f_info['Size'])}")
+            return result
+
+        created = not os.path.exists(target_dir)
+        if created: os.makedirs(target_dir)
+        self.current_download_dir = target_dir
+        is_pending = self.pending_filter(target_dir)
+
+        def remaining():
+            # 在生产线程中运行，统计列举结果并跳过已完成的文件
+            for f_info in listing:
+                result['files'] += 1
+                result['bytes'] += f_info['Size']
+                if is_pending(f_info):
+                    result['pending'] += 1
+                    result['pending_bytes'] += f_info['Size']
+                    yield f_info
+            print(f"[扫描] 列举完成: 共 {result['files']} 个文件，"
+                  f"已完成 {result['files'] - result['pending']}，待下载 {result['pending']}")
+
+        # 开始下载
+        self.transfer_stats = TransferStats()
+        completed_count, failed_count, elapsed = self.download_files(remaining(), target_dir, max_workers)
+        result.update(completed=completed_count, failed=failed_count, seconds=round(elapsed, 1))
+
+        if self.preempt.is_set() and not self.stop_requested:
+            print(f"[调度] {date_str} 已暂停派发 (本段完成 {completed_count} 个文件)，稍后从断点继续")
+            result['preempted'] = True
+            return result
+
+        if not result['files']:
+            print(f"[结果] 未找到匹配的文件!")
+            if created:
+                try:
+                    os.rmdir(target_dir)
+                except OSError:
+                    pass
+            return result
+
+        if not result['pending']:
+            print(f"[进度] 所有文件已下载完成!")
+            print(f"[结果] 保存位置: {target_dir}")
+            return result
+
+        # 结果统计
+        print(f"\n{'='*60}")
+        print(f"下载完成!")
+        print(f"{'='*60}")
+        print(f"成功: {completed_count} 个文件")
+        print(f"失败: {failed_count} 个文件")
+        print(f"耗时: {elapsed/60:.1f} 分钟")
+        print(f"平均速度: {(completed_count*60)/elapsed if elapsed > 0 else 0:.1f} 文件/分钟")
+        print(f"保存位置: {target_dir}")
+        print(f"完成时间: {time.strftime('%Y-%m-%d %H:%M:%S')}")
+        print(f"{'='*60}\n")
+
+        summary = self.transfer_stats.summary_lines()
+        if summary:
+            print("[传输统计] 各阶段耗时")
+            for line in summary:
+                print(f"  {line}")
+        self.transfer_stats.save(target_dir)
+        return result
+
+    def plan(self, config, refresh=False):
+        """估算任务：列举(带缓存)各月文件并与本地状态核对，按月份/变量汇总，结合历史吞吐估算耗时"""
+        self.config = config
+        dataset = config.get('dataset', DEFAULT_DATASET)
+        local_root = config['local_root']
+        wanted_vars = self.get_selected_vars()
+        store = create_content_store(config)
+        cache_path = os.path.join(local_root, LISTING_CACHE_FILE)
+        if not os.path.isdir(local_root):
+            os.makedirs(local_root)
+
+        self.s3_client = create_s3_client(config['thread_count'], config.get('cache_endpoint'),
+                                          config.get('dns_ttl', DEFAULT_DNS_TTL))
+        months = []
+        for date_str in config['months']:
+            files = cached_list_month_files(self.s3_client, self.bucket_name, date_str, wanted_vars, dataset,
+                                            cache_path, config.get('listing_ttl', DEFAULT_LISTING_TTL), refresh)
+            target_dir = os.path.join(local_root, date_str)
+            completed = {f['Name'] for f in files} - {f['Name'] for f in self.pending_files(files, target_dir)}
+            by_var = {}
+            for f_info, state, need in reconcile_files(files, target_dir, completed, store):
+                v = by_var.setdefault(f_info['Var'], {'files': 0, 'bytes': 0, 'done': 0, 'linked': 0,
+                                                      'transfer_files': 0, 'transfer_bytes': 0})
+                v['files'] += 1
+                v['bytes'] += f_info['Size']
+                if state in ('done', 'linked'):
+                    v[state] += 1
+                else:
+                    v['transfer_files'] += 1
+                    v['transfer_bytes'] += need
+            months.append({'month': date_str, 'vars': by_var})
+
+        # 以历史吞吐中位数估算；设置了带宽上限时不超过上限，没有历史数据时按上限估算
+        rate, samples = historical_throughput(config.get('metrics_db', METRICS_DB))
+        source = 'metrics' if rate else None
+        if config.get('max_rate'):
+            cap = parse_size(config['max_rate'])
+            if not rate or cap < rate:
+                rate, source = cap, 'max_rate'
+        transfer_bytes = sum(v['transfer_bytes'] for m in months for v in m['vars'].values())
+        return {'dataset': dataset, 'months': months,
+                'files': sum(v['files'] for m in months for v in m['vars'].values()),
+                'bytes': sum(v['bytes'] for m in months for v in m['vars'].values()),
+                'transfer_files': sum(v['transfer_files'] for m in months for v in m['vars'].values()),
+                'transfer_bytes': transfer_bytes,
+                'throughput': rate, 'throughput_source': source, 'throughput_samples': samples,
+                'eta_seconds': round(transfer_bytes / rate) if rate else None}
+
+    def install_pause_signals(self):
+        """SIGUSR1 暂停、SIGUSR2 继续(仅 POSIX 且在主线程时可用)
+
+        暂停时正在下载的文件把已写入的数据刷到磁盘后等待，连接池保留，继续后立即恢复传输。
+        """
+        if not hasattr(signal, 'SIGUSR1') or threading.current_thread() is not threading.main_thread():
+            return
+
+        def on_pause(signum, frame):
+            self.pause_gate.pause()
+            print(f"\n[暂停] 收到信号 {signum}，已下载数据写入磁盘后暂停，发送 SIGUSR2 继续")
+            self._emit('paused')
+
+        def on_resume(signum, frame):
+            self.pause_gate.resume()
+            print(f"\n[暂停] 收到信号 {signum}，继续下载")
+            self._emit('resumed')
+
+        signal.signal(signal.SIGUSR1, on_pause)
+        signal.signal(signal.SIGUSR2, on_resume)
+
+    def _emit(self, event, **fields):
+        """向 on_event 回调发送一条机器可读的事件"""
+        if self.on_event is not None:
+            self.on_event(dict(event=event, time=time.strftime('%Y-%m-%dT%H:%M:%S'), **fields))
+
+    def run_daemon(self, interval=3600):
+        """常驻同步模式：周期检查新发布的月份和文件，只下载增量
+
+        S3 客户端(连接池)和同步状态在各轮之间复用；已有更新月份发布且已下载完整的月份
+        视为定稿，之后不再重新列举。
+        """
+        if not self.load_config():
+            return False
+
+        local_root = self.config['local_root']
+        max_workers = self.config['thread_count']
+        start_month = self.config.get('sync_start', self.config['date'])
+        wanted_vars = self.get_selected_vars()
+        dataset = self.config.get('dataset', DEFAULT_DATASET)
+        self.priority_rules = PriorityRules.from_config(self.config)
+
+        wake = threading.Event()
+
+        def on_signal(signum, frame):
+            print(f"\n[同步] 收到信号 {signum}，当前文件写完临时数据后退出")
+            self.stop_requested = True
+            wake.set()
+
+        signal.signal(signal.SIGINT, on_signal)
+        if hasattr(signal, 'SIGTERM'):
+            signal.signal(signal.SIGTERM, on_signal)
+        self.install_pause_signals()
+
+        state = self._load_sync_state(local_root)
+        if state.get('vars') != sorted(wanted_vars):
+            # 变量选择变化后，已定稿的月份需要重新核对
+            state = {'vars': sorted(wanted_vars), 'months': {}}
+
+        print(f"\n{'='*60}")
+        print(f"ERA5 常驻同步启动")
+        print(f"{'='*60}")
+        print(f"起始月份: {start_month}")
+        print(f"保存目录: {local_root}")
+        print(f"检查间隔: {interval} 秒")
+        print(f"{'='*60}\n")
+
+        self.s3_client = create_s3_client(max_workers, self.config.get('cache_endpoint'),
+                                          self.config.get('dns_ttl', DEFAULT_DNS_TTL))
+        self.striper = create_striper(self.config, max_workers)
+        self.rate_limiter = create_rate_limiter(self.config)
+        if self.metrics_server is None:
+            self.metrics_server = start_metrics_server(self.config, lambda: self.progress.latest)
+        cycle = 0
+        while not self.stop_requested:
+            cycle += 1
+            cycle_start = time.time()
+            downloaded = failed = 0
+            try:
+                months = [m for m in list_published_months(self.s3_client, self.bucket_name, dataset)
+                          if m >= start_month]
+                latest = months[-1] if months else None
+                for month in months:
+                    if self.stop_requested:
+                        break
+                    info = state['months'].setdefault(month, {'final': False})
+                    if info['final']:
+                        continue
+
+                    files = list_month_files(self.s3_client, self.bucket_name, month, wanted_vars, dataset)
+                    target_dir = os.path.join(local_root, month)
+                    os.makedirs(target_dir, exist_ok=True)
+                    delta = self.pending_files(files, target_dir)
+
+                    month_failed = 0
+                    if delta:
+                        print(f"[同步] {month}: 发现 {len(delta)} 个新文件")
+                        done, month_failed, _ = self.download_files(delta, target_dir, max_workers)
+                        downloaded += done
+                        failed += month_failed
+
+                    info.update({'files': len(files), 'bytes': sum(f['Size'] for f in files),
+                                 'checked': time.strftime('%Y-%m-%d %H:%M:%S')})
+                    if month != latest and month_failed == 0 and not self.stop_requested:
+                        info['final'] = True
+                self._save_sync_state(local_root, state)
+            except Exception as e:
+                print(f"[同步] 第 {cycle} 轮失败: {e}")
+                traceback.print_exc()
+
+            print(f"[同步] 第 {cycle} 轮结束: 新下载 {downloaded} 个, 失败 {failed} 个, "
+                  f"耗时 {time.time() - cycle_start:.1f} 秒, 下次检查 {interval} 秒后")
+            wake.wait(interval)
+
+        print("[同步] 已退出")
+        return True
+
+    def _load_sync_state(self, local_root):
+        try:
+            with open(os.path.join(local_root, SYNC_STATE_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'vars': None, 'months': {}}
+
+    def _save_sync_state(self, local_root, state):
+        try:
+            os.makedirs(local_root, exist_ok=True)
+            with open(os.path.join(local_root, SYNC_STATE_FILE), 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            print(f"[同步] 保存状态失败: {e}")
+
+    def run_queue(self, queue_path, node_id=None):
+        """多节点模式：把当月文件登记到共享队列，再按租约领取下载"""
+        if not self.load_config():
+            return False
+
+        date_str = self.config['date']
+        local_root = self.config['local_root']
+        max_workers = self.config['thread_count']
+        work_queue = WorkQueue(queue_path, node_id=node_id, max_attempts=self.max_retries)
+
+        print(f"\n{'='*60}")
+        print(f"ERA5 多节点队列下载启动")
+        print(f"{'='*60}")
+        print(f"节点标识: {work_queue.node_id}")
+        print(f"任务队列: {queue_path}")
+        print(f"保存目录: {local_root}")
+        print(f"并发线程: {max_workers}")
+        print(f"{'='*60}\n")
+
+        try:
+            self.s3_client = create_s3_client(max_workers, self.config.get('cache_endpoint'),
+                                              self.config.get('dns_ttl', DEFAULT_DNS_TTL))
+            self.striper = create_striper(self.config, max_workers)
+            self.rate_limiter = create_rate_limiter(self.config)
+            if self.metrics_server is None:
+                self.metrics_server = start_metrics_server(self.config, lambda: self.progress.latest)
+            files = list_month_files(self.s3_client, self.bucket_name, date_str, self.get_selected_vars(),
+                                     self.config.get('dataset', DEFAULT_DATASET))
+            added = work_queue.seed(date_str, files)
+            print(f"[队列] {date_str} 共 {len(files)} 个文件，新登记 {added} 个")
+        except Exception as e:
+            print(f"[错误] 登记任务失败: {e}")
+            traceback.print_exc()
+            return False
+
+        held = set()  # 本节点正在下载的键
+        lost = set()  # 租约已被其他节点接管的键
+        held_lock = threading.Lock()
+        finished = threading.Event()
+        counts = {'done': 0, 'failed': 0}
+
+        def heartbeat():
+            while not finished.wait(work_queue.lease_seconds / 3):
+                with held_lock:
+                    keys = list(held)
+                try:
+                    lost_now = work_queue.renew(keys)
+                except Exception as e:
+                    print(f"[队列] 续租失败: {e}")
+                    continue
+                if lost_now:
+                    with held_lock:
+                        lost.update(lost_now)
+
+        def worker(sid):
+            slot_queue = queue.Queue()
+            slot_queue.put(sid)
+            while not self.stop_requested:
+                items = work_queue.claim(1)
+                if not items:
+                    # 其他节点仍持有租约时等待，租约过期后由本节点接管
+                    by_date, by_owner = work_queue.status()
+                    if not by_owner and not any('stale' in states for states in by_date.values()):
+                        return
+                    time.sleep(min(30, work_queue.lease_seconds / 4))
+                    continue
+
+                f_info = items[0]
+                key = f_info['Key']
+                target_dir = os.path.join(local_root, f_info['Date'])
+                os.makedirs(target_dir, exist_ok=True)
+                with held_lock:
+                    held.add(key)
+                try:
+                    self.download_one(f_info, target_dir, None, slot_queue,
+                                      should_stop=lambda: self.stop_requested or key in lost)
+                    work_queue.complete(key)
+                    with held_lock:
+                        counts['done'] += 1
+                except DownloadStoppedException:
+                    if key not in lost:
+                        work_queue.release([key])
+                except Exception as e:
+                    work_queue.fail(key, f"{type(e).__name__}: {e}")
+                    with held_lock:
+                        counts['failed'] += 1
+                    print(f"[错误] {f_info['Name']}: {e}")
+                finally:
+                    with held_lock:
+                        held.discard(key)
+                        lost.discard(key)
+
+        start_time = time.time()
+        self.post_processor = create_post_processor(self.config)
+        threading.Thread(target=heartbeat, daemon=True).start()
+        sampling = self._start_sampler()
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for future in [executor.submit(worker, sid) for sid in range(max_workers)]:
+                    future.result()
+        finally:
+            finished.set()
+            sampling.set()
+            if self.post_processor:
+                pp_done, pp_failed = self.post_processor.close()
+                self.post_processor = None
+                print(f"[后处理] 完成 {pp_done} 个, 失败 {pp_failed} 个")
+
+        if self.striper:
+            for line in self.striper.summary_lines():
+                print(f"[分流] {line}")
+
+        elapsed = time.time() - start_time
+        print(f"\n[队列] 本节点完成 {counts['done']} 个，失败 {counts['failed']} 个，耗时 {elapsed/60:.1f} 分钟")
+        print_queue_status(work_queue)
+        return True
+
+    def download_one(self, f_info, target_dir, cfg, slot_queue, should_stop=None):
+        """下载单个文件（支持实时进度更新）"""
+        self.pause_gate.wait(should_stop)  # 暂停期间不开始新文件
+        sid = slot_queue.get()
+        local_path = os.path.join(target_dir, f_info['Name'])
+        temp_path = local_path + ".tmp"
+        short_name = f_info['Name'][-25:]  # 文件名后25个字符
+
+        try:
+            # 更新状态：开始
+            self._update_thread_progress(sid, f_info['Var'], short_name, 0.0, "开始下载...")
+
+            # 检查本地文件
+            if os.path.exists(local_path):
+                local_size = os.path.getsize(local_path)
+                if local_size == f_info['Size']:
+                    self._update_thread_progress(sid, f_info['Var'], short_name, 1.0, "已存在")
+                    if self.zarr_ingestor:
+                        self.zarr_ingestor.submit(local_path, f_info)
+                    return  # 已存在
+
+            # 共享存储中已有同一文件时只建链接
+            if self.content_store:
+                method = self.content_store.link_into(f_info, local_path)
+                if method:
+                    self.update_progress(target_dir, f_info['Name'], completed=True)
+                    self._update_thread_progress(sid, f_info['Var'], short_name, 1.0, f"已链接({method})")
+                    self._hand_off(local_path, target_dir, f_info)
+                    return
+
+            # 断点续传
+            downloaded_bytes = 0
+            if os.path.exists(temp_path):
+                downloaded_bytes = os.path.getsize(temp_path)
+                if downloaded_bytes >= f_info['Size']:
+                    os.remove(temp_path)
+                    downloaded_bytes = 0
+                elif downloaded_bytes > 0:
+                    pct = downloaded_bytes / f_info['Size']
+                    self._update_thread_progress(sid, f_info['Var'], short_name, pct,
+                                             f"断点续传 {self.format_size(downloaded_bytes)}")
+
+            last_update = time.time()
+
+            def on_chunk(n, downloaded):
+                # 更新进度（每5秒更新一次，避免过于频繁）
+                nonlocal last_update
+                self.progress.add(sid, n)
+                current_time = time.time()
+                if current_time - last_update >= 5:
+                    pct = downloaded / f_info['Size']
+                    self._update_thread_progress(sid, f_info['Var'], short_name, pct, f"{int(pct*100)}%")
+                    last_update = current_time
+
+            # Range请求（仅当需要断点续传时）
+            def attempt(retry):
+                # 每次尝试从临时文件当前大小续传
+                start = os.path.getsize(temp_path) if retry > 0 and os.path.exists(temp_path) else downloaded_bytes
+                if start >= f_info['Size']:
+                    # 文件已经下载完成
+                    return
+                self.progress.begin(sid, start)
+
+                def fetch(client):
+                    return stream_object_to_file(client, self.bucket_name, f_info, temp_path, start,
+                                                 self.chunk_size, on_chunk=on_chunk, should_stop=should_stop,
+                                                 stats=self.transfer_stats, attempt=retry,
+                                                 limiter=self.rate_limiter, gate=self.pause_gate) - start
+
+                if self.striper:
+                    self.striper.run(fetch)
+                else:
+                    fetch(self.s3_client)
+
+            def on_retry(retry, kind, delay, error):
+                pct = os.path.getsize(temp_path) / f_info['Size'] if os.path.exists(temp_path) else 0.0
+                reason = "限流" if kind == RETRY_THROTTLE else "网络错误"
+                self._update_thread_progress(sid, f_info['Var'], short_name, pct,
+                                             f"{reason} {delay:.0f}秒后重试({retry + 1})")
+
+            self.retry_policy.run(attempt, should_stop, on_retry)
+
+            # 验证并重命名
+            final_size = os.path.getsize(temp_path)
+            if final_size == f_info['Size']:
+                verify_download(temp_path)
+                os.rename(temp_path, local_path)
+                if self.content_store:
+                    self.content_store.adopt(local_path, f_info)
+                self.update_progress(target_dir, f_info['Name'], completed=True)
+                self._update_thread_progress(sid, f_info['Var'], short_name, 1.0, "完成")
+                self._hand_off(local_path, target_dir, f_info)
+            else:
+                raise FileIncompleteException(f"大小不匹配: {final_size} != {f_info['Size']}")
+
+        except Exception as e:
+            self._update_thread_progress(sid, "ERR", "失败", 0.0, f"{type(e).__name__}")
+            raise
+        finally:
+            # 清理进度（下载完成后）
+            with self.progress_lock:
+                if sid in self.thread_progress:
+                    del self.thread_progress[sid]
+            self.progress.end(sid)
+            slot_queue.put(sid)
+
+    def subset_one(self, f_info, target_dir, cfg, slot_queue, should_stop=None):
+        """按配置的气压层/区域/时间只下载子集，写出 *.subset.nc"""
+        self.pause_gate.wait(should_stop)
+        sid = slot_queue.get()
+        subset = self.config['subset']
+        local_path = os.path.join(target_dir, f_info['Name'][:-len('.nc')] + SUBSET_SUFFIX)
+        temp_path = local_path + ".tmp"
+        short_name = f_info['Name'][-25:]
+
+        try:
+            if should_stop is not None and should_stop():
+                raise DownloadStoppedException("用户停止下载")
+            if os.path.exists(local_path):
+                self._update_thread_progress(sid, f_info['Var'], short_name, 1.0, "已存在")
+                if self.zarr_ingestor:
+                    self.zarr_ingestor.submit(local_path, f_info)
+                return
+
+            self._update_thread_progress(sid, f_info['Var'], short_name, 0.0, "读取元数据...")
+            fetched, total = subset_netcdf(self.s3_client, self.bucket_name, f_info, temp_path,
+                                           levels=subset.get('levels'), bbox=subset.get('bbox'),
+                                           times=subset.get('times'))
+            os.replace(temp_path, local_path)
+            self.update_progress(target_dir, f_info['Name'], completed=True)
+            self._hand_off(local_path, target_dir, f_info)
+            self._update_thread_progress(sid, f_info['Var'], short_name, 1.0,
+                                         f"完成 {self.format_size(fetched)}/{self.format_size(total)}")
+        except Exception as e:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            self._update_thread_progress(sid, "ERR", "失败", 0.0, f"{type(e).__name__}")
+            raise
+        finally:
+            with self.progress_lock:
+                self.thread_progress.pop(sid, None)
+            slot_queue.put(sid)
+
+    def _start_sampler(self):
+        """每秒采样一次速度和剩余时间，按 PROGRESS_EVENT_INTERVAL 输出 progress 事件；返回用于停止的 Event"""
+        stop = threading.Event()
+
+        def sample():
+            last_emit = 0.0
+            while not stop.wait(1.0):
+                snapshot = self.progress.sample()
+                if time.time() - last_emit >= PROGRESS_EVENT_INTERVAL:
+                    last_emit = time.time()
+                    self._emit('progress', **{k: v for k, v in snapshot.items() if k != 'time'})
+
+        threading.Thread(target=sample, daemon=True).start()
+        return stop
+
+    def _update_thread_progress(self, sid, var, name, pct, status):
+        """更新线程进度（线程安全）"""
+        with self.progress_lock:
+            self.thread_progress[sid] = {
+                'var': var,
+                'name': name,
+                'pct': pct,
+                'status': status
+            }
+
+    def monitor_progress(self):
+        """监控并打印实时进度（在独立线程中运行）"""
+        import sys
+        last_line_count = 0
+
+        while not self.stop_requested:
+            time.sleep(0.5)  # 每0.5秒更新一次
+
+            with self.progress_lock:
+                if not self.thread_progress:
+                    continue
+
+                # 构建进度显示
+                lines = []
+                snapshot = self.progress.latest or {}
+                streams = snapshot.get('streams', {})
+                lines.append(f"\n{'='*80}")
+                lines.append(f"实时下载进度 (活跃线程: {len(self.thread_progress)}) | {format_progress(snapshot)}")
+                lines.append(f"{'='*80}")
+
+                # 按线程ID排序显示
+                for sid in sorted(self.thread_progress.keys()):
+                    info = self.thread_progress[sid]
+                    var = info['var']
+                    name = info['name']
+                    pct = info['pct']
+                    status = info['status']
+
+                    # 构建进度条
+                    bar_width = 40
+                    filled = int(bar_width * pct)
+                    bar = '[' + '=' * filled + ' ' * (bar_width - filled) + ']'
+
+                    line = f"线程-{sid+1:2d} | [{var}] ...{name}\n"
+                    line += f"        {bar} {pct*100:5.1f}% | {status}"
+                    if sid in streams:
+                        line += f" | {streams[sid] / 1048576:.2f} MB/s"
+                    lines.append(line)
+
+                lines.append(f"{'='*80}\n")
+
+                # 清除之前的输出（仅保留最后一屏）
+                output = '\n'.join(lines)
+                print(output, end='', flush=True)
+
+            # 如果没有活跃线程，退出监控
+            with self.progress_lock:
+                if not self.thread_progress:
+                    break
+
+
+def print_queue_status(work_queue):
+    """打印共享队列的合并进度视图"""
+    by_date, by_owner = work_queue.status()
+    print(f"\n{'='*60}")
+    print("任务队列状态")
+    print(f"{'='*60}")
+    for date_str, states in by_date.items():
+        parts = []
+        for state in ('done', 'leased', 'stale', 'pending', 'failed'):
+            if state in states:
+                count, size = states[state]
+                parts.append(f"{state} {count} ({size / 1024**3:.1f}GB)")
+        print(f"  {date_str}: " + ", ".join(parts))
+    if by_owner:
+        print("  活跃节点: " + ", ".join(f"{owner}({count})" for owner, count in sorted(by_owner.items())))
+    print(f"{'='*60}\n")
@@ -0,0 +1,91 @@
+"""下载计划：核对本地状态，按历史吞吐估算耗时"""
+import os
+import time
+import json
+import sqlite3
+
+from era5.core import FileEntry, list_month_files
+
+
+# ================= 下载计划 =================
+# 列举结果缓存(保存在保存根目录下)，估算大任务时不必每次重新列举几十个月
+LISTING_CACHE_FILE = ".era5_listing_cache.json"
+DEFAULT_LISTING_TTL = 24 * 3600
+# 外部性能监控写入的数据库，performance_logs.download_speed 单位为字节/秒
+METRICS_DB = "era5_performance.db"
+METRICS_DAYS = 30
+
+
+def cached_list_month_files(s3_client, bucket, date_str, wanted_vars, dataset, cache_path,
+                            ttl=DEFAULT_LISTING_TTL, refresh=False):
+    """带本地缓存的 list_month_files：缓存整月的列举结果，过期或 refresh 时重新列举"""
+    key = f"{dataset}/{date_str}"
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    entry = cache.get(key)
+    if refresh or not entry or time.time() - entry['time'] > ttl:
+        entry = {'time': time.time(),
+                 'files': [f.to_dict() for f in list_month_files(s3_client, bucket, date_str, [], dataset)]}
+        cache[key] = entry
+        try:
+            tmp = cache_path + ".tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(cache, f, ensure_ascii=False)
+            os.replace(tmp, cache_path)
+        except OSError as e:
+            print(f"[计划] 保存列举缓存失败: {e}")
+    files = (FileEntry.from_dict(d) for d in entry['files'])
+    return [f for f in files if not wanted_vars or f.var in wanted_vars]
+
+
+def historical_throughput(db_path=METRICS_DB, days=METRICS_DAYS):
+    """从性能监控数据库取最近 days 天下载速度的中位数 (字节/秒)，返回 (速度, 样本数)，没有数据时速度为 None"""
+    if not os.path.exists(db_path):
+        return None, 0
+    try:
+        with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+            since = time.time() - days * 86400
+            where = 'WHERE download_speed > 0 AND timestamp >= ?'
+            count = conn.execute(f'SELECT COUNT(*) FROM performance_logs {where}', (since,)).fetchone()[0]
+            if not count:
+                return None, 0
+            median = conn.execute(f'SELECT download_speed FROM performance_logs {where} '
+                                  'ORDER BY download_speed LIMIT 1 OFFSET ?', (since, count // 2)).fetchone()[0]
+            return float(median), count
+    except sqlite3.Error as e:
+        print(f"[计划] 读取性能数据库失败: {e}")
+        return None, 0
+
+
+def reconcile_files(files, target_dir, completed, store=None):
+    """与本地状态核对，返回 [(f_info, 状态, 仍需传输的字节)]
+
+    状态：done 已完成 / linked 可从共享存储链接 / partial 有临时文件可续传 / missing 需完整下载。
+    """
+    plan = []
+    for f_info in files:
+        local_path = os.path.join(target_dir, f_info['Name'])
+        if f_info['Name'] in completed:
+            plan.append((f_info, 'done', 0))
+            continue
+        try:
+            if os.path.getsize(local_path) == f_info['Size']:
+                plan.append((f_info, 'done', 0))
+                continue
+        except OSError:
+            pass
+        if store is not None and store.has(f_info):
+            plan.append((f_info, 'linked', 0))
+            continue
+        try:
+            partial = os.path.getsize(local_path + ".tmp")
+        except OSError:
+            partial = 0
+        if 0 < partial < f_info['Size']:
+            plan.append((f_info, 'partial', f_info['Size'] - partial))
+        else:
+            plan.append((f_info, 'missing', f_info['Size']))
+    return plan
@@ -0,0 +1,151 @@
+"""下载后处理流水线：校验、统计、压缩在进程池中与下载重叠执行"""
+import os
+import threading
+import time
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+from era5.validate import validate_netcdf
+
+
+# ================= 下载后处理流水线 =================
+POST_PROCESS_LOG = ".era5_postprocess.jsonl"
+# 压缩副本保存的子目录
+COMPRESSED_DIR = "compressed"
+
+
+def pp_validate(path):
+    """检查文件结构并抽样解压数据块，不完整读取文件"""
+    return validate_netcdf(path)
+
+
+def pp_stats(path):
+    """逐个时间步计算各数据变量的最小/最大/平均值和缺测数"""
+    import netCDF4
+    import numpy as np
+    result = {}
+    with netCDF4.Dataset(path) as ds:
+        for name, var in ds.variables.items():
+            if name in ds.dimensions or var.ndim < 2:
+                continue
+            vmin, vmax, total, count, missing = np.inf, -np.inf, 0.0, 0, 0
+            for i in range(var.shape[0]):
+                block = np.ma.masked_invalid(var[i])
+                missing += int(np.ma.count_masked(block))
+                if block.count():
+                    vmin = min(vmin, float(block.min()))
+                    vmax = max(vmax, float(block.max()))
+                    total += float(block.sum(dtype='f8'))
+                    count += int(block.count())
+            result[name] = {'min': vmin if count else None, 'max': vmax if count else None,
+                            'mean': total / count if count else None, 'missing': missing}
+    return result
+
+
+def pp_compress(path, complevel=4):
+    """在 compressed/ 子目录写出 zlib 压缩的副本，原文件保持不变以便断点续传校验大小"""
+    import netCDF4
+    out_dir = os.path.join(os.path.dirname(path), COMPRESSED_DIR)
+    os.makedirs(out_dir, exist_ok=True)
+    out_path = os.path.join(out_dir, os.path.basename(path))
+    temp_path = out_path + ".tmp"
+    with netCDF4.Dataset(path) as src, netCDF4.Dataset(temp_path, 'w', format='NETCDF4') as dst:
+        dst.setncatts({k: src.getncattr(k) for k in src.ncattrs()})
+        for name, dim in src.dimensions.items():
+            dst.createDimension(name, None if dim.isunlimited() else len(dim))
+        for name, var in src.variables.items():
+            fill = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+            chunking = var.chunking()
+            out = dst.createVariable(name, var.dtype, var.dimensions, zlib=True, complevel=complevel,
+                                     shuffle=True, fill_value=fill,
+                                     chunksizes=chunking if isinstance(chunking, list) else None)
+            out.setncatts({k: var.getncattr(k) for k in var.ncattrs() if k != '_FillValue'})
+            var.set_auto_maskandscale(False)
+            out.set_auto_maskandscale(False)
+            if var.ndim >= 2:
+                for i in range(var.shape[0]):
+                    out[i] = var[i]
+            else:
+                out[:] = var[:]
+    os.replace(temp_path, out_path)
+    return {'output': out_path, 'size': os.path.getsize(out_path), 'original': os.path.getsize(path)}
+
+
+POST_PROCESS_STEPS = {
+    'validate': pp_validate,
+    'stats': pp_stats,
+    'compress': pp_compress,
+}
+
+
+def run_post_process(path, steps):
+    """在子进程中依次执行后处理步骤，某一步失败后不再继续"""
+    record = {'file': os.path.basename(path), 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'steps': {}}
+    t0 = time.time()
+    for step in steps:
+        try:
+            record['steps'][step] = POST_PROCESS_STEPS[step](path)
+        except Exception as e:
+            record['error'] = f"{step}: {type(e).__name__}: {e}"
+            break
+    record['seconds'] = round(time.time() - t0, 2)
+    return record
+
+
+class PostProcessor:
+    """把落盘的文件送入进程池做后处理，与后续下载重叠执行
+
+    排队中的文件数有上限，流水线跟不上时提交方(下载线程)会阻塞等待。
+    结果逐行追加到目录下的 .era5_postprocess.jsonl。
+    """
+
+    def __init__(self, steps, max_workers=2, max_pending=None):
+        unknown = [s for s in steps if s not in POST_PROCESS_STEPS]
+        if unknown:
+            raise ValueError(f"未知的后处理步骤: {unknown}")
+        self.steps = list(steps)
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_pending or max_workers * 2)
+        self._lock = threading.Lock()
+        self.done = 0
+        self.failed = 0
+
+    def submit(self, path, target_dir):
+        self._slots.acquire()
+        try:
+            future = self.executor.submit(run_post_process, path, self.steps)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._on_done(f, target_dir))
+
+    def _on_done(self, future, target_dir):
+        self._slots.release()
+        try:
+            record = future.result()
+        except Exception as e:
+            record = {'error': f"{type(e).__name__}: {e}"}
+        with self._lock:
+            if 'error' in record:
+                self.failed += 1
+                print(f"[后处理] {record.get('file', '?')} 失败: {record['error']}")
+            else:
+                self.done += 1
+            try:
+                with open(os.path.join(target_dir, POST_PROCESS_LOG), 'a', encoding='utf-8') as log:
+                    log.write(json.dumps(record, ensure_ascii=False) + "\n")
+            except Exception as e:
+                print(f"[后处理] 记录结果失败: {e}")
+
+    def close(self):
+        """等待所有后处理完成"""
+        self.executor.shutdown(wait=True)
+        return self.done, self.failed
+
+
+def create_post_processor(config):
+    """按配置中的 post_process 步骤创建后处理流水线，未配置时返回 None"""
+    steps = config.get('post_process') if config else None
+    if not steps:
+        return None
+    return PostProcessor(steps, max_workers=config.get('post_process_workers', 2))
@@ -0,0 +1,383 @@
+"""进度与性能观测：采样剖析、EWMA 速度与剩余时间、指标端点"""
+import os
+import sys
+import threading
+import time
+import re
+import json
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# ================= 性能剖析 =================
+# 调用栈采样间隔(秒)
+DEFAULT_PROFILE_INTERVAL = 0.01
+# 下载内层循环的计时分段：读响应、写文件、进度回调(含锁)、限速等待，以及界面线程的刷新回调
+PROFILE_SECTIONS = ('read', 'write', 'callback', 'throttle', 'tk_ui')
+
+
+class Profiler:
+    """运行时可开关的剖析器
+
+    开启后后台线程按固定间隔采样所有线程(含下载线程和界面线程)的 Python 调用栈，
+    并累计下载内层循环各段耗时；停止后输出火焰图可用的折叠栈 (flamegraph.pl / speedscope)
+    和分段汇总。关闭时热路径只多一次 enabled 属性判断。
+    """
+
+    def __init__(self, interval=DEFAULT_PROFILE_INTERVAL):
+        self.interval = interval
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.stacks = {}
+        self.sections = {}
+        self.samples = 0
+        self.started = None
+        self.elapsed = 0.0
+        self._stop = None
+
+    def start(self, interval=None):
+        """开始一次新的剖析(清空上次的数据)"""
+        with self.lock:
+            if self.enabled:
+                return
+            self.interval = interval or self.interval
+            self.stacks, self.sections, self.samples = {}, {}, 0
+            self.started, self.elapsed = time.perf_counter(), 0.0
+            self._stop = threading.Event()
+            self.enabled = True
+        threading.Thread(target=self._sample_loop, args=(self._stop,), name="era5-profiler", daemon=True).start()
+
+    def stop(self):
+        with self.lock:
+            if not self.enabled:
+                return
+            self.enabled = False
+            self._stop.set()
+            self.elapsed = time.perf_counter() - self.started
+
+    def record(self, section, seconds):
+        with self.lock:
+            entry = self.sections.setdefault(section, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def record_chunk(self, read, write, callback, throttle):
+        with self.lock:
+            for section, seconds in (('read', read), ('write', write), ('callback', callback), ('throttle', throttle)):
+                entry = self.sections.setdefault(section, [0, 0.0])
+                entry[0] += 1
+                entry[1] += seconds
+
+    def _sample_loop(self, stop):
+        me = threading.get_ident()
+        while not stop.wait(self.interval):
+            names = {t.ident: re.sub(r'-\d+', '', t.name) for t in threading.enumerate()}
+            frames = sys._current_frames()
+            collapsed = []
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread"))
+                collapsed.append(';'.join(reversed(stack)))
+            del frames
+            with self.lock:
+                self.samples += 1
+                for key in collapsed:
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def collapsed_lines(self):
+        """折叠栈：每行 '根;...;叶 次数'"""
+        with self.lock:
+            return [f"{stack} {count}" for stack, count in sorted(self.stacks.items())]
+
+    def summary_lines(self, top=15):
+        with self.lock:
+            sections = {k: list(v) for k, v in self.sections.items()}
+            stacks = dict(self.stacks)
+            samples = self.samples
+            elapsed = self.elapsed or (time.perf_counter() - self.started if self.started else 0.0)
+        lines = [f"剖析时长 {elapsed:.1f} 秒，采样 {samples} 次 (间隔 {self.interval * 1000:.0f} ms)"]
+        loop_total = sum(sections.get(s, [0, 0.0])[1] for s in PROFILE_SECTIONS[:4])
+        if sections:
+            lines.append(f"{'分段':<12}{'次数':>10}{'累计(s)':>12}{'平均(ms)':>12}{'占比':>8}")
+            for name in PROFILE_SECTIONS:
+                if name not in sections:
+                    continue
+                count, seconds = sections[name]
+                share = f"{seconds / loop_total * 100:.1f}%" if loop_total and name != 'tk_ui' else "-"
+                lines.append(f"{name:<12}{count:>10}{seconds:>12.2f}{seconds / count * 1000:>12.3f}{share:>8}")
+        # 按叶子函数(采样时正在执行的函数)汇总
+        leaves = {}
+        for stack, count in stacks.items():
+            leaf = stack.rsplit(';', 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + count
+        if leaves:
+            lines.append("采样最多的函数 (自身时间):")
+            total = sum(leaves.values())
+            for leaf, count in sorted(leaves.items(), key=lambda kv: -kv[1])[:top]:
+                lines.append(f"  {count / total * 100:5.1f}%  {leaf}")
+        return lines
+
+    def dump(self, out_dir):
+        """写出折叠栈 (.collapsed) 和分段汇总 (.txt)，返回两个文件路径"""
+        os.makedirs(out_dir, exist_ok=True)
+        base = os.path.join(out_dir, f"era5_profile_{time.strftime('%Y%m%d_%H%M%S')}")
+        with open(base + ".collapsed", 'w', encoding='utf-8') as f:
+            f.write('\n'.join(self.collapsed_lines()) + '\n')
+        with open(base + ".txt", 'w', encoding='utf-8') as f:
+            f.write('\n'.join(self.summary_lines()) + '\n')
+        return base + ".collapsed", base + ".txt"
+
+
+# 进程内共享的剖析器，下载循环和界面回调通过它记录分段耗时
+PROFILER = Profiler()
+
+
+# ================= 速度与剩余时间 =================
+# 速度 EWMA 的半衰期(秒)：越短反应越快，越长读数越稳
+DEFAULT_SPEED_HALFLIFE = 10.0
+# 无界面模式输出 progress 事件的间隔(秒)
+PROGRESS_EVENT_INTERVAL = 5.0
+
+
+class SpeedEstimator:
+    """累计字节数的指数加权平均速度(字节/秒)
+
+    采样间隔不固定(界面卡顿、线程调度)，按实际间隔折算权重 alpha = 1 - 2^(-dt/半衰期)，
+    读数与采样频率无关。第一次采样只记录基准，第二次起才有速度。
+    """
+
+    def __init__(self, halflife=DEFAULT_SPEED_HALFLIFE):
+        self.halflife = halflife
+        self.rate = None
+        self.last_t = None
+        self.last_bytes = 0
+
+    def update(self, total_bytes, now):
+        if self.last_t is None:
+            self.last_t, self.last_bytes = now, total_bytes
+            return 0.0
+        dt = now - self.last_t
+        if dt <= 0:
+            return self.rate or 0.0
+        instant = (total_bytes - self.last_bytes) / dt
+        alpha = 1.0 - 2.0 ** (-dt / self.halflife)
+        self.rate = instant if self.rate is None else self.rate + alpha * (instant - self.rate)
+        self.last_t, self.last_bytes = now, total_bytes
+        return self.rate
+
+
+class StreamCounter:
+    """一个流(下载线程槽位)的字节计数，只由当前占用该槽位的线程写入，采样线程只读"""
+    __slots__ = ('total', 'on_disk', 'active')
+
+    def __init__(self):
+        self.total = 0  # 累计传输字节，只增不减
+        self.on_disk = 0  # 当前文件已在磁盘上的字节(含续传起点)
+        self.active = False
+
+
+class ProgressTracker:
+    """下载进度事件源：按流(下载线程槽位)累计字节，采样时更新每个流和全局的 EWMA 速度，
+    并用清单中未结束文件的剩余字节估算剩余时间
+
+    下载线程调用 begin/add/end，调度方在文件进入清单时调用 expect、结束(成功、跳过或最终失败)时调用 finish；
+    sample() 由界面定时器或采样线程调用，产出快照并通知订阅者，latest 保存最近一次快照。
+    每块数据只累加本流的计数器，不取共享锁；同一时刻一个槽位只被一个线程占用，计数器没有并发写入。
+    计数从不清零，总量由采样线程汇总各流得到，单调递增。
+    """
+
+    def __init__(self, halflife=DEFAULT_SPEED_HALFLIFE):
+        self.halflife = halflife
+        self.lock = threading.Lock()  # 只保护清单计数，按文件而不是按块获取
+        self.counters = {}  # 流 -> StreamCounter
+        self.outstanding = 0  # 清单中未结束文件的总字节
+        self.outstanding_files = 0
+        self.global_speed = SpeedEstimator(halflife)
+        self.stream_speed = {}
+        self.listeners = []
+        self.latest = None
+
+    def reset(self):
+        """开始新一轮下载：清空清单和速度估计，保留各流的累计字节，指标中的总量跨轮次单调递增"""
+        with self.lock:
+            self.outstanding = 0
+            self.outstanding_files = 0
+        for counter in list(self.counters.values()):
+            counter.active = False
+            counter.on_disk = 0
+        self.global_speed = SpeedEstimator(self.halflife)
+        self.stream_speed = {}
+        self.latest = None
+
+    def counter(self, stream):
+        counter = self.counters.get(stream)
+        if counter is None:
+            # setdefault 是原子操作，两个线程同时创建时只保留一个
+            counter = self.counters.setdefault(stream, StreamCounter())
+        return counter
+
+    def expect(self, size):
+        with self.lock:
+            self.outstanding += size
+            self.outstanding_files += 1
+
+    def finish(self, size):
+        with self.lock:
+            self.outstanding = max(0, self.outstanding - size)
+            self.outstanding_files = max(0, self.outstanding_files - 1)
+
+    def begin(self, stream, offset=0):
+        counter = self.counter(stream)
+        counter.on_disk = offset
+        counter.active = True
+
+    def end(self, stream):
+        counter = self.counter(stream)
+        counter.active = False
+        counter.on_disk = 0
+
+    def add(self, stream, n):
+        counter = self.counters.get(stream) or self.counter(stream)
+        counter.total += n
+        counter.on_disk += n
+
+    @property
+    def total(self):
+        """累计传输字节"""
+        return sum(c.total for c in list(self.counters.values()))
+
+    def subscribe(self, fn):
+        self.listeners.append(fn)
+
+    def sample(self, now=None):
+        """更新速度估计并返回快照，同时通知订阅者；只应由一个线程调用"""
+        now = time.monotonic() if now is None else now
+        counters = list(self.counters.items())
+        stream_total = {stream: c.total for stream, c in counters}
+        total = sum(stream_total.values())
+        on_disk = sum(c.on_disk for _, c in counters if c.active)
+        active = sum(1 for _, c in counters if c.active)
+        with self.lock:
+            outstanding, files = self.outstanding, self.outstanding_files
+
+        rate = self.global_speed.update(total, now)
+        streams = {}
+        for stream, nbytes in sorted(stream_total.items()):
+            estimator = self.stream_speed.setdefault(stream, SpeedEstimator(self.halflife))
+            streams[stream] = round(estimator.update(nbytes, now), 1)
+        remaining = max(0, outstanding - on_disk)
+        if not remaining:
+            eta = 0
+        else:
+            eta = round(remaining / rate) if rate >= 1 else None
+        snapshot = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'bytes': total, 'rate': round(rate, 1),
+                    'remaining_bytes': remaining, 'remaining_files': files, 'eta_seconds': eta,
+                    'active': active, 'streams': streams}
+        self.latest = snapshot
+        for fn in list(self.listeners):
+            fn(snapshot)
+        return snapshot
+
+
+def format_progress(snapshot):
+    """一行文字：速度、剩余量和预计剩余时间"""
+    if not snapshot:
+        return "当前速度: 0.0 MB/s"
+    text = f"当前速度: {snapshot['rate'] / 1048576:.2f} MB/s"
+    if snapshot['remaining_files']:
+        text += f" | 剩余 {snapshot['remaining_bytes'] / 1073741824:.2f} GB"
+        eta = snapshot['eta_seconds']
+        text += f" | 预计 {format_duration(eta)}" if eta is not None else " | 预计 --"
+    return text
+
+
+def format_metrics(snapshot):
+    """快照转为 Prometheus 文本格式"""
+    snapshot = snapshot or {}
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            if value is not None:
+                lines.append(f"{name}{labels} {value}")
+
+    metric('era5_downloaded_bytes_total', 'counter', "累计下载字节数", [('', snapshot.get('bytes', 0))])
+    metric('era5_throughput_bytes_per_second', 'gauge', "全局下载速度 (EWMA)", [('', snapshot.get('rate', 0.0))])
+    metric('era5_stream_throughput_bytes_per_second', 'gauge', "各下载线程的速度 (EWMA)",
+           [(f'{{stream="{sid}"}}', rate) for sid, rate in (snapshot.get('streams') or {}).items()])
+    metric('era5_remaining_bytes', 'gauge', "清单中尚未下载的字节数", [('', snapshot.get('remaining_bytes', 0))])
+    metric('era5_remaining_files', 'gauge', "清单中尚未结束的文件数", [('', snapshot.get('remaining_files', 0))])
+    metric('era5_eta_seconds', 'gauge', "预计剩余时间", [('', snapshot.get('eta_seconds'))])
+    metric('era5_active_streams', 'gauge', "正在下载的线程数", [('', snapshot.get('active', 0))])
+    return "\n".join(lines) + "\n"
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """/metrics 输出 Prometheus 指标，/progress 输出最近一次进度快照(JSON)
+
+    /profile/start 开启性能剖析，/profile/stop 停止并返回分段汇总，/profile 返回折叠栈。
+    """
+    snapshot = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        snapshot = type(self).snapshot()
+        text = 'text/plain; charset=utf-8'
+        if path == '/metrics':
+            body, ctype = format_metrics(snapshot).encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8'
+        elif path in ('/', '/progress'):
+            body, ctype = json.dumps(snapshot or {}, ensure_ascii=False).encode('utf-8'), 'application/json'
+        elif path == '/profile/start':
+            PROFILER.start()
+            body, ctype = "profiling started\n".encode('utf-8'), text
+        elif path == '/profile/stop':
+            PROFILER.stop()
+            body, ctype = ('\n'.join(PROFILER.summary_lines()) + '\n').encode('utf-8'), text
+        elif path == '/profile':
+            body, ctype = ('\n'.join(PROFILER.collapsed_lines()) + '\n').encode('utf-8'), text
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(config, snapshot):
+    """配置了 metrics_port 时在后台线程提供指标端点，返回服务器；snapshot() 返回最近的进度快照"""
+    port = config.get('metrics_port')
+    if not port:
+        return None
+    host = config.get('metrics_host', '127.0.0.1')
+    handler = type('Handler', (MetricsRequestHandler,), {'snapshot': staticmethod(snapshot)})
+    server = ThreadingHTTPServer((host, int(port)), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[指标] http://{host}:{port}/metrics (进度快照 /progress)")
+    return server
+
+
+def format_duration(seconds):
+    """把秒数格式化为 1天3小时 / 2小时5分 / 40分钟"""
+    seconds = int(seconds)
+    days, rest = divmod(seconds, 86400)
+    hours, rest = divmod(rest, 3600)
+    minutes = rest // 60
+    if days:
+        return f"{days}天{hours}小时"
+    if hours:
+        return f"{hours}小时{minutes}分"
+    return f"{max(minutes, 1)}分钟"
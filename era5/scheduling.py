@@ -0,0 +1,340 @@
+"""按优先级和截止时间调度文件与月份任务"""
+import os
+import threading
+import time
+import itertools
+import heapq
+import random
+import json
+from collections import deque
+
+
+# ================= 优先级调度 =================
+# 后台补档(优先级不高于 0)至少分得的份额：文件按出队次数，任务条目按运行时间
+DEFAULT_BACKFILL_SHARE = 0.2
+# 距截止时间不足该秒数的文件/任务条目提到最前
+DEFAULT_DEADLINE_SLACK = 3600
+# 后台补档一次最多积累的运行额度(秒)，额度内不被紧急任务抢占
+DEFAULT_BACKFILL_SLICE = 600
+# 向运行中的任务提交紧急任务的目录(在保存根目录下)，每个任务一个 JSON 文件
+JOBS_SPOOL_DIR = ".era5_jobs"
+# 运行中的任务检查提交目录的间隔(秒)
+JOBS_POLL_INTERVAL = 5
+
+
+def parse_deadline(value):
+    """解析截止时间：2025-03-01、2025-03-01 18:00 或 2025-03-01T18:00:00，返回时间戳；空值返回 None"""
+    if value in (None, ''):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    for fmt in ('%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value.strip(), fmt))
+        except ValueError:
+            pass
+    raise ValueError(f"截止时间格式不正确: {value} (应为 YYYY-MM-DD 或 YYYY-MM-DD HH:MM)")
+
+
+def _as_list(value):
+    """规则里的 months/vars 可以写成字符串(逗号分隔)或列表"""
+    if isinstance(value, str):
+        value = [value]
+    return [v.strip() for item in value or () for v in str(item).split(',') if v.strip()]
+
+
+class PriorityRules:
+    """任务优先级规则，来自配置的 priorities 和运行中提交的紧急任务
+
+    每条规则形如 {"months": ["202401-202403"], "vars": ["t"], "priority": 10, "deadline": "2025-03-01 18:00"}，
+    months/vars 省略时匹配全部。多条规则同时匹配时取最高优先级和最早截止时间，都不匹配的是优先级 0 的后台补档。
+    """
+
+    def __init__(self, rules=()):
+        self.rules = []
+        for rule in rules:
+            self.add(rule)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls((config or {}).get('priorities') or ())
+
+    def add(self, rule):
+        months = _as_list(rule.get('months'))
+        wanted = _as_list(rule.get('vars'))
+        self.rules.append((set(parse_months(months)) if months else None, set(wanted) if wanted else None,
+                           int(rule.get('priority', 0)), parse_deadline(rule.get('deadline'))))
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def classify(self, month, var=None):
+        """返回 (优先级, 截止时间或 None)；var 为 None 时按整月中匹配的最高优先级"""
+        priority, deadline = None, None
+        for months, wanted, p, d in self.rules:
+            if months is not None and month not in months:
+                continue
+            if var is not None and wanted is not None and var not in wanted:
+                continue
+            priority = p if priority is None else max(priority, p)
+            if d is not None:
+                deadline = d if deadline is None else min(deadline, d)
+        return (0 if priority is None else priority), deadline
+
+    def classify_file(self, f_info):
+        # 对象键形如 数据集/月份/文件名
+        return self.classify(f_info['Key'].rsplit('/', 2)[-2], f_info['Var'])
+
+
+class PriorityScheduler:
+    """按优先级出队的任务队列，可代替 stream_tasks 中的先进先出队列
+
+    优先级高的先出，同优先级按截止时间先后、再按入队顺序；距截止时间不足 slack 秒的任务提到最前。
+    两类任务同时在排队时，后台补档(优先级不高于 0)至少分得 backfill_share 的出队次数，不会被饿死。
+    不限积压：要看到整批任务才能排序，列举结果用 FileEntry 保存，一个月的文件占用的内存很小。
+    """
+
+    def __init__(self, classify, backfill_share=DEFAULT_BACKFILL_SHARE, slack=DEFAULT_DEADLINE_SLACK):
+        self.classify = classify
+        self.backfill_share = backfill_share
+        self.slack = slack
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._urgent = []
+        self._backfill = []
+        self._deadlines = []
+        self._last = deque()
+        self._size = 0
+        # 两类任务同时排队时的出队次数，用于计算后台补档的份额
+        self._contested = 0
+        self._contested_backfill = 0
+
+    def qsize(self):
+        with self._cond:
+            return self._size
+
+    def put(self, item, timeout=None):
+        priority, deadline = self.classify(item)
+        with self._cond:
+            # 条目: [排序键, 序号, 任务, 是否仍在队列中]，序号唯一，比较不会落到任务本身
+            entry = [(-priority, float('inf') if deadline is None else deadline), next(self._seq), item, True]
+            heapq.heappush(self._urgent if priority > 0 else self._backfill, entry)
+            if deadline is not None:
+                heapq.heappush(self._deadlines, (deadline, entry[1], entry))
+            self._size += 1
+            self._cond.notify()
+
+    def put_last(self, item):
+        """放入结束标记：所有任务出队后才会取到"""
+        with self._cond:
+            self._last.append(item)
+            self._cond.notify()
+
+    def get(self):
+        with self._cond:
+            while True:
+                entry = self._pick()
+                if entry is not None:
+                    entry[3] = False
+                    self._size -= 1
+                    return entry[2]
+                if self._last:
+                    return self._last.popleft()
+                self._cond.wait()
+
+    @staticmethod
+    def _prune(heap):
+        # 经截止时间提前出队的条目留在原堆中，取到时丢弃
+        while heap and not heap[0][3]:
+            heapq.heappop(heap)
+
+    def _pick(self):
+        while self._deadlines and not self._deadlines[0][2][3]:
+            heapq.heappop(self._deadlines)
+        if self._deadlines and self._deadlines[0][0] - time.time() <= self.slack:
+            return heapq.heappop(self._deadlines)[2]
+
+        self._prune(self._urgent)
+        self._prune(self._backfill)
+        if self._urgent and self._backfill:
+            self._contested += 1
+            if self._contested_backfill + 1 <= self.backfill_share * self._contested:
+                self._contested_backfill += 1
+                return heapq.heappop(self._backfill)
+            return heapq.heappop(self._urgent)
+        if self._urgent:
+            return heapq.heappop(self._urgent)
+        if self._backfill:
+            return heapq.heappop(self._backfill)
+        return None
+
+
+def create_file_scheduler(config, rules=None):
+    """配置了优先级规则时返回按文件(月份+变量)排序的调度队列，否则返回 None (保持列举顺序)
+
+    每轮 stream_tasks 需要一个新的调度队列。
+    """
+    rules = PriorityRules.from_config(config) if rules is None else rules
+    if not rules:
+        return None
+    return PriorityScheduler(rules.classify_file,
+                             float(config.get('backfill_share', DEFAULT_BACKFILL_SHARE)),
+                             float(config.get('deadline_slack', DEFAULT_DEADLINE_SLACK)))
+
+
+class JobQueue:
+    """进程内的任务条目队列，一个条目是一个月份(及其变量)的下载
+
+    按优先级/截止时间取出条目；等待中的条目比正在运行的更紧急时，运行中的条目被抢占：
+    不再派发新文件，已在下载的文件照常完成，之后重新排队，轮到时从进度和临时文件继续。
+    紧急条目运行时为后台补档积累运行额度(按 backfill_share 折算，最多 backfill_slice 秒)，
+    有额度时后台补档优先取出且不被抢占，紧急任务不断到来时后台任务也能继续推进。
+    """
+
+    def __init__(self, rules, backfill_share=DEFAULT_BACKFILL_SHARE, slack=DEFAULT_DEADLINE_SLACK,
+                 backfill_slice=DEFAULT_BACKFILL_SLICE):
+        self.rules = rules
+        self.backfill_share = min(max(backfill_share, 0.0), 0.9)
+        self.slack = slack
+        self.backfill_slice = backfill_slice
+        self.credit = 0.0
+        self.entries = []
+        self._seq = itertools.count()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(PriorityRules.from_config(config),
+                   float(config.get('backfill_share', DEFAULT_BACKFILL_SHARE)),
+                   float(config.get('deadline_slack', DEFAULT_DEADLINE_SLACK)),
+                   float(config.get('backfill_slice', DEFAULT_BACKFILL_SLICE)))
+
+    def add(self, month, wanted_vars, priority=None, deadline=None):
+        """加入一个条目；未给出优先级时按规则计算"""
+        if priority is None:
+            priority, deadline = self.rules.classify(month)
+        entry = {'month': month, 'vars': list(wanted_vars or ()), 'priority': priority, 'deadline': deadline,
+                 'seq': next(self._seq), 'runs': 0}
+        with self.lock:
+            self.entries.append(entry)
+        return entry
+
+    def requeue(self, entry):
+        """被抢占的条目放回队列，保留原来的顺序号"""
+        with self.lock:
+            self.entries.append(entry)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def is_urgent(self, entry, now=None):
+        deadline = entry['deadline']
+        return entry['priority'] > 0 or (deadline is not None and deadline - (now or time.time()) <= self.slack)
+
+    def _key(self, entry, now):
+        deadline = entry['deadline']
+        near = deadline is not None and deadline - now <= self.slack
+        return (not near, -entry['priority'], float('inf') if deadline is None else deadline, entry['seq'])
+
+    def pop(self):
+        """取出下一个条目，队列为空时返回 None"""
+        now = time.time()
+        with self.lock:
+            if not self.entries:
+                return None
+            backfill = [e for e in self.entries if not self.is_urgent(e, now)]
+            if backfill and self.credit > 0:
+                entry = min(backfill, key=lambda e: self._key(e, now))
+            else:
+                entry = min(self.entries, key=lambda e: self._key(e, now))
+            self.entries.remove(entry)
+            return entry
+
+    def preemptor(self, current, elapsed):
+        """返回应抢占 current 的等待条目，没有则返回 None；elapsed 为 current 本次已运行秒数"""
+        now = time.time()
+        with self.lock:
+            if not self.is_urgent(current, now) and self.credit - elapsed > 0:
+                return None
+            key = self._key(current, now)
+            waiting = [e for e in self.entries if self.is_urgent(e, now) and self._key(e, now) < key]
+            return min(waiting, key=lambda e: self._key(e, now)) if waiting else None
+
+    def record(self, entry, seconds):
+        """记录条目本次运行的时间：紧急条目为后台补档积累额度，后台条目消耗额度"""
+        with self.lock:
+            if self.is_urgent(entry):
+                ratio = self.backfill_share / (1.0 - self.backfill_share)
+                self.credit = min(self.credit + seconds * ratio, self.backfill_slice)
+            else:
+                self.credit = max(0.0, self.credit - seconds)
+
+    def poll(self, spool_dir, default_vars=()):
+        """读取提交目录中的任务文件加入队列(读完删除)，返回新加入的条目"""
+        try:
+            names = sorted(n for n in os.listdir(spool_dir) if n.endswith('.json'))
+        except OSError:
+            return []
+        added = []
+        for name in names:
+            path = os.path.join(spool_dir, name)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    job = json.load(f)
+                months = parse_months(_as_list(job['months']))
+                wanted = _as_list(job.get('vars')) or list(default_vars)
+                self.rules.add(dict(job, months=months, vars=wanted))
+                priority = int(job.get('priority', 0))
+                deadline = parse_deadline(job.get('deadline'))
+                added.extend(self.add(month, wanted, priority, deadline) for month in months)
+                os.remove(path)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print(f"[调度] 无法读取任务文件 {name}: {e}")
+                try:
+                    os.replace(path, path + ".bad")
+                except OSError:
+                    pass
+        return added
+
+
+def submit_job(local_root, months, wanted_vars, priority=0, deadline=None):
+    """把任务写入保存根目录下的提交目录，由正在运行的任务读取；返回任务文件路径"""
+    spool_dir = os.path.join(local_root, JOBS_SPOOL_DIR)
+    os.makedirs(spool_dir, exist_ok=True)
+    job = {'months': list(months), 'vars': list(wanted_vars or ()), 'priority': priority,
+           'deadline': deadline, 'submitted': time.strftime('%Y-%m-%d %H:%M:%S')}
+    path = os.path.join(spool_dir, f"{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}-{random.randrange(1 << 16):04x}.json")
+    # 先写临时文件再改名，读取方不会读到写了一半的任务
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(job, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def parse_months(specs):
+    """解析月份写法：202401、区间 202401-202403、整年 2024 或 2015-2024，可用逗号分隔，返回去重后升序的 YYYYMM 列表"""
+    months = set()
+    for spec in specs:
+        for part in spec.split(','):
+            part = part.strip()
+            if not part:
+                continue
+            if len(part) == 4 and part.isdigit():
+                lo, hi = part + "01", part + "12"
+            elif '-' in part:
+                lo, hi = (p.strip() for p in part.split('-', 1))
+                if len(lo) == 4 and len(hi) == 4:
+                    lo, hi = lo + "01", hi + "12"
+            else:
+                lo = hi = part
+            for m in (lo, hi):
+                if len(m) != 6 or not m.isdigit() or not 1 <= int(m[4:]) <= 12:
+                    raise ValueError(f"月份格式不正确: {part} (应为 YYYYMM、YYYYMM-YYYYMM 或 YYYY)")
+            if lo > hi:
+                raise ValueError(f"月份区间起点晚于终点: {part}")
+            year, month = int(lo[:4]), int(lo[4:])
+            while f"{year:04d}{month:02d}" <= hi:
+                months.add(f"{year:04d}{month:02d}")
+                year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return sorted(months)
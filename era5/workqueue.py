@@ -0,0 +1,149 @@
+"""多节点共享的 SQLite 任务队列"""
+import os
+import time
+import socket
+import sqlite3
+
+
+# ================= 多节点共享任务队列 =================
+class WorkQueue:
+    """放在共享文件系统上的 SQLite 任务队列，节点以限时租约领取文件
+
+    租约过期(节点崩溃或失联)的文件会被其他节点重新领取；
+    已完成的状态对所有节点可见，用于汇总进度。
+    """
+
+    def __init__(self, db_path, node_id=None, lease_seconds=300, max_attempts=6):
+        self.db_path = db_path
+        self.node_id = node_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with self._connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS work_items (
+                    key TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    var TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    owner TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    updated REAL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_work_items_state ON work_items(state, lease_expires)')
+
+    def _connect(self):
+        # 网络文件系统上不使用 WAL，依赖普通文件锁；isolation_level=None 以便手动 BEGIN IMMEDIATE
+        conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=DELETE')
+        return conn
+
+    def seed(self, date_str, files):
+        """登记某月的文件，已存在的条目保持原状态，返回新增数量"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            before = conn.total_changes
+            conn.executemany(
+                'INSERT OR IGNORE INTO work_items (key, name, size, var, date, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                [(f['Key'], f['Name'], f['Size'], f['Var'], date_str, now) for f in files])
+            added = conn.total_changes - before
+            conn.execute('COMMIT')
+            return added
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def claim(self, limit=1):
+        """领取最多 limit 个待下载或租约已过期的文件"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute('''
+                SELECT key, name, size, var, date FROM work_items
+                WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?)
+                ORDER BY date, key
+                LIMIT ?
+            ''', (now, limit)).fetchall()
+            conn.executemany('''
+                UPDATE work_items
+                SET state = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1, updated = ?
+                WHERE key = ?
+            ''', [(self.node_id, now + self.lease_seconds, now, r[0]) for r in rows])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        return [{'Key': r[0], 'Name': r[1], 'Size': r[2], 'Var': r[3], 'Date': r[4]} for r in rows]
+
+    def renew(self, keys):
+        """续租本节点持有的文件，返回已丢失租约的键"""
+        if not keys:
+            return set()
+        now = time.time()
+        lost = set()
+        with self._connect() as conn:
+            for key in keys:
+                cur = conn.execute('''
+                    UPDATE work_items SET lease_expires = ?, updated = ?
+                    WHERE key = ? AND owner = ? AND state = 'leased'
+                ''', (now + self.lease_seconds, now, key, self.node_id))
+                if cur.rowcount == 0:
+                    lost.add(key)
+        return lost
+
+    def complete(self, key):
+        with self._connect() as conn:
+            conn.execute('''
+                UPDATE work_items SET state = 'done', owner = ?, lease_expires = NULL, error = NULL, updated = ?
+                WHERE key = ?
+            ''', (self.node_id, time.time(), key))
+
+    def fail(self, key, error):
+        """记录失败；未超过最大次数的放回队列，由任意节点重试"""
+        with self._connect() as conn:
+            conn.execute('''
+                UPDATE work_items
+                SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                    owner = NULL, lease_expires = NULL, error = ?, updated = ?
+                WHERE key = ? AND owner = ?
+            ''', (self.max_attempts, str(error)[:500], time.time(), key, self.node_id))
+
+    def release(self, keys):
+        """停止时归还未完成的租约"""
+        with self._connect() as conn:
+            conn.executemany('''
+                UPDATE work_items SET state = 'pending', owner = NULL, lease_expires = NULL,
+                                      attempts = MAX(attempts - 1, 0), updated = ?
+                WHERE key = ? AND owner = ? AND state = 'leased'
+            ''', [(time.time(), key, self.node_id) for key in keys])
+
+    def status(self):
+        """汇总所有节点的进度：{date: {state: (文件数, 字节数)}} 及各节点正在处理的数量"""
+        now = time.time()
+        by_date = {}
+        by_owner = {}
+        with self._connect() as conn:
+            for date_str, state, count, size in conn.execute('''
+                SELECT date,
+                       CASE WHEN state = 'leased' AND lease_expires < ? THEN 'stale' ELSE state END,
+                       COUNT(*), SUM(size)
+                FROM work_items GROUP BY 1, 2 ORDER BY 1
+            ''', (now,)):
+                by_date.setdefault(date_str, {})[state] = (count, size or 0)
+            for owner, count in conn.execute('''
+                SELECT owner, COUNT(*) FROM work_items
+                WHERE state = 'leased' AND lease_expires >= ? GROUP BY owner
+            ''', (now,)):
+                by_owner[owner] = count
+        return by_date, by_owner
@@ -0,0 +1,179 @@
+"""把下载的 NetCDF 文件按变量追加写入 Zarr 存储"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# ================= Zarr 输出 =================
+# Zarr 各维度默认块大小，未列出的维度不分块
+ZARR_DEFAULT_CHUNKS = {'time': 24, 'level': 1, 'latitude': 181, 'longitude': 360}
+
+
+def _open_zarr_group(path):
+    """以 zarr v2 格式打开(或创建)存储，便于 xarray 识别维度"""
+    import zarr
+    try:
+        return zarr.open_group(path, mode='a', zarr_format=2)
+    except TypeError:
+        # zarr 2.x 没有 zarr_format 参数
+        return zarr.open_group(path, mode='a')
+
+
+def _create_zarr_array(group, name, shape, chunks, dtype, fill_value, dims, attrs):
+    create = getattr(group, 'create_array', None) or group.create_dataset
+    arr = create(name=name, shape=shape, chunks=chunks, dtype=dtype, fill_value=fill_value)
+    arr.attrs.update(attrs)
+    arr.attrs['_ARRAY_DIMENSIONS'] = list(dims)
+    return arr
+
+
+def zarr_store_path(store_root, var):
+    return os.path.join(store_root, f"{var}.zarr")
+
+
+def zarr_ingested_names(store_root, var):
+    """读取某变量存储中已写入的文件名，存储不存在时返回空集合"""
+    path = zarr_store_path(store_root, var)
+    if not os.path.exists(path):
+        return set()
+    return set(_open_zarr_group(path).attrs.get('era5_ingested', []))
+
+
+class ZarrIngestor:
+    """把下载完成的 NetCDF 按时间顺序追加到每个变量一个的 Zarr 存储
+
+    在后台单线程中逐个写入；同一变量的文件必须按文件名(即时间)顺序追加，
+    先到的后序文件会等待前序文件。已写入的文件名记录在存储属性中，
+    重跑时据此跳过，中途崩溃留下的半截数据在下次打开时截掉。
+    """
+
+    def __init__(self, store_root, chunks=None, keep_nc=True):
+        try:
+            import zarr  # noqa: F401
+            import netCDF4  # noqa: F401
+        except ImportError as e:
+            raise RuntimeError(f"Zarr 输出需要安装 zarr 和 netCDF4: {e}")
+        self.store_root = store_root
+        self.chunks = dict(ZARR_DEFAULT_CHUNKS, **(chunks or {}))
+        self.keep_nc = keep_nc
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self._expected = {}  # {var: [按顺序等待写入的文件名]}
+        self._ready = {}     # {var: {文件名: 本地路径}}
+        self._ingested = {}  # {var: set(文件名)}
+        self._to_remove = []  # 不保留 NetCDF 时，结束后再删除，避免与后处理冲突
+        self.done = 0
+        self.failed = 0
+
+    def store_path(self, var):
+        return zarr_store_path(self.store_root, var)
+
+    def ingested(self, var):
+        """返回某变量已写入的文件名集合"""
+        with self._lock:
+            if var not in self._ingested:
+                self._ingested[var] = zarr_ingested_names(self.store_root, var)
+            return self._ingested[var]
+
+    def expect(self, files):
+        """登记本批待写入的文件，决定各变量的写入顺序"""
+        for f_info in sorted(files, key=lambda f: f['Name']):
+            done = self.ingested(f_info['Var'])
+            with self._lock:
+                queue_ = self._expected.setdefault(f_info['Var'], [])
+                if f_info['Name'] not in done and f_info['Name'] not in queue_:
+                    queue_.append(f_info['Name'])
+
+    def submit(self, local_path, f_info):
+        with self._lock:
+            self._ready.setdefault(f_info['Var'], {})[f_info['Name']] = local_path
+        self.executor.submit(self._drain, f_info['Var'])
+
+    def _drain(self, var):
+        """按顺序写入所有已就绪的文件"""
+        while True:
+            with self._lock:
+                expected = self._expected.get(var, [])
+                ready = self._ready.get(var, {})
+                if not expected or expected[0] not in ready:
+                    return
+                name = expected.pop(0)
+                path = ready.pop(name)
+            try:
+                self._append(var, name, path)
+                with self._lock:
+                    self._ingested[var].add(name)
+                    self.done += 1
+                if not self.keep_nc:
+                    self._to_remove.append(path)
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                    # 后续文件不能越过失败的文件写入
+                    self._expected[var] = []
+                print(f"[Zarr] {name} 写入失败，{var} 的后续文件本轮不再写入: {e}")
+                return
+
+    def _append(self, var, name, path):
+        import netCDF4
+        group = _open_zarr_group(self.store_path(var))
+        time_len = group.attrs.get('era5_time_len', 0)
+
+        with netCDF4.Dataset(path) as ds:
+            ds.set_auto_maskandscale(False)
+            nt = len(ds.dimensions['time'])
+            for vname, v in ds.variables.items():
+                attrs = {k: v.getncattr(k) for k in v.ncattrs() if k != '_FillValue'}
+                attrs = {k: (val.tolist() if hasattr(val, 'tolist') else val) for k, val in attrs.items()}
+                fill = v.getncattr('_FillValue').item() if '_FillValue' in v.ncattrs() else None
+                if not v.dimensions or v.dimensions[0] != 'time':
+                    # 不含时间维的坐标只在首次写入
+                    if vname not in group:
+                        arr = _create_zarr_array(group, vname, v.shape, v.shape, v.dtype, fill, v.dimensions, attrs)
+                        arr[...] = v[...]
+                    continue
+
+                if vname in group:
+                    arr = group[vname]
+                    if arr.shape[0] > time_len:
+                        # 上次写入中途中断，截掉未登记的部分
+                        arr.resize((time_len,) + arr.shape[1:])
+                else:
+                    chunks = tuple(min(self.chunks.get(d, n), n) or 1 for d, n in zip(v.dimensions, v.shape))
+                    arr = _create_zarr_array(group, vname, (0,) + v.shape[1:], chunks, v.dtype, fill,
+                                             v.dimensions, attrs)
+                arr.resize((time_len + nt,) + arr.shape[1:])
+                if v.ndim >= 3:
+                    # 逐层写入，限制内存占用
+                    for i in range(v.shape[1]):
+                        arr[time_len:time_len + nt, i] = v[:, i]
+                else:
+                    arr[time_len:time_len + nt] = v[:]
+
+        ingested = list(group.attrs.get('era5_ingested', []))
+        ingested.append(name)
+        group.attrs.update({'era5_ingested': ingested, 'era5_time_len': time_len + nt})
+
+    def close(self):
+        """等待写入完成并合并元数据，返回 (成功数, 失败数, 仍在等待前序文件的数量)"""
+        self.executor.shutdown(wait=True)
+        import zarr
+        for var in self._ingested:
+            if os.path.exists(self.store_path(var)):
+                zarr.consolidate_metadata(self.store_path(var))
+        for path in self._to_remove:
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"[Zarr] 删除 {path} 失败: {e}")
+        waiting = sum(len(v) for v in self._expected.values())
+        return self.done, self.failed, waiting
+
+
+def create_zarr_ingestor(config):
+    """按配置中的 zarr_store 创建 Zarr 写入器，未配置时返回 None"""
+    store_root = config.get('zarr_store') if config else None
+    if not store_root:
+        return None
+    return ZarrIngestor(store_root, chunks=config.get('zarr_chunks'),
+                        keep_nc=config.get('zarr_keep_nc', True))
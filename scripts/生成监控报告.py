@@ -8,14 +8,21 @@ ERA5性能监控报告生成器
 - 生成静态HTML报告
 - 包含交互式图表
 - 支持离线查看
+- 长时间运行的数据在 SQL 中按时间分桶聚合，图表点数固定
 """
 
 import os
+import math
 import sqlite3
 import json
 from datetime import datetime
 from pathlib import Path
 
+# 图表目标点数，分桶宽度按时间跨度自适应
+TARGET_POINTS = 1000
+# 每个时间桶内速度分档数，用于估算分位数
+SPEED_BINS = 32
+
 
 class PerformanceReportGenerator:
     """性能报告生成器"""
@@ -23,17 +30,19 @@ class PerformanceReportGenerator:
     def __init__(self, db_path="era5_performance.db"):
         self.db_path = db_path
 
-    def generate_html_report(self, output_path="era5_performance_report.html"):
+    def generate_html_report(self, output_path="era5_performance_report.html", target_points=TARGET_POINTS):
         """生成HTML报告"""
 
         # 获取数据
-        logs = self._get_all_logs()
-        stats = self._get_statistics()
+        self._ensure_index()
+        logs, bucket_seconds = self._get_bucketed_logs(target_points)
 
         if not logs:
             print("[错误] 没有监控数据")
             return False
 
+        stats = self._get_statistics(logs, bucket_seconds)
+
         # 生成HTML
         html = self._create_html_template(logs, stats)
 
@@ -42,74 +51,137 @@ class PerformanceReportGenerator:
             f.write(html)
 
         print(f"[成功] 报告已生成: {output_path}")
-        print(f"        数据点: {len(logs)} 个")
+        print(f"        数据点: {len(logs)} 个 (每 {bucket_seconds} 秒聚合)")
         return True
 
-    def _get_all_logs(self):
-        """获取所有日志"""
+    def _ensure_index(self):
+        """为 timestamp 建索引，使范围查询和 MIN/MAX 不必全表扫描"""
         try:
             with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT timestamp, datetime, download_speed, total_downloaded,
-                           active_threads, cpu_usage, memory_usage, network_errors
-                    FROM performance_logs
-                    ORDER BY timestamp ASC
+                conn.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_performance_logs_timestamp
+                    ON performance_logs(timestamp)
                 ''')
-                return cursor.fetchall()
         except Exception as e:
-            print(f"[错误] 读取数据库失败: {e}")
-            return []
+            # 只读数据库等情况下不建索引也能生成报告
+            print(f"[警告] 创建索引失败: {e}")
+
+    def _get_bucketed_logs(self, target_points=TARGET_POINTS):
+        """在 SQL 中按时间分桶聚合日志
 
-    def _get_statistics(self):
-        """获取统计信息"""
+        SQL 按 (时间桶, 速度档) 分组一次扫描完成，速度分位数由各档计数在档内插值得到，
+        避免对全部样本排序。返回 (rows, bucket_seconds)，每行为:
+        (桶起始时间, 样本数, 最低速度, 平均速度, 最高速度, P50速度, P95速度,
+         累计下载量, 平均线程数, 平均CPU, 最高CPU, 平均内存, 网络错误数)
+        """
         try:
             with sqlite3.connect(self.db_path) as conn:
                 cursor = conn.cursor()
+                cursor.execute('SELECT MIN(timestamp), MAX(timestamp), MAX(download_speed) FROM performance_logs')
+                t_start, t_end, max_speed = cursor.fetchone()
+                if t_start is None:
+                    return [], 0
 
-                # 基本统计
+                bucket_seconds = max(1, math.ceil((t_end - t_start) / max(1, target_points)))
+                bin_scale = SPEED_BINS / max_speed if max_speed else 0
                 cursor.execute('''
-                    SELECT
-                        COUNT(*) as total_count,
-                        AVG(download_speed) as avg_speed,
-                        MAX(download_speed) as max_speed,
-                        MIN(download_speed) as min_speed,
-                        MAX(total_downloaded) as final_downloaded,
-                        MIN(timestamp) as start_time,
-                        MAX(timestamp) as end_time,
-                        AVG(cpu_usage) as avg_cpu,
-                        AVG(memory_usage) as avg_memory,
-                        SUM(network_errors) as total_errors
+                    SELECT CAST((timestamp - :t_start) / :bucket AS INTEGER) AS bucket,
+                           CAST(download_speed * :bin_scale AS INTEGER) AS speed_bin,
+                           COUNT(*),
+                           MIN(download_speed),
+                           SUM(download_speed),
+                           MAX(download_speed),
+                           MAX(total_downloaded),
+                           SUM(active_threads),
+                           SUM(cpu_usage),
+                           MAX(cpu_usage),
+                           SUM(memory_usage),
+                           SUM(network_errors)
                     FROM performance_logs
-                ''')
-
-                row = cursor.fetchone()
-                return {
-                    'total_count': row[0],
-                    'avg_speed': row[1],
-                    'max_speed': row[2],
-                    'min_speed': row[3],
-                    'final_downloaded': row[4],
-                    'start_time': row[5],
-                    'end_time': row[6],
-                    'avg_cpu': row[7],
-                    'avg_memory': row[8],
-                    'total_errors': row[9]
-                }
+                    GROUP BY bucket, speed_bin
+                    ORDER BY bucket ASC, speed_bin ASC
+                ''', {'t_start': t_start, 'bucket': bucket_seconds, 'bin_scale': bin_scale})
+
+                rows = []
+                current, bins = None, []
+                for row in cursor:
+                    if row[0] != current and bins:
+                        rows.append(self._merge_bucket(t_start, bucket_seconds, bins))
+                        bins = []
+                    current = row[0]
+                    bins.append(row)
+                if bins:
+                    rows.append(self._merge_bucket(t_start, bucket_seconds, bins))
+                return rows, bucket_seconds
         except Exception as e:
-            print(f"[错误] 统计失败: {e}")
+            print(f"[错误] 读取数据库失败: {e}")
+            return [], 0
+
+    @staticmethod
+    def _merge_bucket(t_start, bucket_seconds, bins):
+        """合并同一时间桶内各速度档的聚合结果"""
+        count = sum(b[2] for b in bins)
+
+        def speed_percentile(q):
+            # 速度档已按升序排列，在目标档内按 MIN/MAX 线性插值
+            rank = q * (count - 1)
+            seen = 0
+            for b in bins:
+                if seen + b[2] > rank:
+                    frac = (rank - seen) / b[2] if b[2] > 1 else 0
+                    return b[3] + (b[5] - b[3]) * frac
+                seen += b[2]
+            return bins[-1][5]
+
+        return (
+            t_start + bins[0][0] * bucket_seconds,
+            count,
+            min(b[3] for b in bins),
+            sum(b[4] for b in bins) / count,
+            max(b[5] for b in bins),
+            speed_percentile(0.50),
+            speed_percentile(0.95),
+            max(b[6] for b in bins),
+            sum(b[7] for b in bins) / count,
+            sum(b[8] for b in bins) / count,
+            max(b[9] for b in bins),
+            sum(b[10] for b in bins) / count,
+            sum(b[11] for b in bins),
+        )
+
+    def _get_statistics(self, logs, bucket_seconds):
+        """由分桶结果汇总统计信息，无需再次扫描数据库"""
+        if not logs:
             return {}
+        total_count = sum(log[1] for log in logs)
+        return {
+            'total_count': total_count,
+            'avg_speed': sum(log[3] * log[1] for log in logs) / total_count,
+            'max_speed': max(log[4] for log in logs),
+            'min_speed': min(log[2] for log in logs),
+            'final_downloaded': max(log[7] for log in logs),
+            'start_time': logs[0][0],
+            'end_time': logs[-1][0] + bucket_seconds,
+            'avg_cpu': sum(log[9] * log[1] for log in logs) / total_count,
+            'avg_memory': sum(log[11] * log[1] for log in logs) / total_count,
+            'total_errors': sum(log[12] for log in logs),
+            'bucket_seconds': bucket_seconds
+        }
 
     def _create_html_template(self, logs, stats):
         """创建HTML模板"""
 
-        # 准备图表数据
+        # 准备图表数据(每个点是一个时间桶)
+        mb = 1024 * 1024
         timestamps = [log[0] * 1000 for log in logs]  # JavaScript使用毫秒
-        speeds = [log[2] / (1024*1024) for log in logs]  # MB/s
-        downloaded = [log[3] / (1024**3) for log in logs]  # GB
-        cpu = [log[5] for log in logs]
-        memory = [log[6] for log in logs]
-        threads = [log[4] for log in logs]
+        speeds = [round(log[3] / mb, 3) for log in logs]  # 平均 MB/s
+        speeds_min = [round(log[2] / mb, 3) for log in logs]
+        speeds_max = [round(log[4] / mb, 3) for log in logs]
+        speeds_p95 = [round(log[6] / mb, 3) for log in logs]
+        downloaded = [round(log[7] / (1024**3), 3) for log in logs]  # GB
+        cpu = [round(log[9], 1) for log in logs]
+        memory = [round(log[11], 1) for log in logs]
+        threads = [round(log[8], 1) for log in logs]
 
         html = f"""<!DOCTYPE html>
 <html lang="zh-CN">
@@ -224,6 +296,7 @@ class PerformanceReportGenerator:
         <div class="header">
             <h1>ERA5下载性能监控报告</h1>
             <p>生成时间: {datetime.now().strftime('%Y年%m月%d日 %H:%M:%S')}</p>
+            <p>原始采样 {stats.get('total_count', 0)} 条，按 {stats.get('bucket_seconds', 0)} 秒分桶聚合为 {len(logs)} 个点</p>
         </div>
 
         <div class="content">
@@ -304,6 +377,9 @@ class PerformanceReportGenerator:
         // 图表数据
         const timestamps = {json.dumps(timestamps)};
         const speeds = {json.dumps(speeds)};
+        const speedsMin = {json.dumps(speeds_min)};
+        const speedsMax = {json.dumps(speeds_max)};
+        const speedsP95 = {json.dumps(speeds_p95)};
         const downloaded = {json.dumps(downloaded)};
         const cpu = {json.dumps(cpu)};
         const memory = {json.dumps(memory)};
@@ -313,6 +389,7 @@ class PerformanceReportGenerator:
         const commonOptions = {{
             responsive: true,
             maintainAspectRatio: false,
+            animation: false,
             interaction: {{
                 intersect: false,
                 mode: 'index',
@@ -333,16 +410,43 @@ class PerformanceReportGenerator:
             type: 'line',
             data: {{
                 labels: timestamps,
-                datasets: [{{
-                    label: '下载速度 (MB/s)',
-                    data: speeds,
-                    borderColor: 'rgb(75, 192, 192)',
-                    backgroundColor: 'rgba(75, 192, 192, 0.1)',
-                    borderWidth: 2,
-                    fill: true,
-                    tension: 0.4,
-                    pointRadius: 0,
-                }}],
+                datasets: [
+                    {{
+                        label: '最高 (MB/s)',
+                        data: speedsMax,
+                        borderColor: 'rgba(75, 192, 192, 0.3)',
+                        backgroundColor: 'rgba(75, 192, 192, 0.15)',
+                        borderWidth: 1,
+                        fill: '+1',
+                        pointRadius: 0,
+                    }},
+                    {{
+                        label: '最低 (MB/s)',
+                        data: speedsMin,
+                        borderColor: 'rgba(75, 192, 192, 0.3)',
+                        borderWidth: 1,
+                        fill: false,
+                        pointRadius: 0,
+                    }},
+                    {{
+                        label: '平均 (MB/s)',
+                        data: speeds,
+                        borderColor: 'rgb(75, 192, 192)',
+                        borderWidth: 2,
+                        fill: false,
+                        tension: 0.4,
+                        pointRadius: 0,
+                    }},
+                    {{
+                        label: 'P95 (MB/s)',
+                        data: speedsP95,
+                        borderColor: 'rgb(153, 102, 255)',
+                        borderWidth: 1,
+                        borderDash: [4, 4],
+                        fill: false,
+                        pointRadius: 0,
+                    }}
+                ],
             }},
             options: {{
                 ...commonOptions,
@@ -0,0 +1,56 @@
+import pytest
+
+from era5.core import VAR_CODE_RE, parse_size, parse_var_code
+from era5.scheduling import parse_months
+
+
+def test_parse_months_single_and_range():
+    assert parse_months(['202401']) == ['202401']
+    assert parse_months(['202311-202402']) == ['202311', '202312', '202401', '202402']
+
+
+def test_parse_months_years():
+    assert parse_months(['2024']) == [f'2024{m:02d}' for m in range(1, 13)]
+    months = parse_months(['2015-2024'])
+    assert len(months) == 120
+    assert (months[0], months[-1]) == ('201501', '202412')
+
+
+def test_parse_months_lists_are_merged():
+    assert parse_months(['202403, 202401', '202401-202402', '']) == ['202401', '202402', '202403']
+
+
+@pytest.mark.parametrize('spec', ['2024013', '202413', '202400', 'abc', '202403-202401', '24-25'])
+def test_parse_months_rejects_bad_input(spec):
+    with pytest.raises(ValueError):
+        parse_months([spec])
+
+
+@pytest.mark.parametrize('name, code', [
+    ('e5.oper.an.pl.128_130_t.ll025sc.2024010100_2024010123.nc', 't'),
+    ('e5.oper.an.pl.128_157_r.ll025sc.2024010100_2024010123.nc', 'r'),
+    ('e5.oper.an.sfc.128_165_10u.ll025sc.2024010100_2024013123.nc', '10u'),
+    ('e5.oper.an.sfc.228_246_100u.ll025sc.2024010100_2024013123.nc', '100u'),
+    ('e5.oper.an.pl.vo.ll025sc.nc', 'vo'),
+    ('e5.oper.an.pl.nc', 'nc'),
+])
+def test_parse_var_code(name, code):
+    assert parse_var_code(name) == code
+    assert VAR_CODE_RE.match(name).group(1) == code
+
+
+@pytest.mark.parametrize('name', ['README', 'a.b.c.nc', ''])
+def test_parse_var_code_unknown(name):
+    assert parse_var_code(name) == 'unknown'
+
+
+@pytest.mark.parametrize('text, size', [
+    ('1048576', 1 << 20),
+    ('500G', 500 << 30),
+    ('2T', 2 << 40),
+    ('1.5k', 1536),
+    (' 10MB ', 10 << 20),
+    (4096, 4096),
+])
+def test_parse_size(text, size):
+    assert parse_size(text) == size
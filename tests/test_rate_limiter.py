@@ -0,0 +1,45 @@
+import threading
+import time
+
+import pytest
+
+from era5.core import DownloadStoppedException, RateLimiter, create_rate_limiter
+
+
+def test_burst_is_not_delayed():
+    limiter = RateLimiter(1_000_000)
+    t0 = time.monotonic()
+    limiter.consume(1_000_000)
+    assert time.monotonic() - t0 < 0.1
+
+
+def test_overdraft_waits_for_refill():
+    limiter = RateLimiter(100_000)
+    limiter.consume(100_000)
+    t0 = time.monotonic()
+    limiter.consume(50_000)
+    assert 0.4 <= time.monotonic() - t0 < 1.0
+
+
+def test_threads_share_one_bucket():
+    limiter = RateLimiter(200_000, burst=1)
+    t0 = time.monotonic()
+    threads = [threading.Thread(target=limiter.consume, args=(50_000,)) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # 4 个线程共取走 200 KB，合计速率不超过 200 KB/s
+    assert time.monotonic() - t0 >= 0.9
+
+
+def test_stop_interrupts_wait():
+    limiter = RateLimiter(1000, burst=1)
+    with pytest.raises(DownloadStoppedException):
+        limiter.consume(100_000, should_stop=lambda: True)
+
+
+def test_create_rate_limiter():
+    assert create_rate_limiter({}) is None
+    assert create_rate_limiter(None) is None
+    assert create_rate_limiter({'max_rate': '50M'}).rate == 50 * 1024 * 1024
@@ -0,0 +1,140 @@
+import errno
+
+import pytest
+from botocore.exceptions import ClientError, ReadTimeoutError
+
+from era5.core import (RETRY_FATAL, RETRY_THROTTLE, RETRY_TRANSIENT, CircuitBreaker, DiskFullException,
+                       DownloadStoppedException, FileIncompleteException, RequeueTracker, RetryBudget,
+                       RetryPolicy, classify_error)
+
+
+def client_error(code, status):
+    return ClientError({'Error': {'Code': code, 'Message': code},
+                        'ResponseMetadata': {'HTTPStatusCode': status}}, 'GetObject')
+
+
+def fast_policy(**kwargs):
+    """退避很短、熔断不会触发的策略，测试不必真的等待"""
+    kwargs.setdefault('base', 0.001)
+    kwargs.setdefault('cap', 0.005)
+    kwargs.setdefault('throttle_base', 0.002)
+    return RetryPolicy(breaker=CircuitBreaker(min_requests=1000), **kwargs)
+
+
+@pytest.mark.parametrize('error, kind', [
+    (client_error('SlowDown', 503), RETRY_THROTTLE),
+    (client_error('TooManyRequests', 429), RETRY_THROTTLE),
+    (client_error('InternalError', 500), RETRY_TRANSIENT),
+    (client_error('RequestTimeout', 400), RETRY_TRANSIENT),
+    (client_error('NoSuchKey', 404), RETRY_FATAL),
+    (client_error('AccessDenied', 403), RETRY_FATAL),
+    (client_error('InvalidRange', 416), RETRY_FATAL),
+    (OSError(errno.ENOSPC, "No space left on device"), RETRY_FATAL),
+    (OSError(errno.EACCES, "Permission denied"), RETRY_FATAL),
+    (OSError(errno.ECONNRESET, "Connection reset"), RETRY_TRANSIENT),
+    (TimeoutError("timed out"), RETRY_TRANSIENT),
+    (ReadTimeoutError(endpoint_url='https://example'), RETRY_TRANSIENT),
+    (FileIncompleteException("short"), RETRY_TRANSIENT),
+    (DownloadStoppedException("stop"), RETRY_FATAL),
+    (DiskFullException("full"), RETRY_FATAL),
+])
+def test_classify_error(error, kind):
+    assert classify_error(error) == kind
+
+
+def test_retry_policy_retries_transient_errors():
+    calls = []
+    retries = []
+
+    def attempt(n):
+        calls.append(n)
+        if n < 2:
+            raise client_error('InternalError', 500)
+        return 'ok'
+
+    result = fast_policy().run(attempt, on_retry=lambda *args: retries.append(args[:2]))
+    assert result == 'ok'
+    assert calls == [0, 1, 2]
+    assert retries == [(0, RETRY_TRANSIENT), (1, RETRY_TRANSIENT)]
+
+
+def test_retry_policy_raises_fatal_immediately():
+    calls = []
+
+    def attempt(n):
+        calls.append(n)
+        raise client_error('NoSuchKey', 404)
+
+    with pytest.raises(ClientError):
+        fast_policy().run(attempt)
+    assert calls == [0]
+
+
+def test_retry_policy_gives_up_after_max_attempts():
+    calls = []
+
+    def attempt(n):
+        calls.append(n)
+        raise FileIncompleteException("short")
+
+    with pytest.raises(FileIncompleteException):
+        fast_policy(max_attempts=3).run(attempt)
+    assert calls == [0, 1, 2]
+
+
+def test_retry_policy_spends_shared_budget():
+    policy = fast_policy()
+    policy.budget = RetryBudget(1)
+    calls = []
+
+    def attempt(n):
+        calls.append(n)
+        raise client_error('SlowDown', 503)
+
+    with pytest.raises(ClientError):
+        policy.run(attempt)
+    assert calls == [0, 1]
+    assert policy.budget.remaining == 0
+
+
+def test_retry_policy_stops_during_backoff():
+    policy = fast_policy(base=5.0, cap=5.0)
+
+    def attempt(n):
+        raise client_error('InternalError', 500)
+
+    with pytest.raises(DownloadStoppedException):
+        policy.run(attempt, should_stop=lambda: True)
+
+
+def test_retry_delay_is_bounded():
+    policy = RetryPolicy(base=2.0, cap=60.0, throttle_base=5.0)
+    delay = 0.0
+    for _ in range(50):
+        delay = policy.next_delay(delay, RETRY_TRANSIENT)
+        assert 2.0 <= delay <= 60.0
+    assert policy.next_delay(0.0, RETRY_THROTTLE) >= 5.0
+
+
+def test_circuit_breaker_opens_on_high_error_rate():
+    breaker = CircuitBreaker(window=30, min_requests=4, threshold=0.5, cooldown=10)
+    for ok in (True, False, False, False):
+        breaker.record(ok)
+    assert breaker.trips == 1
+    assert breaker.open_until > 0
+
+
+def test_requeue_tracker():
+    tracker = RequeueTracker(max_attempts=2, budget=RetryBudget(10))
+    tracker.started('a')
+    assert tracker.failed('a', FileIncompleteException("short"))
+    tracker.started('a')
+    assert not tracker.failed('a', FileIncompleteException("short"))
+    tracker.started('b')
+    assert not tracker.failed('b', client_error('NoSuchKey', 404))
+    tracker.skipped('c', "磁盘空间不足，本次未下载")
+    report = tracker.report()
+    assert set(report) == {'a', 'b', 'c'}
+    assert report['a']['attempts'] == 2
+    tracker.succeeded('a')
+    assert 'a' not in tracker.report()
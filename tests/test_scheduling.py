@@ -0,0 +1,133 @@
+import json
+import os
+import time
+
+import pytest
+
+from era5.scheduling import JOBS_SPOOL_DIR, JobQueue, PriorityRules, PriorityScheduler, parse_deadline, submit_job
+
+
+def drain(scheduler, n):
+    return [scheduler.get() for _ in range(n)]
+
+
+def test_scheduler_orders_by_priority_then_arrival():
+    items = [('a', 0), ('b', 5), ('c', 1), ('d', 5)]
+    scheduler = PriorityScheduler(lambda item: (item[1], None), backfill_share=0.0)
+    for item in items:
+        scheduler.put(item)
+    assert scheduler.qsize() == 4
+    assert [name for name, _ in drain(scheduler, 4)] == ['b', 'd', 'c', 'a']
+    assert scheduler.qsize() == 0
+
+
+def test_scheduler_gives_backfill_its_share():
+    scheduler = PriorityScheduler(lambda item: item[1:], backfill_share=0.2)
+    for i in range(10):
+        scheduler.put((f'u{i}', 10, None))
+        scheduler.put((f'b{i}', 0, None))
+    order = [name for name, _, _ in drain(scheduler, 10)]
+    # 两类任务都在排队时，每 5 次出队中有 1 次给后台补档
+    assert [i for i, name in enumerate(order) if name.startswith('b')] == [4, 9]
+
+
+def test_scheduler_serves_near_deadline_first():
+    now = time.time()
+    scheduler = PriorityScheduler(lambda item: item[1:], slack=3600)
+    scheduler.put(('urgent', 10, None))
+    scheduler.put(('far', 0, now + 86400))
+    scheduler.put(('near', 0, now + 60))
+    assert [name for name, _, _ in drain(scheduler, 3)] == ['near', 'urgent', 'far']
+
+
+def test_scheduler_returns_sentinels_last():
+    scheduler = PriorityScheduler(lambda item: (0, None))
+    scheduler.put_last(None)
+    scheduler.put('a')
+    scheduler.put('b')
+    assert drain(scheduler, 3) == ['a', 'b', None]
+
+
+def test_priority_rules_classify():
+    rules = PriorityRules([
+        {'months': ['202401-202403'], 'vars': 't', 'priority': 10, 'deadline': '2025-03-01'},
+        {'months': '202402', 'priority': 3, 'deadline': '2025-02-01 12:00'},
+    ])
+    assert rules.classify('202401', 't') == (10, parse_deadline('2025-03-01'))
+    assert rules.classify('202401', 'u') == (0, None)
+    assert rules.classify('202402', 'u') == (3, parse_deadline('2025-02-01 12:00'))
+    assert rules.classify('202402') == (10, parse_deadline('2025-02-01 12:00'))
+    assert rules.classify('202405', 't') == (0, None)
+    assert rules.classify_file({'Key': 'e5.oper.an.pl/202401/x.nc', 'Var': 't'})[0] == 10
+
+
+def test_parse_deadline():
+    assert parse_deadline(None) is None
+    assert parse_deadline('') is None
+    assert parse_deadline(1700000000) == 1700000000.0
+    assert parse_deadline('2025-03-01T18:00') == parse_deadline('2025-03-01 18:00')
+    assert parse_deadline('2025-03-01 18:00') - parse_deadline('2025-03-01') == 18 * 3600
+    with pytest.raises(ValueError):
+        parse_deadline('03/01/2025')
+
+
+def test_job_queue_pops_urgent_first():
+    queue = JobQueue(PriorityRules())
+    queue.add('202401', ['t'])
+    queue.add('202402', ['t'], priority=5)
+    queue.add('202403', ['t'], priority=5)
+    assert [queue.pop()['month'] for _ in range(3)] == ['202402', '202403', '202401']
+    assert queue.pop() is None
+
+
+def test_job_queue_preempts_backfill_for_urgent_work():
+    queue = JobQueue(PriorityRules())
+    running = queue.add('202401', ['t'])
+    assert queue.pop() is running
+    assert queue.preemptor(running, 0) is None
+    urgent = queue.add('202402', ['t'], priority=5)
+    assert queue.preemptor(running, 0) is urgent
+    # 后台补档有额度时不被抢占
+    queue.credit = 100
+    assert queue.preemptor(running, 10) is None
+    assert queue.preemptor(running, 200) is urgent
+
+
+def test_job_queue_backfill_credit():
+    queue = JobQueue(PriorityRules(), backfill_share=0.2, backfill_slice=600)
+    urgent = queue.add('202401', ['t'], priority=5)
+    backfill = queue.add('202402', ['t'])
+    queue.record(urgent, 400)
+    assert queue.credit == pytest.approx(100)
+    queue.record(urgent, 10000)
+    assert queue.credit == 600
+    queue.record(backfill, 250)
+    assert queue.credit == pytest.approx(350)
+    # 有额度时后台补档先出队
+    assert queue.pop() is backfill
+    queue.record(backfill, 1000)
+    assert queue.credit == 0
+
+
+def test_job_queue_polls_submitted_jobs(tmp_path):
+    spool = tmp_path / JOBS_SPOOL_DIR
+    submit_job(str(tmp_path), ['202401-202402'], ['t'], priority=7, deadline='2025-03-01')
+    (spool / 'broken.json').write_text('{not json', encoding='utf-8')
+
+    queue = JobQueue(PriorityRules())
+    added = queue.poll(str(spool), default_vars=['u'])
+    assert [e['month'] for e in added] == ['202401', '202402']
+    assert all(e['vars'] == ['t'] and e['priority'] == 7 for e in added)
+    assert added[0]['deadline'] == parse_deadline('2025-03-01')
+    assert sorted(os.listdir(spool)) == ['broken.json.bad']
+    # 提交的任务同时成为规则，列举出的文件按它排序
+    assert queue.rules.classify('202402', 't')[0] == 7
+
+
+def test_submit_job_writes_complete_file(tmp_path):
+    path = submit_job(str(tmp_path), ['2024'], [], priority=1)
+    with open(path, encoding='utf-8') as f:
+        job = json.load(f)
+    assert job['months'] == ['2024']
+    assert job['priority'] == 1
+    assert not [n for n in os.listdir(os.path.dirname(path)) if n.endswith('.tmp')]
@@ -0,0 +1,196 @@
+import io
+import threading
+import time
+
+import pytest
+
+from era5.core import (DownloadStoppedException, FileIncompleteException, PauseGate, TransferStats,
+                       stream_object_to_file)
+
+DATA = bytes(range(256)) * 64   # 16 KB
+CHUNK = 1024
+
+
+class FakeBody:
+    """模拟 botocore StreamingBody，只提供 iter_chunks"""
+
+    def __init__(self, data):
+        self.data = data
+        self.closed = False
+
+    def iter_chunks(self, chunk_size):
+        for i in range(0, len(self.data), chunk_size):
+            if self.closed:
+                raise ValueError("读取已关闭的响应")
+            yield self.data[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeRaw:
+    """模拟 urllib3 响应：_fp 支持 readinto，可走直接读取路径"""
+
+    def __init__(self, data):
+        self._fp = io.BytesIO(data)
+        self.headers = {}
+        self.released = False
+
+    def release_conn(self):
+        self.released = True
+
+
+class DirectBody:
+    def __init__(self, data, content_length=None):
+        self._raw_stream = FakeRaw(data)
+        self._content_length = len(data) if content_length is None else content_length
+
+    def close(self):
+        pass
+
+
+class FakeClient:
+    """记录每次 get_object 的 Range，按 Range 返回对象的剩余部分"""
+
+    def __init__(self, data, body_cls=FakeBody):
+        self.data = data
+        self.body_cls = body_cls
+        self.ranges = []
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.ranges.append(Range)
+        start = int(Range[len('bytes='):-1]) if Range else 0
+        assert start < len(self.data), "Range 超出对象末尾 (416)"
+        return {'Body': self.body_cls(self.data[start:])}
+
+
+def f_info(data=DATA):
+    return {'Key': 'e5.oper.an.pl/202401/x.nc', 'Size': len(data), 'Var': 't'}
+
+
+def stream(client, path, start=0, **kwargs):
+    return stream_object_to_file(client, 'bucket', f_info(client.data), str(path), start, CHUNK, **kwargs)
+
+
+def stop_after(seconds):
+    """超时保护：gate 意外地一直等待时让测试以停止异常结束，而不是卡住"""
+    deadline = time.monotonic() + seconds
+    return lambda: time.monotonic() > deadline
+
+
+def test_full_download(tmp_path):
+    client = FakeClient(DATA)
+    path = tmp_path / 'x.nc.tmp'
+    seen = []
+    stats = TransferStats()
+    assert stream(client, path, on_chunk=lambda n, done: seen.append(done), stats=stats) == len(DATA)
+    assert path.read_bytes() == DATA
+    assert client.ranges == [None]
+    assert seen == list(range(CHUNK, len(DATA) + 1, CHUNK))
+    assert stats.by_phase()['body'].count == 1
+
+
+def test_resume_appends_from_offset(tmp_path):
+    client = FakeClient(DATA)
+    path = tmp_path / 'x.nc.tmp'
+    path.write_bytes(DATA[:5000])
+    assert stream(client, path, start=5000) == len(DATA)
+    assert client.ranges == ['bytes=5000-']
+    assert path.read_bytes() == DATA
+
+
+def test_short_pause_keeps_connection(tmp_path):
+    client = FakeClient(DATA)
+    path = tmp_path / 'x.nc.tmp'
+    gate = PauseGate(hold=5)
+
+    def on_chunk(n, done):
+        if done == 4 * CHUNK:
+            gate.pause()
+            threading.Timer(0.2, gate.resume).start()
+
+    stream(client, path, on_chunk=on_chunk, gate=gate, should_stop=stop_after(10))
+    assert client.ranges == [None]
+    assert path.read_bytes() == DATA
+
+
+def test_long_pause_resumes_with_range(tmp_path):
+    client = FakeClient(DATA)
+    path = tmp_path / 'x.nc.tmp'
+    gate = PauseGate(hold=0.1)
+
+    def on_chunk(n, done):
+        if done == 4 * CHUNK and not client.ranges[1:]:
+            gate.pause()
+            threading.Timer(1.0, gate.resume).start()
+
+    assert stream(client, path, on_chunk=on_chunk, gate=gate, should_stop=stop_after(10)) == len(DATA)
+    assert client.ranges == [None, f'bytes={4 * CHUNK}-']
+    assert path.read_bytes() == DATA
+
+
+def test_pause_after_last_chunk_is_ignored(tmp_path):
+    client = FakeClient(DATA)
+    path = tmp_path / 'x.nc.tmp'
+    gate = PauseGate(hold=0)
+
+    def on_chunk(n, done):
+        if done == len(DATA):
+            gate.pause()
+
+    assert stream(client, path, on_chunk=on_chunk, gate=gate, should_stop=stop_after(5)) == len(DATA)
+    assert client.ranges == [None]
+    assert gate.paused
+    assert path.read_bytes() == DATA
+
+
+def test_stop_while_paused_keeps_written_data(tmp_path):
+    client = FakeClient(DATA)
+    path = tmp_path / 'x.nc.tmp'
+    gate = PauseGate(hold=5)
+    stop = threading.Event()
+
+    def on_chunk(n, done):
+        if done == 3 * CHUNK:
+            gate.pause()
+            threading.Timer(0.2, stop.set).start()
+
+    with pytest.raises(DownloadStoppedException):
+        stream(client, path, on_chunk=on_chunk, gate=gate, should_stop=stop.is_set)
+    # 暂停前写入的数据已刷到磁盘，下次从这里续传
+    assert path.read_bytes() == DATA[:3 * CHUNK]
+
+
+def test_direct_read_path(tmp_path):
+    bodies = []
+    client = FakeClient(DATA, lambda data: bodies.append(DirectBody(data)) or bodies[-1])
+    path = tmp_path / 'x.nc.tmp'
+    assert stream(client, path) == len(DATA)
+    assert path.read_bytes() == DATA
+    # 直接读完后连接交还连接池
+    assert bodies[0]._raw_stream.released
+
+
+def test_direct_read_falls_back_for_compressed_body(tmp_path):
+    bodies = []
+
+    def body(data):
+        b = DirectBody(data)
+        b._raw_stream.headers = {'content-encoding': 'gzip'}
+        b.iter_chunks = FakeBody(data).iter_chunks
+        bodies.append(b)
+        return b
+
+    client = FakeClient(DATA, body)
+    path = tmp_path / 'x.nc.tmp'
+    assert stream(client, path) == len(DATA)
+    assert path.read_bytes() == DATA
+    # 压缩的响应交给 iter_chunks 解码，不直接读底层连接
+    assert not bodies[0]._raw_stream.released
+
+
+def test_direct_read_detects_short_body(tmp_path):
+    client = FakeClient(DATA, lambda data: DirectBody(data, content_length=len(data) + 100))
+    path = tmp_path / 'x.nc.tmp'
+    with pytest.raises(FileIncompleteException):
+        stream(client, path)
@@ -0,0 +1,90 @@
+import io
+
+import pytest
+
+from era5.subset import read_chunk_index, subset_netcdf
+
+np = pytest.importorskip('numpy')
+h5py = pytest.importorskip('h5py')
+netCDF4 = pytest.importorskip('netCDF4')
+
+LEVELS = [1000, 850, 700, 500, 300]
+LATS = np.linspace(90, -90, 37)
+LONS = np.arange(0, 360, 10.0)
+
+
+class RangeBody:
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self):
+        return self.stream.read()
+
+    def close(self):
+        pass
+
+
+class RangeClient:
+    """按 Range 返回本地文件片段的假 S3 客户端"""
+
+    def __init__(self, data):
+        self.data = data
+        self.requests = 0
+
+    def get_object(self, Bucket, Key, Range):
+        self.requests += 1
+        start, end = (int(v) for v in Range[len('bytes='):].split('-'))
+        return {'Body': RangeBody(self.data[start:end + 1])}
+
+
+@pytest.fixture
+def era5_file(tmp_path):
+    path = tmp_path / 'e5.oper.an.pl.128_130_t.ll025sc.nc'
+    values = np.random.default_rng(0).random((4, len(LEVELS), len(LATS), len(LONS)), dtype='f4')
+    with netCDF4.Dataset(path, 'w', format='NETCDF4') as ds:
+        for name, coord in (('time', None), ('level', LEVELS), ('latitude', LATS), ('longitude', LONS)):
+            ds.createDimension(name, 4 if coord is None else len(coord))
+            var = ds.createVariable(name, 'f8' if name != 'level' else 'i4', (name,))
+            var[:] = np.arange(4) if coord is None else coord
+        var = ds.createVariable('T', 'f4', ('time', 'level', 'latitude', 'longitude'), zlib=True,
+                                chunksizes=(1, 1, len(LATS), len(LONS)))
+        var[:] = values
+    return path, values
+
+
+def test_read_chunk_index_matches_get_chunk_info(era5_file):
+    path, _ = era5_file
+    with h5py.File(path, 'r') as h5:
+        dsid = h5['T'].id
+        expected = [dsid.get_chunk_info(i) for i in range(dsid.get_num_chunks())]
+        got = read_chunk_index(dsid)
+
+        class NoIter:
+            # 没有 chunk_iter 的旧版 h5py/HDF5
+            get_num_chunks = dsid.get_num_chunks
+            get_chunk_info = dsid.get_chunk_info
+
+        fallback = read_chunk_index(NoIter())
+    key = lambda info: (info.chunk_offset, info.byte_offset, info.size)
+    assert len(got) == len(expected) == 4 * len(LEVELS)
+    assert sorted(map(key, got)) == sorted(map(key, expected)) == sorted(map(key, fallback))
+
+
+def test_subset_by_level_and_region(era5_file, tmp_path):
+    path, values = era5_file
+    data = path.read_bytes()
+    client = RangeClient(data)
+    out = tmp_path / 'out.subset.nc'
+    fetched, total = subset_netcdf(client, 'bucket', {'Key': 'k', 'Size': len(data)}, str(out),
+                                   levels=[500, 850], bbox=[40, 100, 0, 150], times=[1, 3])
+    assert total == len(data)
+    # 只取回了选中的 2 个时次 × 2 个层次的块
+    assert fetched < total
+    lat_idx = np.nonzero((LATS <= 40) & (LATS >= 0))[0]
+    lon_idx = np.nonzero((LONS >= 100) & (LONS <= 150))[0]
+    with netCDF4.Dataset(out) as ds:
+        assert list(ds['level'][:]) == [850, 500]
+        np.testing.assert_array_equal(ds['latitude'][:], LATS[lat_idx])
+        np.testing.assert_array_equal(ds['longitude'][:], LONS[lon_idx])
+        expected = values[1:3][:, [1, 3]][:, :, lat_idx][:, :, :, lon_idx]
+        np.testing.assert_array_equal(ds['T'][:], expected)
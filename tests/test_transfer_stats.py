@@ -0,0 +1,133 @@
+import json
+
+import pytest
+
+from era5.core import LATENCY_BUCKETS_MS, TRANSFER_PHASES, TRANSFER_STATS_FILE, LatencyHistogram, TransferStats
+
+OVERFLOW = len(LATENCY_BUCKETS_MS)
+
+
+@pytest.mark.parametrize('ms, bucket', [
+    (0.0, 0),
+    (0.5, 0),
+    (1.0, 0),        # 桶上界包含在桶内
+    (1.01, 1),
+    (2.0, 1),
+    (7.0, 3),
+    (1000.0, LATENCY_BUCKETS_MS.index(1000)),
+    (60000.0, OVERFLOW - 1),
+    (60000.1, OVERFLOW),
+    (1e9, OVERFLOW),
+])
+def test_bucket_placement(ms, bucket):
+    hist = LatencyHistogram()
+    hist.observe(ms)
+    assert hist.counts[bucket] == 1
+    assert sum(hist.counts) == hist.count == 1
+    assert hist.max_ms == ms
+
+
+def test_percentile_returns_bucket_upper_bound():
+    hist = LatencyHistogram()
+    for ms in [3] * 50 + [40] * 45 + [150] * 5:
+        hist.observe(ms)
+    assert hist.percentile(0.5) == 5.0
+    assert hist.percentile(0.9) == 50.0
+    assert hist.percentile(0.95) == 50.0
+    assert hist.percentile(0.96) == 150.0     # 上界 200 超过观测到的最大值，取最大值
+    assert hist.percentile(1.0) == 150.0
+
+
+def test_percentile_walks_every_bucket():
+    hist = LatencyHistogram()
+    samples = [b - 0.5 for b in LATENCY_BUCKETS_MS]
+    for ms in samples:
+        hist.observe(ms)
+    n = len(samples)
+    for i, bound in enumerate(LATENCY_BUCKETS_MS):
+        expected = min(float(bound), hist.max_ms)
+        assert hist.percentile((i + 1) / n) == expected
+
+
+def test_percentile_overflow_bucket_uses_max():
+    hist = LatencyHistogram()
+    hist.observe(10)
+    hist.observe(90000)
+    hist.observe(120000)
+    assert hist.counts[OVERFLOW] == 2
+    assert hist.percentile(0.95) == 120000
+    assert hist.percentile(0.3) == 10.0
+
+
+def test_percentile_of_empty_histogram():
+    assert LatencyHistogram().percentile(0.5) == 0.0
+
+
+def test_merge():
+    a, b = LatencyHistogram(), LatencyHistogram()
+    for ms in (1, 30, 70000):
+        a.observe(ms)
+    for ms in (30, 400):
+        b.observe(ms)
+    a.merge(b)
+    assert a.count == 5
+    assert sum(a.counts) == 5
+    assert a.counts[LATENCY_BUCKETS_MS.index(50)] == 2
+    assert a.total_ms == pytest.approx(1 + 30 + 70000 + 30 + 400)
+    assert a.max_ms == 70000
+    assert b.count == 2
+
+
+def timings(connect=0.0, ttfb=0.0, body=0.0, disk=0.0):
+    return {'connect': connect, 'ttfb': ttfb, 'body': body, 'disk': disk}
+
+
+def test_transfer_stats_by_phase_and_var():
+    stats = TransferStats()
+    stats.record('t', 0, timings(ttfb=0.020, body=1.5))
+    stats.record('t', 1, timings(ttfb=0.080, body=0.5))
+    stats.record('u', 0, timings(connect=0.010, ttfb=0.300, body=2.0))
+    merged = stats.by_phase()
+    assert set(merged) == set(TRANSFER_PHASES)
+    assert all(merged[phase].count == 3 for phase in TRANSFER_PHASES)
+    assert merged['ttfb'].max_ms == pytest.approx(300)
+    only_t = stats.by_phase('t')
+    assert only_t['ttfb'].count == 2
+    assert only_t['body'].total_ms == pytest.approx(2000)
+    # 重试次数分开统计
+    snapshot = stats.snapshot()
+    assert set(snapshot) == {'t', 'u'}
+    assert set(snapshot['t']) == {'0', '1'}
+    assert snapshot['t']['1']['ttfb']['count'] == 1
+
+
+def test_transfer_stats_summary_lines():
+    stats = TransferStats()
+    assert stats.summary_lines() == []
+    stats.record('t', 0, timings(ttfb=0.020, body=1.5))
+    lines = stats.summary_lines()
+    assert len(lines) == 1 + len(TRANSFER_PHASES)
+    assert lines[1 + TRANSFER_PHASES.index('body')].split()[:2] == ['body', '1']
+
+
+def test_transfer_stats_save(tmp_path):
+    stats = TransferStats()
+    stats.record('t', 0, timings(connect=0.002, ttfb=0.040, body=0.9, disk=0.01))
+    stats.record('t', 0, timings(ttfb=70.0))
+    stats.save(str(tmp_path))
+    with open(tmp_path / TRANSFER_STATS_FILE, encoding='utf-8') as f:
+        saved = json.load(f)
+    assert saved['phases'] == list(TRANSFER_PHASES)
+    ttfb = saved['stats']['t']['0']['ttfb']
+    assert ttfb['buckets_ms'] == list(LATENCY_BUCKETS_MS) + ['inf']
+    assert ttfb['count'] == 2
+    assert ttfb['counts'][LATENCY_BUCKETS_MS.index(50)] == 1
+    assert ttfb['counts'][-1] == 1
+    assert ttfb['max_ms'] == 70000
+    assert ttfb['p50_ms'] == 50.0
+    assert ttfb['p95_ms'] == 70000
+
+
+def test_transfer_stats_save_failure_is_reported(tmp_path, capsys):
+    TransferStats().save(str(tmp_path / 'missing'))
+    assert '保存传输统计失败' in capsys.readouterr().out
@@ -0,0 +1,161 @@
+import os
+
+import pytest
+
+from era5.core import FileCorruptException, FileIncompleteException
+from era5.validate import _lookup3, audit_directory, validate_netcdf, verify_download
+
+np = pytest.importorskip('numpy')
+
+
+@pytest.mark.parametrize('data, initval, expected', [
+    # lookup3.c 自带的 hashlittle 测试向量
+    (b'', 0, 0xdeadbeef),
+    (b'', 0xdeadbeef, 0xbd5b7dde),
+    (b'Four score and seven years ago', 0, 0x17770551),
+    (b'Four score and seven years ago', 1, 0xcd628161),
+])
+def test_lookup3_known_vectors(data, initval, expected):
+    assert _lookup3(data, initval) == expected
+
+
+def test_lookup3_accepts_memoryview():
+    data = bytes(range(256)) * 3
+    assert _lookup3(memoryview(data)[5:101]) == _lookup3(data[5:101])
+
+
+def write_netcdf4(path, fmt='NETCDF4'):
+    netCDF4 = pytest.importorskip('netCDF4')
+    with netCDF4.Dataset(path, 'w', format=fmt) as ds:
+        ds.createDimension('time', 8)
+        ds.createDimension('lat', 32)
+        ds.createDimension('lon', 64)
+        kwargs = {'zlib': True, 'chunksizes': (1, 32, 64)} if fmt.startswith('NETCDF4') else {}
+        var = ds.createVariable('t', 'f4', ('time', 'lat', 'lon'), **kwargs)
+        var[:] = np.random.default_rng(0).random((8, 32, 64), dtype='f4')
+    return str(path)
+
+
+def write_h5py(path):
+    h5py = pytest.importorskip('h5py')
+    # libver='latest' 写出带校验和的 v3 超级块和 v2 对象头
+    with h5py.File(path, 'w', libver='latest') as h5:
+        h5.create_dataset('t', data=np.arange(64 * 64, dtype='f8').reshape(64, 64),
+                          chunks=(8, 64), compression='gzip')
+        h5.create_dataset('plain', data=np.arange(100, dtype='i4'))
+    return str(path)
+
+
+def flip_byte(path, offset):
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        b = f.read(1)
+        f.seek(offset)
+        f.write(bytes([b[0] ^ 0xFF]))
+
+
+def truncate(path, size):
+    with open(path, 'r+b') as f:
+        f.truncate(size)
+
+
+def test_validate_netcdf4(tmp_path):
+    info = validate_netcdf(write_netcdf4(tmp_path / 'a.nc'))
+    assert info['format'].startswith('hdf5-sb')
+    assert info['chunks_checked'] == 4
+
+
+def test_validate_netcdf4_all_chunks(tmp_path):
+    info = validate_netcdf(write_netcdf4(tmp_path / 'a.nc'), samples=None)
+    assert info['chunks_checked'] == 8
+
+
+@pytest.mark.parametrize('fmt', ['NETCDF3_CLASSIC', 'NETCDF3_64BIT_OFFSET'])
+def test_validate_classic(tmp_path, fmt):
+    info = validate_netcdf(write_netcdf4(tmp_path / 'a.nc', fmt))
+    assert info['format'].startswith('classic-')
+
+
+def test_validate_h5py_latest(tmp_path):
+    info = validate_netcdf(write_h5py(tmp_path / 'a.h5'))
+    assert info['format'] == 'hdf5-sb3'
+    assert info['chunks_checked'] == 4
+
+
+@pytest.mark.parametrize('fmt', ['NETCDF4', 'NETCDF3_CLASSIC'])
+def test_truncated_file_is_incomplete(tmp_path, fmt):
+    path = write_netcdf4(tmp_path / 'a.nc', fmt)
+    truncate(path, os.path.getsize(path) // 2)
+    with pytest.raises(FileIncompleteException) as info:
+        validate_netcdf(path)
+    assert not isinstance(info.value, FileCorruptException)
+
+
+def test_superblock_checksum_mismatch(tmp_path):
+    path = write_h5py(tmp_path / 'a.h5')
+    # v3 超级块第 12 字节起是基址，改动后校验和不再相符
+    flip_byte(path, 12)
+    with pytest.raises(FileCorruptException):
+        validate_netcdf(path)
+
+
+def test_missing_signature(tmp_path):
+    path = tmp_path / 'a.nc'
+    path.write_bytes(b'\0' * 4096)
+    with pytest.raises(FileCorruptException):
+        validate_netcdf(str(path))
+
+
+def test_tiny_file_is_incomplete(tmp_path):
+    path = tmp_path / 'a.nc'
+    path.write_bytes(b'\x89HD')
+    with pytest.raises(FileIncompleteException):
+        validate_netcdf(str(path))
+
+
+def test_corrupt_chunk_is_detected(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    path = write_h5py(tmp_path / 'a.h5')
+    with h5py.File(path, 'r') as h5:
+        info = h5['t'].id.get_chunk_info(7)
+    flip_byte(path, info.byte_offset + info.size // 2)
+    # 默认只抽 4 块，均匀抽样包含最后一块
+    with pytest.raises(FileCorruptException):
+        validate_netcdf(path)
+
+
+def test_corrupt_metadata_is_wrapped(tmp_path):
+    path = write_netcdf4(tmp_path / 'a.nc')
+    # 逐字节破坏文件开头的元数据，h5py 的异常都应转换为 FileIncompleteException 及其子类
+    size = min(os.path.getsize(path), 2048)
+    original = open(path, 'rb').read()
+    for offset in range(0, size, 7):
+        flip_byte(path, offset)
+        try:
+            validate_netcdf(path)
+        except FileIncompleteException:
+            pass
+        with open(path, 'wb') as f:
+            f.write(original)
+
+
+def test_verify_download_removes_bad_file(tmp_path):
+    path = write_netcdf4(tmp_path / 'a.nc.tmp')
+    truncate(path, os.path.getsize(path) - 100)
+    with pytest.raises(FileCorruptException):
+        verify_download(path)
+    assert not os.path.exists(path)
+
+
+def test_verify_download_keeps_good_file(tmp_path):
+    path = write_netcdf4(tmp_path / 'a.nc.tmp')
+    verify_download(path)
+    assert os.path.exists(path)
+
+
+def test_audit_directory(tmp_path):
+    write_netcdf4(tmp_path / 'good.nc')
+    bad = write_netcdf4(tmp_path / 'bad.nc')
+    truncate(bad, 1000)
+    assert audit_directory(str(tmp_path), max_workers=1) == (1, 1)
+    assert (tmp_path / '.era5_audit.jsonl').exists()